@@ -0,0 +1,385 @@
+import os
+import copy
+import asyncio
+from typing import List, Dict, Any, Optional
+from dotenv import load_dotenv
+from pymongo.errors import ExecutionTimeout
+from common.database import get_async_client, get_database, pool_metrics, async_health_check
+from common.query_cache import schema_fingerprint
+from common.collection_stats import CollectionStatsBuilder
+from common.hll import FieldSketches
+from common.schema_inference import ainfer_schema
+from common.prompt_cache import atimed_invoke
+from common.result_cache import result_key
+from common.serializer import to_jsonable
+from test import MongoDBQueryEngine
+
+# Load environment variables
+load_dotenv()
+
+# Upper bounds on in-flight LLM and database calls per engine
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", "32"))
+
+
+class AsyncMongoDBQueryEngine(MongoDBQueryEngine):
+    """MongoDBQueryEngine on Motor and the LLM's ainvoke, so one worker can serve many users"""
+
+    def __init__(
+        self,
+        mongodb_uri: str,
+        database_name: str,
+        google_api_key: str,
+        llm_concurrency: int = LLM_CONCURRENCY,
+        db_concurrency: int = DB_CONCURRENCY,
+    ):
+        # MongoDBQueryEngine.__init__ is not called: it connects and loads the schema synchronously.
+        # Use `await AsyncMongoDBQueryEngine.create(...)` to get a ready engine.
+        self.mongodb_uri = mongodb_uri
+        self.database_name = database_name
+        self.google_api_key = google_api_key
+        self.client = get_async_client(
+            mongodb_uri,
+            serverSelectionTimeoutMS=30000,
+            connectTimeoutMS=30000,
+            ssl=True,
+            tlsAllowInvalidCertificates=True
+        )
+        self.db = self.client[database_name]
+        self.analytics_db = get_database(self.client, database_name, analytics=True)
+        self.collections = {}  # Cache of collection metadata
+        self.current_collection = None
+        self.chat_history = []
+
+        self.llm_semaphore = asyncio.Semaphore(llm_concurrency)
+        self.db_semaphore = asyncio.Semaphore(db_concurrency)
+        self._background_tasks = set()
+
+        self._init_components(google_api_key)
+
+    @classmethod
+    async def create(cls, mongodb_uri: str, database_name: str, google_api_key: str, **kwargs):
+        """Create an engine and load the database schema"""
+        engine = cls(mongodb_uri, database_name, google_api_key, **kwargs)
+        await engine._load_database_schema()
+        return engine
+
+    def session(self):
+        """Return an engine for one user session, sharing this engine's pool, LLM, caches and limits"""
+        session = copy.copy(self)
+        session.chat_history = []
+        return session
+
+    async def _load_database_schema(self):
+        """Load schema information about all collections in the database"""
+        print(f"Connecting to MongoDB database: {self.database_name}")
+
+        try:
+            await self.client.server_info()  # Check connection
+        except Exception as e:
+            raise ConnectionError(f"Failed to connect to MongoDB: {e}")
+
+        collection_names = await self.db.list_collection_names()
+        print(f"Found {len(collection_names)} collections: {', '.join(collection_names)}")
+
+        if not self._load_from_catalog("portcalls"):
+            await self._analyze_collection("portcalls")
+
+    async def _analyze_collection(self, collection_name: str, sample_size: int = 100):
+        """Analyze a collection's schema from a sample of documents"""
+        collection = self.db[collection_name]
+
+        async with self.db_semaphore:
+            total_count = await self.count_provider.acount(collection)
+            # Server-side inference, or a random sample grown until the field/type set stops changing
+            sample_docs, fields = await ainfer_schema(collection, self._analyze_document, batch_size=sample_size)
+
+        self._store_collection_metadata(collection_name, total_count, sample_docs, fields)
+
+    def _refresh_in_background(self, collection_name: str):
+        """Re-analyze a collection in a background task"""
+        async def refresh():
+            try:
+                await self._analyze_collection(collection_name)
+            except Exception as e:
+                print(f"Background schema refresh of {collection_name} failed: {e}")
+
+        task = asyncio.get_running_loop().create_task(refresh())
+        # Keep a reference so the task is not garbage collected before it finishes
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def set_current_collection(self, collection_name: str):
+        """Set the current collection for queries"""
+        if collection_name not in self.collections and not self._load_from_catalog(collection_name):
+            if collection_name in await self.db.list_collection_names():
+                await self._analyze_collection(collection_name)
+            else:
+                raise ValueError(f"Collection '{collection_name}' does not exist in the database")
+
+        self.current_collection = collection_name
+        print(f"Current collection set to: {collection_name}")
+        return f"Current collection set to: {collection_name} ({self.collections[collection_name]['total_documents']} documents)"
+
+    async def generate_mongodb_query(self, question: str):
+        """Generate a MongoDB query or aggregation pipeline based on a natural language question"""
+        if not self.current_collection:
+            raise ValueError("No collection selected. Please select a collection first.")
+
+        collection_info = self.collections[self.current_collection]
+
+        # The cache may embed the question over the network, so keep it off the event loop
+        fingerprint = schema_fingerprint(collection_info)
+        cached_query = await asyncio.to_thread(self.query_cache.get, question, self.current_collection, fingerprint)
+        if cached_query is not None:
+            print(f"Query cache hit for: {question}")
+            return cached_query
+
+        # Building the prefix may register provider-side cached content, a blocking call
+        messages, llm_kwargs = await asyncio.to_thread(self._build_query_messages, question, collection_info)
+        async with self.llm_semaphore:
+            try:
+                response_text = await atimed_invoke(self.llm, messages, **llm_kwargs)
+            except Exception as e:
+                if not llm_kwargs:
+                    raise
+                print(f"Cached prompt context failed ({e}), sending the full prompt")
+                self.prompt_prefixes.discard_cached_content(self.current_collection)
+                messages, llm_kwargs = await asyncio.to_thread(self._build_query_messages, question, collection_info)
+                response_text = await atimed_invoke(self.llm, messages, **llm_kwargs)
+        query_data = self._parse_query_response(response_text)
+        await asyncio.to_thread(self.query_cache.put, question, self.current_collection, fingerprint, query_data)
+        return query_data
+
+    async def execute_query(self, query_data: Dict[str, Any]):
+        """Execute a MongoDB query based on the query data"""
+        if not self.current_collection:
+            raise ValueError("No collection selected")
+
+        collection = self.db[self.current_collection]
+        query_type, query, explanation = self._prepare_query(query_data)
+
+        # Rewrite generated pipelines so filters, projections and limits apply as early as possible
+        original_query, rewrites = query, []
+        if query_type == "aggregate":
+            query, rewrites = self.pipeline_optimizer.optimize(query)
+
+        # Identical queries are served from the result cache until the collection changes
+        cache_key = result_key(self.database_name, self.current_collection, query_type, query)
+        await self.result_cache.aensure_invalidation(collection)
+        generation = self.result_cache.generation(collection.full_name)
+        cached_result = self.result_cache.get(cache_key)
+        if cached_result is not None:
+            print("Result cache hit")
+            cached_result["explanation"] = explanation
+            return cached_result
+
+        # Explain first: expensive queries are routed to the analytics node or refused
+        if self.query_guard.enabled:
+            async with self.db_semaphore:
+                document_count = await self.count_provider.acount(collection)
+                estimate = await self.query_guard.acheck(collection, query_type, query, document_count)
+            if estimate.route == "analytics":
+                collection = self.analytics_db[self.current_collection]
+        max_time_ms = self.query_guard.max_time_ms
+
+        # Log how the rewrites changed the query plan
+        if rewrites:
+            async with self.db_semaphore:
+                await self.pipeline_optimizer.alog_comparison(collection, original_query, query, rewrites)
+
+        try:
+            async with self.db_semaphore:
+                if query_type == "find":
+                    results = await collection.find(query, max_time_ms=max_time_ms).limit(50).to_list(length=50)  # Limit to first 50 results for safety
+                    result = {
+                        "count": len(results),
+                        "results": to_jsonable(results),
+                        "explanation": explanation
+                    }
+
+                elif query_type == "aggregate":
+                    results = await collection.aggregate(query, maxTimeMS=max_time_ms, **self.pipeline_optimizer.options(query)).to_list(length=None)
+                    result = {
+                        "count": len(results),
+                        "results": to_jsonable(results),
+                        "explanation": explanation
+                    }
+
+                elif query_type == "count":
+                    count = await collection.count_documents(query, maxTimeMS=max_time_ms)
+                    result = {
+                        "count": count,
+                        "explanation": explanation
+                    }
+
+                elif query_type == "distinct":
+                    field = query.get("field")
+                    filter_query = query.get("filter", {})
+                    if not field:
+                        raise ValueError("'field' is required for distinct queries")
+
+                    values = await collection.distinct(field, filter_query, maxTimeMS=max_time_ms)
+                    result = {
+                        "count": len(values),
+                        "values": values,
+                        "explanation": explanation
+                    }
+
+                else:
+                    raise ValueError(f"Unsupported query type: {query_type}")
+
+        except ExecutionTimeout:
+            raise RuntimeError(f"Query exceeded the {max_time_ms} ms time limit. Please ask a narrower question.")
+        except Exception as e:
+            raise RuntimeError(f"Error executing query: {str(e)}")
+
+        self.result_cache.put(cache_key, collection.full_name, result, generation)
+        return result
+
+    async def get_collection_stats(self, collection_name: Optional[str] = None, exact: bool = False):
+        """Get detailed statistics about a collection"""
+        col_name = collection_name or self.current_collection
+
+        if not col_name:
+            raise ValueError("No collection specified and no current collection set")
+
+        collection = self.analytics_db[col_name]
+
+        async with self.db_semaphore:
+            stats = {
+                "name": col_name,
+                "document_count": await self.count_provider.acount(collection, exact=exact),
+                "count_estimated": not exact,
+                "field_stats": {}
+            }
+
+            if col_name not in self.collections:
+                return stats
+
+        metadata = self.collections[col_name]
+        builder = CollectionStatsBuilder(
+            metadata["fields"],
+            date_field=(metadata.get("date_fields") or [None])[0],
+            document_count=stats["document_count"],
+            cardinalities=await self._field_cardinalities(collection, col_name, stats["document_count"]),
+            lower_bounds=self.sketch_store.lower_bounds(col_name)
+        )
+
+        async def run(pipeline):
+            async with self.db_semaphore:
+                result = await collection.aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+            return result[0] if result else {}
+
+        # The facet passes are independent, so run them concurrently
+        stats.update(builder.merge(await asyncio.gather(*(run(pipeline) for pipeline in builder.pipelines()))))
+
+        return stats
+
+    async def _field_cardinalities(self, collection, collection_name: str, document_count: int) -> Dict[str, int]:
+        """Approximate distinct values per field from persisted sketches, rebuilt when stale"""
+        field_names = [field for field in self.collections[collection_name]["fields"] if field != "_id"]
+        if self.sketch_store.is_stale(collection_name, field_names):
+            print(f"Building cardinality sketches for {collection_name}")
+            sketches = FieldSketches(field_names, document_count=document_count)
+            pipeline = sketches.pipeline()
+
+            def add_batch(docs):
+                for doc in docs:
+                    sketches.add(doc)
+
+            if pipeline is not None:
+                async with self.db_semaphore:
+                    cursor = collection.aggregate(pipeline, allowDiskUse=True)
+                    while batch := await cursor.to_list(length=1000):
+                        # Hashing is CPU-bound, so keep it off the event loop
+                        await asyncio.to_thread(add_batch, batch)
+            self.sketch_store.save(collection_name, sketches)
+        return self.sketch_store.cardinalities(collection_name)
+
+    async def process_analytical_question(self, question: str):
+        """Process analytical questions that require specialized handling"""
+        if not self.current_collection:
+            return "No collection selected. Please select a collection first."
+
+        trend_request = self._parse_trend_question(question)
+        if trend_request:
+            return await self._generate_trend_analysis(*trend_request)
+
+        return None
+
+    async def _generate_trend_analysis(self, date_field: str, time_periods: List[str], group_by: str = "month"):
+        """Generate a trend analysis for specified time periods and grouping"""
+        collection = self.analytics_db[self.current_collection]
+        pipelines = self._trend_pipelines(date_field, time_periods, group_by)
+
+        async def run(pipeline):
+            async with self.db_semaphore:
+                return await collection.aggregate(pipeline).to_list(length=None)
+
+        # Periods are independent, so run their aggregations concurrently
+        outcomes = await asyncio.gather(*(run(pipeline) for pipeline in pipelines.values()), return_exceptions=True)
+        results = {
+            period: f"Error: {str(outcome)}" if isinstance(outcome, Exception) else outcome
+            for period, outcome in zip(pipelines, outcomes)
+        }
+        return self._format_trend_analysis(results, group_by)
+
+    async def ask(self, question: str):
+        """Process a natural language question about the data"""
+        if question.lower().startswith("use collection "):
+            collection_name = question[len("use collection "):].strip()
+            return await self.set_current_collection(collection_name)
+
+        elif question.lower() == "list collections":
+            collections = self.list_collections()
+            return "Available collections:\n" + "\n".join(collections)
+
+        elif question.lower() == "show schema" or question.lower() == "describe collection":
+            if not self.current_collection:
+                return "No collection selected. Use 'use collection [name]' first."
+            schema = self.get_collection_schema()
+            return f"Schema for {self.current_collection}:\n" + "\n".join(schema)
+
+        elif question.lower() == "pool stats":
+            return self._format_pool_stats(await async_health_check(), pool_metrics())
+
+        elif question.lower() in ("collection stats", "stats", "stats exact"):
+            if not self.current_collection:
+                return "No collection selected. Use 'use collection [name]' first."
+            stats = await self.get_collection_stats(exact=question.lower() == "stats exact")
+            return self._format_stats(stats)
+
+        if not self.current_collection:
+            return "Please select a collection first using 'use collection [name]'"
+
+        try:
+            analytical_result = await self.process_analytical_question(question)
+            if analytical_result:
+                return analytical_result
+
+            query_data = await self.generate_mongodb_query(question)
+            result = await self.execute_query(query_data)
+            return self._format_result(result, question)
+
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+
+async def main():
+    mongodb_uri = os.getenv("MONGO_URL")
+    database_name = os.getenv("MONGO_DB")
+    google_api_key = os.getenv("GOOGLE_API_KEY")
+
+    engine = await AsyncMongoDBQueryEngine.create(mongodb_uri, database_name, google_api_key)
+    print("\nAsync MongoDB Query Engine initialized successfully!")
+
+    while True:
+        question = await asyncio.to_thread(input, "\nEnter a command or question: ")
+        if question.lower() == 'exit':
+            break
+        print(f"\n{await engine.ask(question)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
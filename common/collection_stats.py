@@ -0,0 +1,173 @@
+import os
+import datetime
+from typing import List, Dict, Any, Optional, Set
+
+from dateutil.relativedelta import relativedelta
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Fields computed per $facet pipeline; keeps each facet's memory and the 16MB result document bounded
+STATS_FIELDS_PER_FACET = int(os.getenv("STATS_FIELDS_PER_FACET", "20"))
+# Collections above this many documents get their field stats from a $sample instead of a full pass
+STATS_SAMPLE_THRESHOLD = int(os.getenv("STATS_SAMPLE_THRESHOLD", "1000000"))
+STATS_SAMPLE_SIZE = int(os.getenv("STATS_SAMPLE_SIZE", "100000"))
+LOW_CARDINALITY_LIMIT = 15  # Only report a value distribution for fields with this many distinct values or fewer
+TOP_K = 10
+MONTHLY_HISTORY_MONTHS = 6
+
+
+def field_path(field_name: str) -> List[str]:
+    """Split a schema field name like 'items[].name' into its array prefixes and value path"""
+    parts = field_name.split("[].")
+    unwinds = []
+    prefix = ""
+    for part in parts[:-1]:
+        prefix = f"{prefix}.{part}" if prefix else part
+        unwinds.append(prefix)
+    value_path = ".".join(parts)
+    return unwinds + [value_path]
+
+
+class CollectionStatsBuilder:
+    """Builds the few $facet pipelines that compute all field and time stats for a collection"""
+
+    def __init__(
+        self,
+        fields: Dict[str, Any],
+        date_field: Optional[str] = None,
+        document_count: int = 0,
+        fields_per_facet: int = STATS_FIELDS_PER_FACET,
+        sample_threshold: int = STATS_SAMPLE_THRESHOLD,
+        sample_size: int = STATS_SAMPLE_SIZE,
+        top_k: int = TOP_K,
+        cardinalities: Optional[Dict[str, int]] = None,
+        lower_bounds: Optional[Set[str]] = None
+    ):
+        # Whole subdocuments have no useful cardinality, so only leaf-valued fields are counted
+        self.fields = [
+            name for name, info in fields.items()
+            if name != "_id" and set(info.get("types", [])) - {"dict"}
+        ]
+        # Like distinct(), count the elements of array fields rather than whole arrays
+        self.array_fields = {name for name in self.fields if "list" in fields[name].get("types", [])}
+        self.date_field = date_field
+        self.fields_per_facet = max(1, fields_per_facet)
+        self.sample_size = sample_size if document_count > sample_threshold else None
+        self.top_k = top_k
+        # Approximate distinct counts (HyperLogLog); when given, no facet materializes a value set
+        # and only low-cardinality fields get a top-k distribution
+        self.cardinalities = cardinalities
+        # Fields whose cardinality comes from a sample too small to exhaust their values
+        self.lower_bounds = lower_bounds or set()
+
+    def _field_facets(self, index: int, field_name: str) -> Dict[str, List[Dict[str, Any]]]:
+        *unwinds, value_path = field_path(field_name)
+        if field_name in self.array_fields:
+            unwinds.append(value_path)
+        stages = [{"$unwind": f"${path}"} for path in unwinds]
+        stages.append({"$match": {value_path: {"$exists": True}}})
+        group = {"$group": {"_id": f"${value_path}", "count": {"$sum": 1}}}
+        top = stages + [group, {"$sort": {"count": -1}}, {"$limit": self.top_k}]
+        if self.cardinalities is not None:
+            if self.cardinalities.get(field_name, 0) > LOW_CARDINALITY_LIMIT:
+                return {}
+            return {f"f{index}_top": top}
+        return {f"f{index}_top": top, f"f{index}_distinct": stages + [group, {"$count": "n"}]}
+
+    def _history_match(self) -> Dict[str, Any]:
+        since = datetime.datetime.now() - relativedelta(months=MONTHLY_HISTORY_MONTHS)
+        return {"$match": {self.date_field: {"$gte": since}}}
+
+    def _monthly_stages(self) -> List[Dict[str, Any]]:
+        field = self.date_field
+        return [
+            {"$group": {
+                "_id": {"year": {"$year": f"${field}"}, "month": {"$month": f"${field}"}},
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id.year": 1, "_id.month": 1}}
+        ]
+
+    def _time_facets(self) -> Dict[str, List[Dict[str, Any]]]:
+        field = self.date_field
+        return {
+            "date_range": [
+                {"$group": {"_id": None, "min_date": {"$min": f"${field}"}, "max_date": {"$max": f"${field}"}}}
+            ],
+            "monthly_counts": [self._history_match()] + self._monthly_stages()
+        }
+
+    def _time_pipelines(self) -> List[List[Dict[str, Any]]]:
+        """Time stats as passes whose leading $match/$sort can use an index on the date field"""
+        field = self.date_field
+        present = {"$match": {field: {"$ne": None}}}
+        return [
+            [self._history_match(), {"$facet": {"monthly_counts": self._monthly_stages()}}],
+            [present, {"$sort": {field: 1}}, {"$limit": 1}, {"$project": {"_id": 0, "min_date": f"${field}"}}],
+            [present, {"$sort": {field: -1}}, {"$limit": 1}, {"$project": {"_id": 0, "max_date": f"${field}"}}]
+        ]
+
+    def pipelines(self) -> List[List[Dict[str, Any]]]:
+        """Return the aggregation pipelines to run; each yields a single facet document"""
+        prefix = [{"$sample": {"size": self.sample_size}}] if self.sample_size else []
+        field_facets = [self._field_facets(index, field) for index, field in enumerate(self.fields)]
+        field_facets = [facets for facets in field_facets if facets]
+        pipelines = []
+        for start in range(0, len(field_facets), self.fields_per_facet):
+            facets = {}
+            for batch in field_facets[start:start + self.fields_per_facet]:
+                facets.update(batch)
+            pipelines.append(prefix + [{"$facet": facets}])
+
+        if self.date_field:
+            if pipelines and not self.sample_size:
+                # Time stats ride along with the first field pass
+                pipelines[0][-1]["$facet"].update(self._time_facets())
+            else:
+                # Date range and history must cover every document, so they never use the sample
+                pipelines.extend(self._time_pipelines())
+        return pipelines
+
+    def merge(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Combine the facet documents returned by pipelines() into field_stats and time_stats"""
+        facets = {}
+        for result in results:
+            facets.update(result or {})
+
+        stats = {"field_stats": {}}
+        if self.sample_size:
+            stats["sampled_documents"] = self.sample_size
+
+        for index, field_name in enumerate(self.fields):
+            if self.cardinalities is not None:
+                field_stats = {"distinct_values": self.cardinalities.get(field_name, 0), "approximate": True}
+                if field_name in self.lower_bounds:
+                    field_stats["lower_bound"] = True
+            else:
+                distinct = facets.get(f"f{index}_distinct") or [{"n": 0}]
+                field_stats = {"distinct_values": distinct[0]["n"]}
+            if field_stats["distinct_values"] <= LOW_CARDINALITY_LIMIT:
+                field_stats["distribution"] = [
+                    {"value": item["_id"], "count": item["count"]}
+                    for item in facets.get(f"f{index}_top", [])
+                ]
+            stats["field_stats"][field_name] = field_stats
+
+        if self.date_field:
+            time_stats = {}
+            if facets.get("date_range"):
+                time_stats["date_range"] = {
+                    "min": facets["date_range"][0]["min_date"],
+                    "max": facets["date_range"][0]["max_date"]
+                }
+            elif "min_date" in facets:
+                time_stats["date_range"] = {"min": facets["min_date"], "max": facets.get("max_date")}
+            if facets.get("monthly_counts"):
+                time_stats["monthly_counts"] = [
+                    {"year": item["_id"]["year"], "month": item["_id"]["month"], "count": item["count"]}
+                    for item in facets["monthly_counts"]
+                ]
+            stats["time_stats"] = time_stats
+        return stats
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+from collections import deque
+from typing import List, Dict, Any, Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Recent turns passed to the LLM in full; older turns are folded into a bounded summary
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "5"))
+CONVERSATION_SUMMARY_CHARS = int(os.getenv("CONVERSATION_SUMMARY_CHARS", "1500"))
+
+CODE_BLOCK_PATTERN = re.compile(r'```(?:javascript|json)?\s*([\s\S]*?)\s*```')
+
+
+def _brief(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length] + "..."
+
+
+def extract_turn(question: str, response: str) -> Dict[str, str]:
+    """Pull the question and the generated query (or a short answer) out of one exchange"""
+    extract = {"question": _brief(question, 300)}
+    match = CODE_BLOCK_PATTERN.search(response)
+    if not match:
+        extract["response"] = response.split("\n\n")[0] if "\n\n" in response else response[:100]
+        return extract
+
+    try:
+        query_data = json.loads(match.group(1))
+    except ValueError:
+        extract["code"] = _brief(match.group(1), 150)
+        return extract
+
+    if isinstance(query_data, dict) and "query" in query_data:
+        extract["query"] = json.dumps(query_data["query"], default=str)
+        if "explanation" in query_data:
+            extract["explanation"] = query_data["explanation"]
+    elif isinstance(query_data, (list, dict)):
+        # A bare pipeline or filter, as appended to responses by ask()
+        extract["query"] = json.dumps(query_data, default=str)
+    return extract
+
+
+class ConversationMemory:
+    """Chat history kept as a fixed window of recent turns plus a rolling summary of older ones"""
+
+    def __init__(self, history: Optional[List[Dict[str, Any]]] = None, window: int = CONVERSATION_WINDOW,
+                 summary_chars: int = CONVERSATION_SUMMARY_CHARS):
+        self.window = window
+        self.summary_chars = summary_chars
+        self.turns = deque()  # (turn number, user message, model message, extract)
+        self.summary_lines = deque()
+        self.turn_count = 0
+        self._context: Optional[str] = None
+
+        # Seed from chat history in the [{"role": ..., "parts": [...]}, ...] format
+        history = history or []
+        for user_message, model_message in zip(history[0::2], history[1::2]):
+            self.add_turn(user_message["parts"][0], model_message["parts"][0])
+
+    def add_turn(self, question: str, response: str):
+        """Record one question/response exchange"""
+        self.turn_count += 1
+        # Parse each response once, when it is added, instead of on every prompt
+        extract = extract_turn(question, response)
+        self.turns.append((
+            self.turn_count,
+            {"role": "user", "parts": [question]},
+            {"role": "model", "parts": [response]},
+            extract
+        ))
+
+        while len(self.turns) > self.window:
+            number, _, _, old_extract = self.turns.popleft()
+            line = f"Q{number}: {_brief(old_extract['question'], 100)}"
+            if "query" in old_extract:
+                line += f" -> {_brief(old_extract['query'], 200)}"
+            self.summary_lines.append(line)
+            while sum(len(line) + 1 for line in self.summary_lines) > self.summary_chars:
+                self.summary_lines.popleft()
+        self._context = None
+
+    def clear(self):
+        self.turns.clear()
+        self.summary_lines.clear()
+        self._context = None
+
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        """The retained turns in the chat history message format"""
+        return [message for _, user_message, model_message, _ in self.turns for message in (user_message, model_message)]
+
+    def context(self) -> str:
+        """Prompt text for the conversation so far; bounded by the window and summary size"""
+        if self._context is not None:
+            return self._context
+
+        context = ""
+        if self.summary_lines:
+            context += "Summary of earlier conversation:\n" + "\n".join(self.summary_lines) + "\n\n"
+        if self.turns:
+            context += "Previous conversation context:\n"
+            for number, _, _, extract in self.turns:
+                context += f"Question {number}: {extract['question']}\n"
+                if "query" in extract:
+                    context += f"Query {number}: {extract['query']}\n"
+                    if "explanation" in extract:
+                        context += f"Explanation {number}: {extract['explanation']}\n"
+                elif "code" in extract:
+                    context += f"Code {number}: {extract['code']}\n"
+                else:
+                    context += f"Response {number}: {extract['response']}\n"
+            context += "\n"
+        self._context = context
+        return context
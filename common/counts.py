@@ -0,0 +1,68 @@
+import os
+import time
+import threading
+from typing import Dict, Tuple
+
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure
+
+# Load environment variables
+load_dotenv()
+
+COUNT_CACHE_TTL = int(os.getenv("COUNT_CACHE_TTL", "300"))
+
+
+class CountProvider:
+    """Collection document counts from collection metadata by default, exact counts on demand, cached"""
+
+    def __init__(self, ttl_seconds: int = COUNT_CACHE_TTL):
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[Tuple[str, str, bool], Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and time.time() - entry[1] <= self.ttl_seconds:
+            return entry[0]
+        return None
+
+    def _store(self, key, count: int) -> int:
+        with self._lock:
+            self._cache[key] = (count, time.time())
+        return count
+
+    def count(self, collection, exact: bool = False) -> int:
+        """Return the document count of a collection, estimated from metadata unless exact is requested"""
+        key = (collection.database.name, collection.name, exact)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        if exact:
+            return self._store(key, collection.count_documents({}))
+        try:
+            return self._store(key, collection.estimated_document_count())
+        except OperationFailure:
+            # Views have no count metadata, so fall back to counting
+            return self._store(key, collection.count_documents({}))
+
+    async def acount(self, collection, exact: bool = False) -> int:
+        """Async (Motor) variant of count()"""
+        key = (collection.database.name, collection.name, exact)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        if exact:
+            return self._store(key, await collection.count_documents({}))
+        try:
+            return self._store(key, await collection.estimated_document_count())
+        except OperationFailure:
+            return self._store(key, await collection.count_documents({}))
+
+    def invalidate(self, database_name: str, collection_name: str):
+        """Forget cached counts for a collection"""
+        with self._lock:
+            for exact in (False, True):
+                self._cache.pop((database_name, collection_name, exact), None)
@@ -1,22 +1,222 @@
 
 import os
 import sys
-from pymongo import MongoClient
+import time
+import atexit
+import threading
+from typing import Dict, Any, Optional
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import ReadPreference
 from dotenv import load_dotenv
 # from common.logs import log
 # Load environment variables from .env file
 load_dotenv()
 
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+# Read preference used for heavy analytics reads (stats, trends)
+MONGO_ANALYTICS_READ_PREFERENCE = os.getenv("MONGO_ANALYTICS_READ_PREFERENCE", "secondaryPreferred")
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool listener counting open/checked-out connections and checkout wait time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open_connections = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.pool_clears = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+                "pool_clears": self.pool_clears
+            }
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_checked_out(self, event):
+        wait_ms = getattr(event, "duration", 0.0) * 1000
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+class ClientRegistry:
+    """Process-wide registry handing out one pooled MongoClient per URI and option set"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._metrics = {}
+
+    def get_client(self, mongo_uri: Optional[str] = None, client_class=MongoClient, **options):
+        mongo_uri = mongo_uri or os.getenv("MONGO_URL")
+        key = (client_class.__name__, mongo_uri, tuple(sorted(options.items())))
+
+        with self._lock:
+            if key not in self._clients:
+                metrics = PoolMetrics()
+                settings = {
+                    "maxPoolSize": MONGO_MAX_POOL_SIZE,
+                    "minPoolSize": MONGO_MIN_POOL_SIZE,
+                    "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+                    "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                }
+                settings.update(options)
+                self._clients[key] = client_class(mongo_uri, event_listeners=[metrics], **settings)
+                self._metrics[key] = metrics
+            return self._clients[key]
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {f"pool-{i}": metrics.snapshot() for i, metrics in enumerate(self._metrics.values())}
+
+    def health_check(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            clients = list(self._clients.values())
+
+        results = {}
+        for i, client in enumerate(clients):
+            if not isinstance(client, MongoClient):
+                continue  # Motor clients are checked by async_health_check()
+            start = time.time()
+            try:
+                client.admin.command("ping")
+                results[f"pool-{i}"] = {"ok": True, "latency_ms": round((time.time() - start) * 1000, 2)}
+            except Exception as e:
+                results[f"pool-{i}"] = {"ok": False, "error": str(e)}
+        return results
+
+    async def async_health_check(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            clients = list(self._clients.values())
+
+        results = {}
+        for i, client in enumerate(clients):
+            start = time.time()
+            try:
+                if isinstance(client, MongoClient):
+                    client.admin.command("ping")
+                else:
+                    await client.admin.command("ping")
+                results[f"pool-{i}"] = {"ok": True, "latency_ms": round((time.time() - start) * 1000, 2)}
+            except Exception as e:
+                results[f"pool-{i}"] = {"ok": False, "error": str(e)}
+        return results
+
+    def close_all(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+            self._metrics.clear()
+
+
+registry = ClientRegistry()
+atexit.register(registry.close_all)
+
+
+def get_client(mongo_uri: Optional[str] = None, **options) -> MongoClient:
+    """Return the shared pooled client for a URI and option set"""
+    return registry.get_client(mongo_uri, **options)
+
+
+def get_async_client(mongo_uri: Optional[str] = None, **options):
+    """Return the shared pooled Motor client for a URI and option set"""
+    from motor.motor_asyncio import AsyncIOMotorClient
+    return registry.get_client(mongo_uri, client_class=AsyncIOMotorClient, **options)
+
+
+def get_database(client, database_name: str, analytics: bool = False):
+    """Return a database handle, routed to secondaries for analytics reads"""
+    if analytics:
+        read_preference = READ_PREFERENCES.get(MONGO_ANALYTICS_READ_PREFERENCE, ReadPreference.SECONDARY_PREFERRED)
+        return client.get_database(database_name, read_preference=read_preference)
+    return client[database_name]
+
+
+def pool_metrics() -> Dict[str, Dict[str, Any]]:
+    """Return checked-out/wait-time metrics for every shared pool"""
+    return registry.metrics()
+
+
+def health_check() -> Dict[str, Dict[str, Any]]:
+    """Ping every shared pool and report latency"""
+    return registry.health_check()
+
+
+async def async_health_check() -> Dict[str, Dict[str, Any]]:
+    """Ping every shared pool, including Motor pools, and report latency"""
+    return await registry.async_health_check()
+
+
 class Database:
     __client = None
     __db = None
 
     def __init__(self):
         try:
-           
+
             mongo_db = os.getenv("MONGO_DB")
             mongo_uri = os.getenv("MONGO_URL")
-            Database.__client = MongoClient(mongo_uri)
+            # The registry returns the same pooled client for every instance
+            Database.__client = get_client(mongo_uri)
             Database.__db = Database.__client[mongo_db]
             print("MongoDB connection established.")
         except Exception as e:
@@ -53,4 +253,6 @@ class Database:
 if __name__ == '__main__':
     db=Database()
     data=db.find_one("portcalls")
-    print(data)
\ No newline at end of file
+    print(data)
+    print(health_check())
+    print(pool_metrics())
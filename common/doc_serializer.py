@@ -0,0 +1,97 @@
+import re
+import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from bson import ObjectId, Decimal128
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """Approximate the model token count of a text (words and punctuation marks)"""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class DocumentSerializer:
+    """Turn Mongo documents into compact 'field: value' text for embedding"""
+
+    def __init__(
+        self,
+        fields: Optional[List[str]] = None,
+        templates: Optional[Dict[str, str]] = None,
+        exclude: Tuple[str, ...] = ("_id", "__v"),
+        max_list_items: int = 10,
+        max_value_length: int = 300
+    ):
+        self.fields = fields
+        self.templates = templates or {}
+        self.exclude = exclude
+        self.max_list_items = max_list_items
+        self.max_value_length = max_value_length
+
+    def signature(self) -> Dict[str, Any]:
+        """Settings that change the produced text, used to key persisted indexes"""
+        return {
+            "fields": self.fields,
+            "templates": self.templates,
+            "exclude": list(self.exclude),
+            "max_list_items": self.max_list_items,
+            "max_value_length": self.max_value_length
+        }
+
+    def _selected(self, path: str) -> bool:
+        root = path.split("[", 1)[0]
+        if root in self.exclude or path in self.exclude:
+            return False
+        if not self.fields:
+            return True
+        return any(root == field or root.startswith(f"{field}.") or field.startswith(f"{root}.") for field in self.fields)
+
+    def format_value(self, value: Any) -> str:
+        """Render a scalar value without BSON/Python repr noise"""
+        if isinstance(value, datetime.datetime):
+            if value.hour == value.minute == value.second == 0:
+                return value.strftime("%Y-%m-%d")
+            return value.strftime("%Y-%m-%d %H:%M")
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, Decimal128):
+            return str(value.to_decimal())
+        if isinstance(value, bool):
+            return "yes" if value else "no"
+        if isinstance(value, float):
+            return f"{value:g}"
+
+        text = re.sub(r"\s+", " ", str(value)).strip()
+        if len(text) > self.max_value_length:
+            text = text[:self.max_value_length] + "..."
+        return text
+
+    def flatten(self, doc: Dict[str, Any], prefix: str = "") -> List[Tuple[str, str]]:
+        """Flatten nested documents into (dotted path, formatted value) pairs, skipping empty values"""
+        items = []
+        for key, value in doc.items():
+            path = f"{prefix}{key}"
+            if not self._selected(path):
+                continue
+
+            if isinstance(value, dict):
+                items.extend(self.flatten(value, f"{path}."))
+            elif isinstance(value, list):
+                elements = [element for element in value[:self.max_list_items] if element not in (None, "", [], {})]
+                if elements and all(isinstance(element, dict) for element in elements):
+                    for i, element in enumerate(elements):
+                        items.extend(self.flatten(element, f"{path}[{i}]."))
+                elif elements:
+                    items.append((path, ", ".join(self.format_value(element) for element in elements)))
+            elif value not in (None, ""):
+                items.append((path, self.format_value(value)))
+        return items
+
+    def serialize(self, doc: Dict[str, Any]) -> str:
+        """Serialize a document into one 'field: value' line per populated field"""
+        lines = []
+        for path, value in self.flatten(doc):
+            template = self.templates.get(re.sub(r"\[\d+\]", "[]", path))
+            lines.append(template.format(value=value) if template else f"{path}: {value}")
+        return "\n".join(lines)
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+# Load environment variables
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("cache", "embeddings.sqlite"))
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_CHUNK = 500
+
+
+def text_hash(text: str) -> str:
+    """Return the content hash used to key cached vectors"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that never embeds the same text twice for a model, backed by SQLite"""
+
+    def __init__(self, embeddings, model_id: Optional[str] = None, path: str = EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_id = model_id or getattr(embeddings, "model_id", None) or getattr(embeddings, "model_name")
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets several processes read and write the shared cache concurrently
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self._conn.commit()
+
+    def _lookup(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), LOOKUP_CHUNK):
+                chunk = hashes[i:i + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model] + chunk
+                )
+                for digest, blob in rows:
+                    found[digest] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _store(self, model: str, vectors: Dict[str, List[float]]):
+        rows = [(model, digest, np.asarray(vector, dtype=np.float32).tobytes()) for digest, vector in vectors.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, reusing cached vectors and embedding each distinct new text once"""
+        hashes = [text_hash(text) for text in texts]
+        found = self._lookup(self.model_id, list(set(hashes)))
+
+        missing = {}
+        for digest, text in zip(hashes, texts):
+            if digest not in found and digest not in missing:
+                missing[digest] = text
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), vectors))
+            self._store(self.model_id, new_vectors)
+            found.update(new_vectors)
+
+        return [found[digest] for digest in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, cached separately since some models embed queries differently"""
+        model = f"{self.model_id}#query"
+        digest = text_hash(text)
+        found = self._lookup(model, [digest])
+        if digest in found:
+            self.hits += 1
+            return found[digest]
+
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self._store(model, {digest: vector})
+        return vector
+
+    def close(self):
+        """Close the cache and the wrapped embeddings"""
+        if hasattr(self.embeddings, "close"):
+            self.embeddings.close()
+        with self._lock:
+            self._conn.close()
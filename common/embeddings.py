@@ -0,0 +1,128 @@
+import os
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+# Load environment variables
+load_dotenv()
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_PROCESSES = int(os.getenv("EMBEDDING_PROCESSES", str(os.cpu_count() or 1)))
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # "torch" or "onnx"
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE")  # e.g. "onnx/model_qint8_avx512_vnni.onnx"
+
+
+class BatchEmbeddings(Embeddings):
+    """CPU sentence-transformers embeddings with batching, multi-process encoding and an optional ONNX runtime"""
+
+    def __init__(
+        self,
+        model_name: str,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        processes: int = EMBEDDING_PROCESSES,
+        backend: str = EMBEDDING_BACKEND,
+        onnx_file: Optional[str] = EMBEDDING_ONNX_FILE
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.processes = max(1, processes)
+        self.backend = backend
+        self.onnx_file = onnx_file
+
+        self._pool = None
+        self.model = self._load_model()
+
+    @property
+    def model_id(self) -> str:
+        """Identifier of the model and runtime, used to key persisted vectors"""
+        if self.backend == "onnx":
+            return f"{self.model_name}#onnx:{self.onnx_file or 'model.onnx'}"
+        return self.model_name
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        if self.backend == "onnx":
+            try:
+                model_kwargs = {"file_name": self.onnx_file} if self.onnx_file else None
+                model = SentenceTransformer(self.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+                print(f"Loaded ONNX embedding model {self.model_id}")
+                return model
+            except Exception as e:
+                print(f"ONNX backend unavailable, falling back to torch: {e}")
+                self.backend = "torch"
+
+        return SentenceTransformer(self.model_name, device="cpu")
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Split the cores between workers instead of letting every worker grab all of them
+            threads = str(max(1, (os.cpu_count() or 1) // self.processes))
+            previous = os.environ.get("OMP_NUM_THREADS")
+            os.environ["OMP_NUM_THREADS"] = threads
+            try:
+                self._pool = self.model.start_multi_process_pool(["cpu"] * self.processes)
+            finally:
+                if previous is None:
+                    os.environ.pop("OMP_NUM_THREADS", None)
+                else:
+                    os.environ["OMP_NUM_THREADS"] = previous
+            print(f"Started {self.processes} embedding worker processes ({threads} threads each)")
+        return self._pool
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of texts, spreading large batches over worker processes"""
+        if not texts:
+            return []
+
+        texts = [text.replace("\n", " ") for text in texts]
+        if self.processes > 1 and len(texts) >= self.batch_size * 2:
+            vectors = self.model.encode_multi_process(
+                texts,
+                self._get_pool(),
+                batch_size=self.batch_size,
+                chunk_size=max(self.batch_size, len(texts) // self.processes)
+            )
+        else:
+            vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query text in-process"""
+        return self.model.encode(text.replace("\n", " "), convert_to_numpy=True).tolist()
+
+    def close(self):
+        """Stop the worker processes, if any were started"""
+        if self._pool is not None:
+            self.model.stop_multi_process_pool(self._pool)
+            self._pool = None
+
+
+def benchmark(model_name: str, texts: List[str], configs: List[dict]):
+    """Print embedding throughput for a set of engine configurations"""
+    for config in configs:
+        engine = BatchEmbeddings(model_name, **config)
+        try:
+            engine.embed_documents(texts[:engine.batch_size])  # warm up
+            start = time.time()
+            engine.embed_documents(texts)
+            elapsed = time.time() - start
+            print(f"{engine.model_id} {config}: {len(texts) / elapsed:.1f} texts/s ({elapsed:.2f}s for {len(texts)})")
+        finally:
+            engine.close()
+
+
+if __name__ == '__main__':
+    sample_text = ("Portcall for vessel MV Example at port Singapore, agent Example Shipping, "
+                   "status completed, created 2025-04-12, cargo 12000 MT steel coils. ")
+    texts = [f"{i} {sample_text * 4}" for i in range(2000)]
+    cores = os.cpu_count() or 1
+    benchmark("sentence-transformers/all-mpnet-base-v2", texts, [
+        {"processes": 1, "batch_size": 32, "backend": "torch"},
+        {"processes": 1, "batch_size": 128, "backend": "torch"},
+        {"processes": cores, "batch_size": 64, "backend": "torch"},
+        {"processes": 1, "batch_size": 64, "backend": "onnx", "onnx_file": "onnx/model_qint8_avx512_vnni.onnx"},
+        {"processes": cores, "batch_size": 64, "backend": "onnx", "onnx_file": "onnx/model_qint8_avx512_vnni.onnx"},
+    ])
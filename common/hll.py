@@ -0,0 +1,226 @@
+import os
+import math
+import json
+import time
+import base64
+import threading
+from typing import List, Dict, Any, Optional, Iterable, Set
+
+import mmh3
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# 2**precision registers per sketch; standard error is about 1.04 / sqrt(2**precision) (1.6% at 12)
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+HLL_DIR = os.getenv("HLL_DIR", os.path.join("cache", "hll"))
+HLL_MAX_AGE = int(os.getenv("HLL_MAX_AGE", "86400"))
+# Collections larger than this are sketched from a $sample rather than a full cursor
+HLL_SCAN_LIMIT = int(os.getenv("HLL_SCAN_LIMIT", "1000000"))
+HLL_SAMPLE_SIZE = int(os.getenv("HLL_SAMPLE_SIZE", "200000"))
+# A sampled field with at least this many distinct values per sampled document is far from exhausted by the
+# sample, so its estimate only bounds the collection's distinct count from below
+HLL_SAMPLE_SATURATION = float(os.getenv("HLL_SAMPLE_SATURATION", "0.5"))
+
+
+class HyperLogLog:
+    """HyperLogLog distinct-count sketch over 64-bit murmur3 hashes"""
+
+    def __init__(self, precision: int = HLL_PRECISION, registers: Optional[bytearray] = None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 18, got {precision}")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.m)
+
+    def add(self, value: Any):
+        """Add a value; values are hashed by type and string form"""
+        key = f"{type(value).__name__}:{value}"
+        hashed = mmh3.hash64(key, signed=False)[0]
+        index = hashed >> (64 - self.precision)
+        remainder = (hashed << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - remainder.bit_length(), 64 - self.precision) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        """Estimated number of distinct values added"""
+        m = self.m
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is far more accurate while many registers are still empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def merge(self, other: "HyperLogLog"):
+        """Fold another sketch of the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "HyperLogLog":
+        return cls(data["precision"], bytearray(base64.b64decode(data["registers"])))
+
+
+def field_values(doc: Dict[str, Any], field_name: str) -> Iterable[Any]:
+    """Yield the leaf values at a schema field name, descending into arrays ('items[].name')"""
+    values = [doc]
+    for part in field_name.replace("[]", "").split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item for item in value if isinstance(item, dict)]
+                next_values.extend(item[part] for item in value if part in item)
+            elif isinstance(value, dict) and part in value:
+                next_values.append(value[part])
+        values = next_values
+
+    for value in values:
+        if isinstance(value, list):
+            # Like distinct(), count array elements rather than whole arrays
+            yield from (str(item) if isinstance(item, dict) else item for item in value)
+        elif isinstance(value, dict):
+            yield str(value)
+        else:
+            yield value
+
+
+class FieldSketches:
+    """One HyperLogLog per field of a collection, fed document by document"""
+
+    def __init__(self, fields: List[str], precision: int = HLL_PRECISION, document_count: int = 0,
+                 scan_limit: int = HLL_SCAN_LIMIT):
+        self.fields = list(fields)
+        self.precision = precision
+        self.sketches = {field: HyperLogLog(precision) for field in self.fields}
+        self.documents = 0
+        # Collections larger than the scan limit are sketched from a sample
+        self.sampled = document_count > scan_limit
+
+    def pipeline(self, sample_size: int = HLL_SAMPLE_SIZE) -> Optional[List[Dict[str, Any]]]:
+        """Aggregation feeding add(): a projected full cursor, or a $sample on large collections; None if no fields"""
+        if not self.fields:
+            return None  # an empty $project would return whole documents
+        top_level = sorted({field.split(".")[0].replace("[]", "") for field in self.fields})
+        pipeline = []
+        if self.sampled:
+            pipeline.append({"$sample": {"size": sample_size}})
+        pipeline.append({"$project": {"_id": 0, **{field: 1 for field in top_level}}})
+        return pipeline
+
+    def add(self, doc: Dict[str, Any]):
+        self.documents += 1
+        for field, sketch in self.sketches.items():
+            for value in field_values(doc, field):
+                sketch.add(value)
+
+    def cardinalities(self) -> Dict[str, int]:
+        return {field: sketch.count() for field, sketch in self.sketches.items()}
+
+    def lower_bounds(self, cardinalities: Optional[Dict[str, int]] = None,
+                     saturation: float = HLL_SAMPLE_SATURATION) -> Set[str]:
+        """Fields whose estimate is only a lower bound because the sample holds too few of their values"""
+        if not self.sampled:
+            return set()
+        cardinalities = cardinalities if cardinalities is not None else self.cardinalities()
+        return {field for field, count in cardinalities.items() if count >= saturation * self.documents}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "documents": self.documents,
+            "sampled": self.sampled,
+            "sketches": {field: sketch.to_dict() for field, sketch in self.sketches.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "FieldSketches":
+        sketches = {field: HyperLogLog.from_dict(sketch) for field, sketch in data["sketches"].items()}
+        precision = next(iter(sketches.values())).precision if sketches else HLL_PRECISION
+        field_sketches = cls(list(sketches), precision)
+        field_sketches.sketches = sketches
+        field_sketches.documents = data.get("documents", 0)
+        field_sketches.sampled = data.get("sampled", False)
+        return field_sketches
+
+
+class SketchStore:
+    """Persists per-field sketches as one JSON file per collection under HLL_DIR/<database>/"""
+
+    def __init__(self, database_name: str, root: str = HLL_DIR, max_age: int = HLL_MAX_AGE):
+        self.directory = os.path.join(root, database_name)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+
+    def _path(self, collection_name: str) -> str:
+        return os.path.join(self.directory, f"{collection_name}.json")
+
+    def _entry(self, collection_name: str) -> Optional[Dict[str, Any]]:
+        if collection_name not in self._entries:
+            path = self._path(collection_name)
+            if not os.path.exists(path):
+                return None
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                entry = {"built_at": data["built_at"], "sketches": FieldSketches.from_dict(data)}
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable sketch file {path}: {e}")
+                return None
+            with self._lock:
+                self._entries[collection_name] = entry
+        return self._entries[collection_name]
+
+    def load(self, collection_name: str) -> Optional[FieldSketches]:
+        entry = self._entry(collection_name)
+        return entry["sketches"] if entry else None
+
+    def is_stale(self, collection_name: str, fields: Optional[List[str]] = None) -> bool:
+        """True when there are no sketches, they are too old, or they do not cover the given fields"""
+        entry = self._entry(collection_name)
+        if entry is None or time.time() - entry["built_at"] > self.max_age:
+            return True
+        return bool(fields) and not set(fields) <= set(entry["sketches"].fields)
+
+    def cardinalities(self, collection_name: str) -> Dict[str, int]:
+        """Approximate distinct values per field, or {} if the collection has not been sketched"""
+        entry = self._entry(collection_name)
+        if entry is None:
+            return {}
+        # Estimates are read on every prompt, so compute them once per loaded sketch set
+        if "cardinalities" not in entry:
+            entry["cardinalities"] = entry["sketches"].cardinalities()
+        return entry["cardinalities"]
+
+    def lower_bounds(self, collection_name: str) -> Set[str]:
+        """Fields of a sampled collection whose cardinalities() value is only a lower bound"""
+        entry = self._entry(collection_name)
+        if entry is None:
+            return set()
+        return entry["sketches"].lower_bounds(self.cardinalities(collection_name))
+
+    def save(self, collection_name: str, sketches: FieldSketches):
+        built_at = time.time()
+        with self._lock:
+            self._entries[collection_name] = {"built_at": built_at, "sketches": sketches}
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(collection_name)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"built_at": built_at, **sketches.to_dict()}, f)
+            os.replace(tmp_path, path)
@@ -0,0 +1,75 @@
+import os
+import json
+import shutil
+import hashlib
+import datetime
+from typing import List, Dict, Any, Optional
+
+# Root directory for persisted vector indexes
+INDEX_ROOT = os.getenv("INDEX_DIR", "indexes")
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 4  # 2: chunks carry doc_id metadata and sync state, 3: field-aware chunk text, 4: token-sized chunks
+
+
+def index_key(
+    database_name: str,
+    collection_name: str,
+    query_filter: Optional[Dict[str, Any]],
+    field_list: Optional[List[str]],
+    model_name: str,
+    serializer: Optional[Dict[str, Any]] = None,
+    chunking: Optional[Dict[str, Any]] = None
+) -> str:
+    """Build a stable key identifying an index for a collection/filter/fields/model combination"""
+    payload = json.dumps({
+        "database": database_name,
+        "collection": collection_name,
+        "filter": query_filter or {},
+        "fields": sorted(field_list) if field_list else None,
+        "model": model_name,
+        "serializer": serializer,
+        "chunking": chunking,
+        "version": MANIFEST_VERSION
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def index_path(collection_name: str, key: str, root: Optional[str] = None) -> str:
+    """Return the directory holding the index for a key"""
+    return os.path.join(root or INDEX_ROOT, f"{collection_name}-{key}")
+
+
+def load_manifest(path: str) -> Optional[Dict[str, Any]]:
+    """Load the manifest of an index directory, or None if the index is missing or incomplete"""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable index manifest {manifest_path}: {e}")
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(path: str, manifest: Dict[str, Any]):
+    """Atomically write the manifest of an index directory"""
+    os.makedirs(path, exist_ok=True)
+    manifest = dict(manifest, version=MANIFEST_VERSION, updated_at=datetime.datetime.now().isoformat())
+
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, manifest_path)
+
+
+def clear_index(path: str):
+    """Remove an index directory so it can be rebuilt from scratch"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
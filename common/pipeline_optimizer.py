@@ -0,0 +1,380 @@
+import os
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure
+from common.logs import log
+from common.query_guard import plan_summary
+
+# Load environment variables
+load_dotenv()
+
+# Log the query plans of generated pipelines before and after rewriting (two extra planner-only explains)
+PIPELINE_EXPLAIN_LOG = os.getenv("PIPELINE_EXPLAIN_LOG", "true").lower() in ("1", "true", "yes")
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", "1000"))
+
+# Stages that hold all their input before producing output and may need to spill to disk
+BLOCKING_STAGES = {"$group", "$sort", "$bucket", "$bucketAuto", "$sortByCount", "$setWindowFields", "$facet"}
+# Stages that reshape documents without dropping or multiplying them; a $match may move ahead of them when safe
+RESHAPING_STAGES = {"$project", "$addFields", "$set", "$unset", "$unwind", "$sort"}
+# Stages that emit exactly one document per input document, so a $limit after them can run before them
+ONE_TO_ONE_STAGES = {"$project", "$addFields", "$set", "$unset", "$lookup"}
+# Stages after which only the fields they reference matter
+CLOSING_STAGES = {"$group", "$bucket", "$bucketAuto", "$sortByCount", "$count", "$replaceRoot", "$replaceWith"}
+# Operators that name fields in literal strings or sort specs instead of "$field" paths, so their reads are unknown
+FIELD_NAME_OPERATORS = {"$getField", "$setField", "$unsetField", "$top", "$topN", "$bottom", "$bottomN"}
+
+
+def overlaps(path: str, other: str) -> bool:
+    """Whether two dotted field paths refer to the same field or one contains the other"""
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+def expression_fields(expression: Any) -> Optional[Set[str]]:
+    """Field paths referenced by an aggregation expression; None if it uses the whole document"""
+    fields = set()
+    if isinstance(expression, str):
+        if expression.startswith("$$"):
+            if expression.split(".")[0] in ("$$ROOT", "$$CURRENT"):
+                return None
+        elif expression.startswith("$"):
+            fields.add(expression[1:])
+    elif isinstance(expression, dict):
+        for key, value in expression.items():
+            if key == "$literal":
+                continue
+            if key in FIELD_NAME_OPERATORS:
+                return None
+            value_fields = expression_fields(value)
+            if value_fields is None:
+                return None
+            fields |= value_fields
+    elif isinstance(expression, list):
+        for item in expression:
+            item_fields = expression_fields(item)
+            if item_fields is None:
+                return None
+            fields |= item_fields
+    return fields
+
+
+def match_fields(spec: Dict[str, Any]) -> Optional[Set[str]]:
+    """Field paths a $match filter reads; None when that cannot be determined ($where, $text, ...)"""
+    fields = set()
+    for key, value in spec.items():
+        if key in ("$and", "$or", "$nor"):
+            for clause in value:
+                clause_fields = match_fields(clause)
+                if clause_fields is None:
+                    return None
+                fields |= clause_fields
+        elif key == "$expr":
+            expr_fields = expression_fields(value)
+            if expr_fields is None:
+                return None
+            fields |= expr_fields
+        elif key == "$comment":
+            continue
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.add(key)
+    return fields
+
+
+def _stage_name(stage: Any) -> Optional[str]:
+    return next(iter(stage)) if isinstance(stage, dict) and len(stage) == 1 else None
+
+
+def is_projection_flag(value: Any) -> bool:
+    """Whether a $project value includes or excludes a field (any number or bool) rather than computing it"""
+    return isinstance(value, (bool, int, float))
+
+
+def _is_nested_projection(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and not any(str(key).startswith("$") for key in value)
+
+
+def _nested_flags(prefix: str, spec: Dict[str, Any], included: Set[str], excluded: Set[str]) -> bool:
+    """Add the dotted paths of a nested projection's flags; False if any leaf is not a flag"""
+    for key, value in spec.items():
+        path = f"{prefix}.{key}"
+        if is_projection_flag(value):
+            (included if value else excluded).add(path)
+        elif not (_is_nested_projection(value) and _nested_flags(path, value, included, excluded)):
+            return False
+    return True
+
+
+def project_spec(spec: Dict[str, Any]) -> Optional[Tuple[Set[str], Set[str], Dict[str, Any]]]:
+    """Split a $project into (included, excluded, computed) fields; None if a value cannot be classified"""
+    included, excluded, computed = set(), set(), {}
+    for key, value in spec.items():
+        if is_projection_flag(value):
+            (included if value else excluded).add(key)
+        elif _is_nested_projection(value):
+            # {"vendor": {"name": 1}} includes vendor.name; nested computed fields are not tracked
+            if not _nested_flags(key, value, included, excluded):
+                return None
+        elif isinstance(value, (str, list, dict)):
+            computed[key] = value
+        else:
+            return None
+    return included, excluded, computed
+
+
+def can_match_move_before(stage: Dict[str, Any], fields: Set[str]) -> bool:
+    """Whether a $match reading fields gives the same result before the stage as after it"""
+    name = _stage_name(stage)
+    spec = stage[name]
+    if name == "$sort":
+        return True
+    if name in ("$addFields", "$set"):
+        return not any(overlaps(field, added) for field in fields for added in spec)
+    if name == "$unset":
+        removed = [spec] if isinstance(spec, str) else spec
+        return not any(overlaps(field, path) for field in fields for path in removed)
+    if name == "$unwind":
+        options = {"path": spec} if isinstance(spec, str) else spec
+        touched = [options["path"].lstrip("$")] + ([options["includeArrayIndex"]] if "includeArrayIndex" in options else [])
+        return not any(overlaps(field, path) for field in fields for path in touched)
+    if name == "$project":
+        parts = project_spec(spec)
+        if parts is None:
+            return False
+        included, excluded, computed = parts
+        for field in fields:
+            if any(overlaps(field, key) for key in list(computed) + list(excluded)):
+                return False
+            # With an inclusion projection, fields not kept would be missing after it
+            if (included or computed) and field != "_id" and not any(field == key or field.startswith(key + ".") for key in included):
+                return False
+        return True
+    return False
+
+
+def _merge_matches(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    if not set(first) & set(second):
+        return {**first, **second}
+    return {"$and": [first, second]}
+
+
+def _collapse(paths: Set[str]) -> List[str]:
+    """Drop paths contained in another path of the set (projecting both is an error)"""
+    return sorted(path for path in paths if not any(path != other and path.startswith(other + ".") for other in paths))
+
+
+class PipelineOptimizer:
+    """Rewrites generated aggregation pipelines so filters, projections and limits apply as early as possible"""
+
+    def __init__(self, explain_log: bool = PIPELINE_EXPLAIN_LOG, max_batch_size: int = PIPELINE_BATCH_SIZE):
+        self.explain_log = explain_log
+        self.max_batch_size = max_batch_size
+
+    def _push_matches(self, pipeline: List[Dict[str, Any]], rewrites: List[str]) -> List[Dict[str, Any]]:
+        moved = True
+        while moved:
+            moved = False
+            for i in range(1, len(pipeline)):
+                stage, previous = pipeline[i], pipeline[i - 1]
+                if _stage_name(stage) != "$match" or _stage_name(previous) not in RESHAPING_STAGES:
+                    continue
+                fields = match_fields(stage["$match"])
+                if fields is not None and can_match_move_before(previous, fields):
+                    pipeline[i - 1], pipeline[i] = stage, previous
+                    rewrites.append(f"moved $match before {_stage_name(previous)}")
+                    moved = True
+        return pipeline
+
+    def _merge_adjacent_matches(self, pipeline: List[Dict[str, Any]], rewrites: List[str]) -> List[Dict[str, Any]]:
+        merged = []
+        for stage in pipeline:
+            if merged and _stage_name(stage) == "$match" and _stage_name(merged[-1]) == "$match":
+                merged[-1] = {"$match": _merge_matches(merged[-1]["$match"], stage["$match"])}
+                rewrites.append("merged adjacent $match stages")
+            else:
+                merged.append(stage)
+        return merged
+
+    def _hoist_limits(self, pipeline: List[Dict[str, Any]], rewrites: List[str]) -> List[Dict[str, Any]]:
+        for i in range(1, len(pipeline)):
+            j = i
+            while j > 0 and _stage_name(pipeline[j]) == "$limit" and _stage_name(pipeline[j - 1]) in ONE_TO_ONE_STAGES:
+                rewrites.append(f"moved $limit before {_stage_name(pipeline[j - 1])}")
+                pipeline[j - 1], pipeline[j] = pipeline[j], pipeline[j - 1]
+                j -= 1
+        return pipeline
+
+    def _stage_dependencies(self, name: str, spec: Any) -> Tuple[Optional[Set[str]], Set[str], bool]:
+        """(fields read or None if unknown, fields produced, whether only those reads matter afterwards)"""
+        if name == "$match":
+            return match_fields(spec), set(), False
+        if name == "$sort":
+            return set(spec), set(), False
+        if name in ("$limit", "$skip"):
+            return set(), set(), False
+        if name == "$unset":
+            return set(), set(), False
+        if name in ("$addFields", "$set"):
+            return expression_fields(list(spec.values())), set(spec), False
+        if name == "$unwind":
+            options = {"path": spec} if isinstance(spec, str) else spec
+            produced = {options["includeArrayIndex"]} if "includeArrayIndex" in options else set()
+            return {options["path"].lstrip("$")}, produced, False
+        if name == "$lookup":
+            if "pipeline" in spec or "let" in spec:
+                return None, set(), False
+            return {spec["localField"]}, {spec["as"]}, False
+        if name == "$project":
+            parts = project_spec(spec)
+            if parts is None:
+                return None, set(), False
+            included, excluded, computed = parts
+            if not included and not computed:
+                return set(), set(), False  # exclusion projection
+            reads = expression_fields(list(computed.values()))
+            if reads is None:
+                return None, set(), False
+            reads |= included
+            if "_id" not in excluded:
+                reads.add("_id")
+            return reads, set(), True
+        if name == "$count":
+            return set(), set(), True
+        if name in CLOSING_STAGES:
+            return expression_fields(spec), set(), True
+        return None, set(), False
+
+    def _push_projection(self, pipeline: List[Dict[str, Any]], rewrites: List[str]) -> List[Dict[str, Any]]:
+        # The projection goes after the leading filter/sort/limit prefix, which the server runs in the query layer
+        start = 0
+        while start < len(pipeline) and _stage_name(pipeline[start]) in ("$match", "$sort", "$limit", "$skip"):
+            start += 1
+        if start >= len(pipeline) or _stage_name(pipeline[start]) in ("$project", "$count"):
+            return pipeline
+
+        needed, produced = set(), set()
+        for stage in pipeline[start:]:
+            name = _stage_name(stage)
+            if name is None:
+                return pipeline
+            reads, outputs, closes = self._stage_dependencies(name, stage[name])
+            if reads is None:
+                return pipeline
+            needed |= {field for field in reads if not any(field == out or field.startswith(out + ".") for out in produced)}
+            produced |= outputs
+            if closes:
+                break
+        else:
+            return pipeline  # every field reaches the output
+
+        if not needed:
+            return pipeline
+        fields = _collapse(needed)
+        projection = {field: 1 for field in fields}
+        if "_id" not in projection:
+            projection["_id"] = 0
+        rewrites.append(f"projected {len(fields)} referenced fields before {_stage_name(pipeline[start])}")
+        return pipeline[:start] + [{"$project": projection}] + pipeline[start:]
+
+    def optimize(self, pipeline: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """Return the rewritten pipeline and a description of each rewrite applied"""
+        if not isinstance(pipeline, list) or any(_stage_name(stage) is None for stage in pipeline):
+            return pipeline, []
+        rewrites = []
+        optimized = self._push_matches(list(pipeline), rewrites)
+        optimized = self._merge_adjacent_matches(optimized, rewrites)
+        optimized = self._hoist_limits(optimized, rewrites)
+        optimized = self._push_projection(optimized, rewrites)
+        return optimized, list(dict.fromkeys(rewrites))
+
+    def options(self, pipeline: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """aggregate() keyword arguments: disk use for blocking stages, one batch for small limited results"""
+        names = [_stage_name(stage) for stage in pipeline]
+        options = {"allowDiskUse": any(name in BLOCKING_STAGES for name in names)}
+        limit = pipeline[-1]["$limit"] if names and names[-1] == "$limit" else None
+        options["batchSize"] = min(limit, self.max_batch_size) if isinstance(limit, int) and limit > 0 else self.max_batch_size
+        return options
+
+    def _explain_command(self, collection_name: str, pipeline: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"explain": {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}}, "verbosity": "queryPlanner"}
+
+    @staticmethod
+    def _plan_text(explain: Dict[str, Any]) -> str:
+        plan = plan_summary(explain)
+        stages = [_stage_name(stage) for stage in explain.get("stages", [])]
+        text = "/".join(plan["stages"]) or "no query plan"
+        if plan["indexes"]:
+            text += f" using {', '.join(plan['indexes'])}"
+        return text + (f", server stages {' -> '.join(stages)}" if stages else "")
+
+    def _log(self, collection_name: str, before: List[Dict[str, Any]], after: List[Dict[str, Any]],
+             rewrites: List[str], before_text: str, after_text: str):
+        log(f"Pipeline optimizer on {collection_name}: {'; '.join(rewrites)}\n"
+            f"  before ({len(before)} stages): {before_text}\n"
+            f"  after ({len(after)} stages): {after_text}")
+
+    def log_comparison(self, collection, before: List[Dict[str, Any]], after: List[Dict[str, Any]], rewrites: List[str]):
+        """Log the query plans of the original and rewritten pipelines"""
+        if not rewrites:
+            return
+        if not self.explain_log:
+            log(f"Pipeline optimizer on {collection.name}: {'; '.join(rewrites)}")
+            return
+        try:
+            before_text = self._plan_text(collection.database.command(self._explain_command(collection.name, before)))
+            after_text = self._plan_text(collection.database.command(self._explain_command(collection.name, after)))
+        except OperationFailure as e:
+            before_text = after_text = f"explain failed: {e}"
+        self._log(collection.name, before, after, rewrites, before_text, after_text)
+
+    async def alog_comparison(self, collection, before: List[Dict[str, Any]], after: List[Dict[str, Any]], rewrites: List[str]):
+        """Async (Motor) variant of log_comparison()"""
+        if not rewrites:
+            return
+        if not self.explain_log:
+            log(f"Pipeline optimizer on {collection.name}: {'; '.join(rewrites)}")
+            return
+        try:
+            before_text = self._plan_text(await collection.database.command(self._explain_command(collection.name, before)))
+            after_text = self._plan_text(await collection.database.command(self._explain_command(collection.name, after)))
+        except OperationFailure as e:
+            before_text = after_text = f"explain failed: {e}"
+        self._log(collection.name, before, after, rewrites, before_text, after_text)
+
+
+if __name__ == "__main__":
+    # Self-check of the rewrites on hand-written pipelines: python -m common.pipeline_optimizer
+    CASES = [
+        (
+            "nested inclusion survives the pushed projection",
+            [{"$match": {"status": "open"}}, {"$unwind": "$items"}, {"$project": {"vendor": {"name": 1}, "items.sku": 1}}],
+            [{"$match": {"status": "open"}}, {"$project": {"_id": 1, "items": 1, "vendor.name": 1}},
+             {"$unwind": "$items"}, {"$project": {"vendor": {"name": 1}, "items.sku": 1}}]
+        ),
+        (
+            "nested computed field is left alone",
+            [{"$unwind": "$items"}, {"$project": {"vendor": {"name": "$vendorName", "id": 1}}}],
+            [{"$unwind": "$items"}, {"$project": {"vendor": {"name": "$vendorName", "id": 1}}}]
+        ),
+        (
+            "numeric flags are inclusions",
+            [{"$unwind": "$x"}, {"$project": {"a": 1.0, "x": 1}}],
+            [{"$project": {"_id": 1, "a": 1, "x": 1}}, {"$unwind": "$x"}, {"$project": {"a": 1.0, "x": 1}}]
+        ),
+        (
+            "$getField reads are unknown",
+            [{"$unwind": "$x"}, {"$addFields": {"k": {"$getField": "a.b"}}}, {"$group": {"_id": "$k"}}],
+            [{"$unwind": "$x"}, {"$addFields": {"k": {"$getField": "a.b"}}}, {"$group": {"_id": "$k"}}]
+        ),
+        (
+            "$match moves ahead of $addFields it does not read",
+            [{"$addFields": {"total": {"$sum": "$items.price"}}}, {"$match": {"status": "open"}}, {"$limit": 10}],
+            [{"$match": {"status": "open"}}, {"$limit": 10}, {"$addFields": {"total": {"$sum": "$items.price"}}}]
+        ),
+    ]
+    optimizer = PipelineOptimizer(explain_log=False)
+    for title, pipeline, expected in CASES:
+        optimized, rewrites = optimizer.optimize(pipeline)
+        assert optimized == expected, f"{title}: {optimized}"
+        print(f"ok  {title}: {'; '.join(rewrites) or 'no rewrites'}")
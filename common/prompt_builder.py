@@ -0,0 +1,141 @@
+import os
+import re
+import json
+from typing import List, Dict, Any, Optional, Tuple, Set
+
+from dotenv import load_dotenv
+from common.doc_serializer import count_tokens
+
+# Load environment variables
+load_dotenv()
+
+# Token budget for the schema part of the query prompt (field list plus sample document)
+PROMPT_SCHEMA_TOKENS = int(os.getenv("PROMPT_SCHEMA_TOKENS", "2500"))
+# Share of the budget the sample document may use
+PROMPT_SAMPLE_SHARE = float(os.getenv("PROMPT_SAMPLE_SHARE", "0.3"))
+PROMPT_EXAMPLE_LENGTH = int(os.getenv("PROMPT_EXAMPLE_LENGTH", "40"))
+
+WORD_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+TIME_WORDS = {"date", "day", "week", "month", "year", "time", "trend", "when", "recent", "latest", "since", "ago"}
+
+
+def words(text: str) -> List[str]:
+    """Lowercase words of a question or a camelCase/snake_case field path, with plural 's' stripped"""
+    result = []
+    for word in WORD_PATTERN.findall(text):
+        word = word.lower()
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        result.append(word)
+    return result
+
+
+def _truncate(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+class SchemaPromptBuilder:
+    """Fits the field list and sample document of a query prompt into a token budget, most relevant first"""
+
+    def __init__(self, token_budget: int = PROMPT_SCHEMA_TOKENS, sample_share: float = PROMPT_SAMPLE_SHARE,
+                 example_length: int = PROMPT_EXAMPLE_LENGTH):
+        self.token_budget = token_budget
+        self.sample_share = sample_share
+        self.example_length = example_length
+
+    def _keyword_scores(self, question: str, fields: Dict[str, Any]) -> Dict[str, float]:
+        """Keyword overlap of each field path with the question, plus a bonus for date fields on time questions"""
+        question_words = set(words(question))
+        wants_time = bool(question_words & TIME_WORDS)
+
+        def score(field: str) -> float:
+            field_words = words(field)
+            exact = sum(1 for word in field_words if word in question_words)
+            partial = sum(
+                0.5 for word in field_words if word not in question_words and len(word) >= 4
+                and any(q.startswith(word) or word.startswith(q) for q in question_words if len(q) >= 4)
+            )
+            types = fields[field]["types"]
+            time_bonus = 1 if wants_time and ("datetime" in types or "date" in types) else 0
+            return exact + partial + time_bonus
+
+        return {field: score(field) for field in fields}
+
+    def rank_fields(self, question: str, fields: Dict[str, Any]) -> List[str]:
+        """Field names ordered by keyword overlap with the question; ties keep schema order"""
+        scores = self._keyword_scores(question, fields)
+        order = {field: index for index, field in enumerate(fields)}
+        # Rarely present fields are less likely to matter when nothing else distinguishes them
+        return sorted(fields, key=lambda field: (-(scores[field] + 0.1 * fields[field].get("presence", 1)), order[field]))
+
+    def relevant_fields(self, question: str, fields: Dict[str, Any], limit: int = 10) -> List[str]:
+        """The fields the question mentions, most relevant first"""
+        scores = self._keyword_scores(question, fields)
+        return [field for field in self.rank_fields(question, fields) if scores[field] > 0][:limit]
+
+    def field_line(self, field: str, info: Dict[str, Any], cardinality: Optional[int] = None,
+                   lower_bound: bool = False) -> str:
+        examples = ", ".join(_truncate(example, self.example_length) for example in info["examples"]) or "N/A"
+        line = f"- {field} (types: {', '.join(info['types'])}, examples: {examples}"
+        if cardinality is not None and lower_bound:
+            line += f", ≥{cardinality} distinct values (sampled)"
+        elif cardinality is not None:
+            line += f", ~{cardinality} distinct values"
+        if info.get("presence", 1) < 1:
+            line += f", present in {info['presence']:.0%} of documents"
+        return line + ")"
+
+    def _compact(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: self._compact(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._compact(item) for item in value[:2]] + (["..."] if len(value) > 2 else [])
+        if isinstance(value, str):
+            return _truncate(value, self.example_length)
+        return value
+
+    def sample_text(self, sample_doc: Dict[str, Any], ranked_fields: List[str], budget: int) -> str:
+        """Compact JSON of the sample document, dropping the least relevant top-level fields to fit"""
+        top_level = []
+        for field in ranked_fields:
+            key = field.split(".")[0].replace("[]", "")
+            if key in sample_doc and key not in top_level:
+                top_level.append(key)
+
+        while top_level:
+            text = json.dumps({key: self._compact(sample_doc[key]) for key in top_level}, separators=(",", ":"), default=str)
+            if count_tokens(text) <= budget:
+                return text
+            top_level.pop()
+        return "{}"
+
+    def build(self, question: str, collection_info: Dict[str, Any],
+              cardinalities: Optional[Dict[str, int]] = None,
+              lower_bounds: Optional[Set[str]] = None) -> Tuple[str, str, Dict[str, int]]:
+        """Return (field list, sample document text, token report) for the question"""
+        cardinalities = cardinalities or {}
+        lower_bounds = lower_bounds or set()
+        fields = collection_info["fields"]
+        ranked = self.rank_fields(question, fields)
+
+        field_budget = int(self.token_budget * (1 - self.sample_share))
+        lines = {}
+        used = 0
+        for field in ranked:
+            line = self.field_line(field, fields[field], cardinalities.get(field), field in lower_bounds)
+            tokens = count_tokens(line)
+            if used + tokens > field_budget and lines:
+                continue  # a shorter, less relevant line may still fit
+            lines[field] = line
+            used += tokens
+
+        # Keep schema order in the prompt; ranking only decides what is left out
+        fields_info = "\n".join(lines[field] for field in fields if field in lines)
+        sample = self.sample_text(collection_info.get("sample_document") or {}, ranked, self.token_budget - used)
+        report = {
+            "fields_included": len(lines),
+            "fields_total": len(fields),
+            "field_tokens": used,
+            "sample_tokens": count_tokens(sample)
+        }
+        return fields_info, sample, report
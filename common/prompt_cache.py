@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+from typing import Dict, Callable, Optional, Tuple
+
+from dotenv import load_dotenv
+from common.doc_serializer import count_tokens
+
+try:
+    from google.ai import generativelanguage_v1beta as glm
+    from google.protobuf import duration_pb2
+except ImportError:  # provider-side caching is optional
+    glm = None
+
+# Load environment variables
+load_dotenv()
+
+# Register static prompt prefixes as Gemini cached content (needs a versioned model that supports caching)
+PROMPT_CONTEXT_CACHE = os.getenv("PROMPT_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+PROMPT_CONTEXT_CACHE_TTL = int(os.getenv("PROMPT_CONTEXT_CACHE_TTL", "3600"))
+# The provider rejects cached content below a per-model minimum size, so smaller prefixes are not registered;
+# unset means the minimum of the configured model
+PROMPT_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CONTEXT_CACHE_MIN_TOKENS", "0")) or None
+# Smallest cached content each model family accepts, matched on the longest model name prefix
+CACHED_CONTENT_MIN_TOKENS = {"gemini-1.5": 32768, "gemini-2.5-flash": 1024, "gemini-2.5-pro": 4096}
+DEFAULT_CACHED_CONTENT_MIN_TOKENS = 4096
+
+
+def cached_content_min_tokens(model: str) -> int:
+    """The provider's minimum cached-content size for a model"""
+    families = [family for family in CACHED_CONTENT_MIN_TOKENS if model.startswith(family)]
+    return CACHED_CONTENT_MIN_TOKENS[max(families, key=len)] if families else DEFAULT_CACHED_CONTENT_MIN_TOKENS
+
+
+class PromptPrefix:
+    """A static prompt prefix, and the provider cached-content name holding it if registered"""
+
+    def __init__(self, text: str, cached_content: Optional[str] = None, expires_at: float = 0.0):
+        self.text = text
+        self.cached_content = cached_content
+        self.expires_at = expires_at
+
+
+class PromptPrefixCache:
+    """Builds each collection's static prompt prefix once per schema fingerprint, optionally caching it provider-side"""
+
+    def __init__(self, model: str, api_key: str, system_instruction: str,
+                 use_provider_cache: bool = PROMPT_CONTEXT_CACHE, ttl_seconds: int = PROMPT_CONTEXT_CACHE_TTL,
+                 min_tokens: Optional[int] = PROMPT_CONTEXT_CACHE_MIN_TOKENS):
+        self.model = model
+        self.system_instruction = system_instruction
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens or cached_content_min_tokens(model)
+        self.client = None
+        if use_provider_cache:
+            if glm is None:
+                print("google-ai-generativelanguage is not installed; prompt prefixes are not cached provider-side")
+            else:
+                self.client = glm.CacheServiceClient(client_options={"api_key": api_key})
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[str, PromptPrefix]] = {}
+
+    def _register(self, text: str) -> Optional[PromptPrefix]:
+        try:
+            cached = self.client.create_cached_content(cached_content=glm.CachedContent(
+                model=f"models/{self.model}",
+                system_instruction=glm.Content(parts=[glm.Part(text=self.system_instruction)]),
+                contents=[glm.Content(role="user", parts=[glm.Part(text=text)])],
+                ttl=duration_pb2.Duration(seconds=self.ttl_seconds)
+            ))
+        except Exception as e:
+            print(f"Could not register cached prompt context: {e}")
+            return None
+        # Renew a minute early so requests never reference an expired cache
+        return PromptPrefix(text, cached.name, time.time() + self.ttl_seconds - 60)
+
+    def get(self, key: str, fingerprint: str, build: Callable[[], str]) -> PromptPrefix:
+        """Return the prefix for key, rebuilding it when the schema fingerprint changes"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == fingerprint:
+            prefix = entry[1]
+            if not prefix.cached_content or time.time() < prefix.expires_at:
+                return prefix
+            text = prefix.text
+        else:
+            text = build()
+
+        prefix = PromptPrefix(text)
+        if self.client is not None:
+            tokens = count_tokens(self.system_instruction + text)
+            if tokens >= self.min_tokens:
+                prefix = self._register(text) or prefix
+            else:
+                print(f"Prompt prefix for {key} is ~{tokens} tokens, under the {self.min_tokens}-token cached content "
+                      f"minimum of {self.model}; sending it inline")
+        with self._lock:
+            self._entries[key] = (fingerprint, prefix)
+        return prefix
+
+    def discard_cached_content(self, key: str):
+        """Stop using the provider cache for key (e.g. after a request referencing it failed)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries[key] = (entry[0], PromptPrefix(entry[1].text))
+
+
+def _log_timing(started: float, first_token: Optional[float], cached: bool):
+    total = time.perf_counter() - started
+    ttft = (first_token - started) if first_token else total
+    print(f"LLM time to first token: {ttft:.2f}s, total: {total:.2f}s, cached context: {'yes' if cached else 'no'}")
+
+
+def timed_invoke(llm, messages, **kwargs) -> str:
+    """Stream an LLM response, logging time to first token and total time; returns the response text"""
+    started = time.perf_counter()
+    first_token = None
+    parts = []
+    for chunk in llm.stream(messages, **kwargs):
+        if first_token is None:
+            first_token = time.perf_counter()
+        parts.append(chunk.content)
+    _log_timing(started, first_token, "cached_content" in kwargs)
+    return "".join(parts)
+
+
+async def atimed_invoke(llm, messages, **kwargs) -> str:
+    """Async variant of timed_invoke()"""
+    started = time.perf_counter()
+    first_token = None
+    parts = []
+    async for chunk in llm.astream(messages, **kwargs):
+        if first_token is None:
+            first_token = time.perf_counter()
+        parts.append(chunk.content)
+    _log_timing(started, first_token, "cached_content" in kwargs)
+    return "".join(parts)
@@ -0,0 +1,151 @@
+import re
+import copy
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so trivially different phrasings share a cache key"""
+    question = question.strip().lower()
+    question = re.sub(r"\s+", " ", question)
+    return question.rstrip("?.! ")
+
+
+def schema_fingerprint(collection_info: Dict[str, Any]) -> str:
+    """Build a short fingerprint of a collection's field/type layout"""
+    layout = {
+        field: sorted(info.get("types", []))
+        for field, info in collection_info.get("fields", {}).items()
+    }
+    payload = json.dumps(layout, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def context_fingerprint(fingerprint: str, conversation: str) -> str:
+    """Extend a schema fingerprint with the conversation context the prompt carries"""
+    if not conversation:
+        return fingerprint
+    return f"{fingerprint}:{hashlib.sha1(conversation.encode('utf-8')).hexdigest()[:16]}"
+
+
+class QueryCache:
+    """LRU/TTL cache of generated queries keyed by question, collection and schema"""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl_seconds: int = 3600,
+        embeddings=None,
+        similarity_threshold: Optional[float] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+
+        self._entries = OrderedDict()
+        self._vectors = {}  # question -> embedding computed on the last miss
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def _key(self, question: str, collection_name: str, fingerprint: str) -> Tuple[str, str, str, str]:
+        # Relative questions ("this month") resolve to literal dates, so never reuse across days
+        return (normalize_question(question), collection_name, fingerprint, datetime.date.today().isoformat())
+
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        if self.embeddings is None or self.similarity_threshold is None:
+            return None
+
+        if question in self._vectors:
+            return self._vectors[question]
+
+        try:
+            vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        except Exception as e:
+            print(f"Query cache embedding failed: {e}")
+            return None
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        self._vectors = {question: vector}  # only the most recent miss is needed for put()
+        return vector
+
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return self.ttl_seconds is not None and time.time() - entry["created_at"] > self.ttl_seconds
+
+    def _find_similar(self, key, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        best_entry, best_score = None, self.similarity_threshold
+        for other_key, entry in self._entries.items():
+            if other_key[1:] != key[1:] or entry["vector"] is None or self._expired(entry):
+                continue
+            score = float(np.dot(vector, entry["vector"]))
+            if score >= best_score:
+                best_entry, best_score = entry, score
+        return best_entry
+
+    def get(self, question: str, collection_name: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached query data for a question, or None"""
+        key = self._key(question, collection_name, fingerprint)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry["query_data"])
+
+        # Fall back to near-duplicate matching on the question embedding
+        vector = self._embed(key[0])
+        if vector is not None:
+            with self._lock:
+                entry = self._find_similar(key, vector)
+                if entry is not None:
+                    self.similar_hits += 1
+                    return copy.deepcopy(entry["query_data"])
+
+        self.misses += 1
+        return None
+
+    def put(self, question: str, collection_name: str, fingerprint: str, query_data: Dict[str, Any]):
+        """Store generated query data for a question"""
+        key = self._key(question, collection_name, fingerprint)
+        vector = self._embed(key[0])
+
+        with self._lock:
+            self._entries[key] = {
+                "query_data": copy.deepcopy(query_data),
+                "vector": vector,
+                "created_at": time.time()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached queries"""
+        with self._lock:
+            self._entries.clear()
+            self._vectors = {}
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters for the cache"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,235 @@
+import os
+from typing import List, Dict, Any, Optional
+
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure, ExecutionTimeout
+
+# Load environment variables
+load_dotenv()
+
+# off: run every query on the primary; route: send expensive queries to the analytics read preference; reject: refuse them
+QUERY_GUARD_MODE = os.getenv("QUERY_GUARD_MODE", "route").lower()
+QUERY_MAX_DOCS_EXAMINED = int(os.getenv("QUERY_MAX_DOCS_EXAMINED", "100000"))
+QUERY_MAX_KEYS_EXAMINED = int(os.getenv("QUERY_MAX_KEYS_EXAMINED", "200000"))
+# Collection scans are fine on collections up to this size
+QUERY_COLLSCAN_MAX_DOCUMENTS = int(os.getenv("QUERY_COLLSCAN_MAX_DOCUMENTS", "10000"))
+# Server-side time limit for every generated query, and for the explain that measures it
+QUERY_MAX_TIME_MS = int(os.getenv("QUERY_MAX_TIME_MS", "30000"))
+QUERY_EXPLAIN_MAX_TIME_MS = int(os.getenv("QUERY_EXPLAIN_MAX_TIME_MS", "2000"))
+
+GUARDED_QUERY_TYPES = ("find", "aggregate", "count", "distinct")
+
+
+class QueryTooExpensive(ValueError):
+    """A generated query whose estimated cost is over the guard thresholds"""
+
+    def __init__(self, message: str, estimate: "QueryEstimate"):
+        super().__init__(message)
+        self.estimate = estimate
+
+
+class QueryEstimate:
+    """What explain says a query will do: plan stages and documents/index keys examined"""
+
+    def __init__(self, stages: List[str], indexes: List[str], docs_examined: int = 0, keys_examined: int = 0,
+                 lower_bound: bool = False):
+        self.stages = stages
+        self.indexes = indexes
+        self.docs_examined = docs_examined
+        self.keys_examined = keys_examined
+        self.lower_bound = lower_bound  # measurement stopped at the threshold
+        self.reasons: List[str] = []
+        self.route = "primary"  # primary, analytics or rejected
+
+    @property
+    def collscan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+    def describe(self) -> str:
+        bound = "at least " if self.lower_bound else "~"
+        plan = "COLLSCAN" if self.collscan else "index " + ", ".join(self.indexes) if self.indexes else "/".join(self.stages)
+        return f"{plan}, {bound}{self.docs_examined} docs / {bound}{self.keys_examined} keys examined"
+
+
+def _walk_plan(node: Any, info: Dict[str, Any], in_plan: bool = False):
+    if isinstance(node, list):
+        for item in node:
+            _walk_plan(item, info, in_plan)
+        return
+    if not isinstance(node, dict):
+        return
+    if in_plan:
+        if "stage" in node:
+            info["stages"].append(node["stage"])
+        if "indexName" in node and node["indexName"] not in info["indexes"]:
+            info["indexes"].append(node["indexName"])
+        # Only a LIMIT stage stops reading early; a top-k SORT also carries limitAmount but reads every match
+        if node.get("stage") == "LIMIT" and "limitAmount" in node:
+            info["limits"].append(node["limitAmount"])
+    for key, value in node.items():
+        if key == "rejectedPlans":
+            continue
+        _walk_plan(value, info, in_plan or key == "winningPlan")
+
+
+def plan_summary(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Stages, index names and limits of the winning plan(s) in an explain result (find, aggregate or sharded)"""
+    info = {"stages": [], "indexes": [], "limits": []}
+    _walk_plan(explain, info)
+    return info
+
+
+def _execution_totals(node: Any) -> Optional[Dict[str, Any]]:
+    if isinstance(node, dict):
+        if "totalDocsExamined" in node:
+            return node
+        node = list(node.values())
+    if isinstance(node, list):
+        for item in node:
+            totals = _execution_totals(item)
+            if totals is not None:
+                return totals
+    return None
+
+
+def leading_filter(query_type: str, query: Any) -> Dict[str, Any]:
+    """The filter that decides how many documents a query reads"""
+    if query_type == "aggregate":
+        first = query[0] if isinstance(query, list) and query else {}
+        return first.get("$match", {}) if isinstance(first, dict) else {}
+    if query_type == "distinct":
+        return query.get("filter", {})
+    return query if isinstance(query, dict) else {}
+
+
+class QueryGuard:
+    """Explain-based cost check run before a generated query, deciding whether it runs, is routed or is refused"""
+
+    def __init__(self, mode: str = QUERY_GUARD_MODE, max_docs_examined: int = QUERY_MAX_DOCS_EXAMINED,
+                 max_keys_examined: int = QUERY_MAX_KEYS_EXAMINED,
+                 collscan_max_documents: int = QUERY_COLLSCAN_MAX_DOCUMENTS, max_time_ms: int = QUERY_MAX_TIME_MS,
+                 explain_max_time_ms: int = QUERY_EXPLAIN_MAX_TIME_MS):
+        self.mode = mode
+        self.max_docs_examined = max_docs_examined
+        self.max_keys_examined = max_keys_examined
+        self.collscan_max_documents = collscan_max_documents
+        self.max_time_ms = max_time_ms
+        self.explain_max_time_ms = explain_max_time_ms
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("route", "reject")
+
+    def _plan_command(self, collection_name: str, query_type: str, query: Any) -> Dict[str, Any]:
+        if query_type == "find":
+            command = {"find": collection_name, "filter": query, "limit": 50}
+        elif query_type == "aggregate":
+            command = {"aggregate": collection_name, "pipeline": query, "cursor": {}}
+        elif query_type == "distinct":
+            command = {"distinct": collection_name, "key": query.get("field"), "query": query.get("filter", {})}
+        else:
+            command = {"count": collection_name, "query": query}
+        # queryPlanner verbosity plans the query without running it
+        return {"explain": command, "verbosity": "queryPlanner", "maxTimeMS": self.explain_max_time_ms}
+
+    def _measure_command(self, collection_name: str, filter_query: Dict[str, Any], limit: int) -> Dict[str, Any]:
+        # A limited count stops as soon as the threshold is crossed, so measuring never costs more than the threshold
+        return {
+            "explain": {"count": collection_name, "query": filter_query, "limit": limit},
+            "verbosity": "executionStats",
+            "maxTimeMS": self.explain_max_time_ms
+        }
+
+    def _measure_limit(self, plan: Dict[str, Any]) -> int:
+        # A blocking sort reads every matching document before any limit applies
+        limits = [] if "SORT" in plan["stages"] else plan["limits"]
+        return min([self.max_docs_examined] + limits) + 1
+
+    def _estimate(self, plan: Dict[str, Any], document_count: int, measured: Optional[Dict[str, Any]]) -> QueryEstimate:
+        estimate = QueryEstimate(plan["stages"], plan["indexes"])
+        if estimate.collscan:
+            # Without an index the whole collection is read, whatever the filter matches
+            estimate.docs_examined = document_count
+        elif measured is None:
+            estimate.docs_examined = estimate.keys_examined = self.max_docs_examined + 1
+            estimate.lower_bound = True
+        else:
+            totals = _execution_totals(measured) or {}
+            estimate.docs_examined = totals.get("totalDocsExamined", 0)
+            estimate.keys_examined = totals.get("totalKeysExamined", 0)
+            estimate.lower_bound = max(estimate.docs_examined, estimate.keys_examined) >= self._measure_limit(plan) - 1
+        return estimate
+
+    def _assess(self, estimate: QueryEstimate, document_count: int) -> QueryEstimate:
+        if estimate.collscan and document_count > self.collscan_max_documents:
+            estimate.reasons.append(f"collection scan over ~{document_count} documents")
+        elif estimate.docs_examined > self.max_docs_examined:
+            estimate.reasons.append(f"examines over {self.max_docs_examined} documents")
+        if estimate.keys_examined > self.max_keys_examined:
+            estimate.reasons.append(f"examines over {self.max_keys_examined} index keys")
+        if estimate.reasons:
+            estimate.route = "analytics" if self.mode == "route" else "rejected"
+        print(f"Query guard: {estimate.describe()} -> {'; '.join(estimate.reasons) or 'ok'} ({estimate.route})")
+        return estimate
+
+    def _rejection(self, estimate: QueryEstimate, indexed_fields: List[str]) -> QueryTooExpensive:
+        message = f"This query is too expensive to run ({'; '.join(estimate.reasons)})."
+        hint = f" on an indexed field ({', '.join(indexed_fields)})" if indexed_fields else ""
+        message += f" Please ask a narrower question, for example with a date range or a filter{hint}."
+        return QueryTooExpensive(message, estimate)
+
+    @staticmethod
+    def _indexed_fields(index_information: Dict[str, Any]) -> List[str]:
+        fields = []
+        for index in index_information.values():
+            for field, _ in index.get("key", []):
+                if field not in fields:
+                    fields.append(field)
+        return fields
+
+    def check(self, collection, query_type: str, query: Any, document_count: int) -> QueryEstimate:
+        """Explain the query against a pymongo collection; raises QueryTooExpensive when refused"""
+        if query_type not in GUARDED_QUERY_TYPES:
+            return QueryEstimate([], [])
+        database = collection.database
+        plan = {"stages": [], "indexes": [], "limits": []}
+        measured = None
+        try:
+            plan = plan_summary(database.command(self._plan_command(collection.name, query_type, query)))
+            if "COLLSCAN" not in plan["stages"]:
+                measured = database.command(self._measure_command(
+                    collection.name, leading_filter(query_type, query), self._measure_limit(plan)))
+        except ExecutionTimeout:
+            # Even the bounded explain ran out of time: treat the query as over the thresholds
+            pass
+        except OperationFailure as e:
+            print(f"Query guard skipped, explain failed: {e}")
+            return QueryEstimate([], [])
+
+        estimate = self._assess(self._estimate(plan, document_count, measured), document_count)
+        if estimate.reasons and self.mode == "reject":
+            raise self._rejection(estimate, self._indexed_fields(collection.index_information()))
+        return estimate
+
+    async def acheck(self, collection, query_type: str, query: Any, document_count: int) -> QueryEstimate:
+        """Async (Motor) variant of check()"""
+        if query_type not in GUARDED_QUERY_TYPES:
+            return QueryEstimate([], [])
+        database = collection.database
+        plan = {"stages": [], "indexes": [], "limits": []}
+        measured = None
+        try:
+            plan = plan_summary(await database.command(self._plan_command(collection.name, query_type, query)))
+            if "COLLSCAN" not in plan["stages"]:
+                measured = await database.command(self._measure_command(
+                    collection.name, leading_filter(query_type, query), self._measure_limit(plan)))
+        except ExecutionTimeout:
+            pass
+        except OperationFailure as e:
+            print(f"Query guard skipped, explain failed: {e}")
+            return QueryEstimate([], [])
+
+        estimate = self._assess(self._estimate(plan, document_count, measured), document_count)
+        if estimate.reasons and self.mode == "reject":
+            raise self._rejection(estimate, self._indexed_fields(await collection.index_information()))
+        return estimate
@@ -0,0 +1,227 @@
+import os
+import time
+import pickle
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+import zstandard
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
+
+# Load environment variables
+load_dotenv()
+
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "600"))
+RESULT_CACHE_LEVEL = int(os.getenv("RESULT_CACHE_LEVEL", "3"))
+# Without a change stream, a collection's write watermark is re-read at most this often
+RESULT_CACHE_CHECK_INTERVAL = float(os.getenv("RESULT_CACHE_CHECK_INTERVAL", "5"))
+RESULT_CACHE_WATERMARK_FIELD = os.getenv("RESULT_CACHE_WATERMARK_FIELD", "updatedOn")
+RESULT_CACHE_WATERMARK_MAX_TIME_MS = int(os.getenv("RESULT_CACHE_WATERMARK_MAX_TIME_MS", "500"))
+
+# Operators whose argument key order is significant and must survive canonicalization
+ORDERED_OPERATORS = {"$sort", "hint"}
+
+
+def canonical(value: Any, ordered: bool = False) -> Any:
+    """Sort document keys (except where order matters) so equivalent queries serialize identically"""
+    if isinstance(value, dict):
+        items = value.items() if ordered else sorted(value.items())
+        return {key: canonical(item, key in ORDERED_OPERATORS) for key, item in items}
+    if isinstance(value, list):
+        return [canonical(item) for item in value]
+    return value
+
+
+def result_key(database_name: str, collection_name: str, query_type: str, query: Any) -> str:
+    """Canonical hash of a query against a collection"""
+    payload = json_util.dumps([database_name, collection_name, query_type, canonical(query)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Byte-budgeted LRU of zstd-compressed query results, invalidated by change streams or write watermarks"""
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_BYTES, ttl_seconds: int = RESULT_CACHE_TTL,
+                 level: int = RESULT_CACHE_LEVEL, check_interval: float = RESULT_CACHE_CHECK_INTERVAL,
+                 watermark_field: str = RESULT_CACHE_WATERMARK_FIELD,
+                 watermark_max_time_ms: int = RESULT_CACHE_WATERMARK_MAX_TIME_MS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.level = level
+        self.check_interval = check_interval
+        self.watermark_field = watermark_field
+        self.watermark_max_time_ms = watermark_max_time_ms
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, bytes, float]]" = OrderedDict()  # key -> (namespace, blob, stored_at)
+        self._bytes = 0
+        self._generations: Dict[str, int] = {}  # namespace -> number of invalidations so far
+        self._watched = set()  # namespaces with a live change stream
+        self._watchers = set()  # namespaces a watcher was started for
+        self._starting = set()  # namespaces whose change stream is still opening
+        self._watermarks: Dict[str, Tuple[Any, float]] = {}  # namespace -> (watermark, checked_at)
+        self._watermark_indexed: Dict[str, bool] = {}  # namespace -> watermark field leads an index
+        self._tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[2] > self.ttl_seconds:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            blob = entry[1]
+        return pickle.loads(zstandard.ZstdDecompressor().decompress(blob))
+
+    def generation(self, namespace: str) -> int:
+        """Invalidation count of a collection; capture it before running a query and hand it to put()"""
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def put(self, key: str, namespace: str, result: Dict[str, Any], generation: Optional[int] = None):
+        blob = zstandard.ZstdCompressor(level=self.level).compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        if len(blob) > self.max_bytes // 4:
+            return  # one huge result would evict everything else
+        with self._lock:
+            if generation is not None and generation != self._generations.get(namespace, 0):
+                return  # the collection changed while the query ran, so the result may predate the write
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (namespace, blob, time.time())
+            self._bytes += len(blob)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        self._bytes -= len(self._entries.pop(key)[1])
+
+    def invalidate(self, namespace: str):
+        """Forget every cached result of a collection"""
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            for key in [key for key, entry in self._entries.items() if entry[0] == namespace]:
+                self._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses,
+                    "watched": sorted(self._watched)}
+
+    def _observe_watermark(self, namespace: str, watermark: Any):
+        previous = self._watermarks.get(namespace)
+        if previous is not None and previous[0] != watermark:
+            self.invalidate(namespace)
+        self._watermarks[namespace] = (watermark, time.time())
+
+    def _postpone_watermark_check(self, namespace: str):
+        previous = self._watermarks.get(namespace)
+        if previous is not None:
+            self._watermarks[namespace] = (previous[0], time.time())
+
+    def _needs_watermark_check(self, namespace: str) -> bool:
+        # A stream that is still opening invalidates the collection once it is up
+        if namespace in self._watched or namespace in self._starting:
+            return False
+        previous = self._watermarks.get(namespace)
+        return previous is None or time.time() - previous[1] >= self.check_interval
+
+    def _has_watermark_index(self, index_information: Dict[str, Any]) -> bool:
+        return any(index["key"][0][0] == self.watermark_field for index in index_information.values())
+
+    def _watermark_query(self):
+        return {"projection": {"_id": 0, self.watermark_field: 1}, "sort": [(self.watermark_field, -1)],
+                "max_time_ms": self.watermark_max_time_ms}
+
+    def _start_watching(self, namespace: str) -> bool:
+        with self._lock:
+            if namespace in self._watchers:
+                return False
+            self._watchers.add(namespace)
+            self._starting.add(namespace)
+            return True
+
+    def _watch(self, collection, namespace: str):
+        try:
+            with collection.watch() as stream:
+                self._watched.add(namespace)
+                self._starting.discard(namespace)
+                # Results cached before the stream opened may already be stale
+                self.invalidate(namespace)
+                for _ in stream:
+                    self.invalidate(namespace)
+        except PyMongoError as e:
+            print(f"Change stream on {namespace} unavailable ({e}); using write watermarks")
+        finally:
+            self._watched.discard(namespace)
+            self._starting.discard(namespace)
+
+    def _read_watermark(self, collection, namespace: str) -> Any:
+        if namespace not in self._watermark_indexed:
+            self._watermark_indexed[namespace] = self._has_watermark_index(collection.index_information())
+        # Document count catches inserts and deletes
+        count = collection.estimated_document_count(maxTimeMS=self.watermark_max_time_ms)
+        if not self._watermark_indexed[namespace]:
+            # Sorting on an unindexed field would scan the collection; updates are left to the TTL
+            return count
+        # The watermark field catches updates
+        latest = collection.find_one({}, **self._watermark_query())
+        return count, json_util.dumps(latest)
+
+    def ensure_invalidation(self, collection):
+        """Keep cached results of a pymongo collection fresh: change stream if possible, watermark otherwise"""
+        namespace = collection.full_name
+        if self._start_watching(namespace):
+            threading.Thread(target=self._watch, args=(collection, namespace), daemon=True).start()
+        if self._needs_watermark_check(namespace):
+            try:
+                self._observe_watermark(namespace, self._read_watermark(collection, namespace))
+            except PyMongoError as e:
+                print(f"Write watermark of {namespace} unavailable ({e})")
+                self._postpone_watermark_check(namespace)
+
+    async def _awatch(self, collection, namespace: str):
+        try:
+            async with collection.watch() as stream:
+                self._watched.add(namespace)
+                self._starting.discard(namespace)
+                self.invalidate(namespace)
+                async for _ in stream:
+                    self.invalidate(namespace)
+        except PyMongoError as e:
+            print(f"Change stream on {namespace} unavailable ({e}); using write watermarks")
+        finally:
+            self._watched.discard(namespace)
+            self._starting.discard(namespace)
+
+    async def _aread_watermark(self, collection, namespace: str) -> Any:
+        if namespace not in self._watermark_indexed:
+            self._watermark_indexed[namespace] = self._has_watermark_index(await collection.index_information())
+        count = await collection.estimated_document_count(maxTimeMS=self.watermark_max_time_ms)
+        if not self._watermark_indexed[namespace]:
+            return count
+        latest = await collection.find_one({}, **self._watermark_query())
+        return count, json_util.dumps(latest)
+
+    async def aensure_invalidation(self, collection):
+        """Async (Motor) variant of ensure_invalidation()"""
+        namespace = collection.full_name
+        if self._start_watching(namespace):
+            task = asyncio.get_running_loop().create_task(self._awatch(collection, namespace))
+            # Keep a reference so the task is not garbage collected
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._needs_watermark_check(namespace):
+            try:
+                self._observe_watermark(namespace, await self._aread_watermark(collection, namespace))
+            except PyMongoError as e:
+                print(f"Write watermark of {namespace} unavailable ({e})")
+                self._postpone_watermark_check(namespace)
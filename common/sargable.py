@@ -0,0 +1,441 @@
+import os
+import re
+import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from dotenv import load_dotenv
+from common.pipeline_optimizer import overlaps, project_spec
+
+# Load environment variables
+load_dotenv()
+
+SARGABLE_REWRITE = os.getenv("SARGABLE_REWRITE", "true").lower() in ("1", "true", "yes")
+
+COMPARISONS = {"$eq", "$gt", "$gte", "$lt", "$lte"}
+FLIPPED = {"$eq": "$eq", "$gt": "$lt", "$gte": "$lte", "$lt": "$gt", "$lte": "$gte"}
+DATE_PARTS = {"$year": "year", "$month": "month", "$dayOfMonth": "day"}
+# $dateToString formats whose output sorts like the date, so a string comparison is a date range
+PERIOD_FORMATS = {"%Y": "year", "%Y-%m": "month", "%Y-%m-%d": "day"}
+UTC_NAMES = {"UTC", "GMT", "Etc/UTC", "Z", "+00:00", "+0000", "00:00"}
+SIMPLE_DATE_FORMAT = re.compile(r"(?:%[YmdHMS]|[^%])*")
+
+# Generated queries that defeat an index on createdOn, for python -m common.sargable
+CORPUS = [
+    ("month and year of createdOn", "find", {"$expr": {"$and": [
+        {"$eq": [{"$month": "$createdOn"}, 4]},
+        {"$eq": [{"$year": "$createdOn"}, 2025]}
+    ]}}),
+    ("year of createdOn", "find", {"$expr": {"$eq": [{"$year": "$createdOn"}, 2024]}}),
+    ("years before 2024 (missing dates match too)", "count", {"$expr": {"$lt": [{"$year": "$createdOn"}, 2024]}}),
+    ("$dateToString month", "find", {"$expr": {"$eq": [{"$dateToString": {"format": "%Y-%m", "date": "$createdOn"}}, "2025-04"]}}),
+    ("$dateToString day range", "find", {"status": "completed", "$expr": {"$and": [
+        {"$gte": [{"$dateToString": {"format": "%Y-%m-%d", "date": "$createdOn"}}, "2025-03-15"]},
+        {"$lte": [{"$dateToString": {"format": "%Y-%m-%d", "date": "$createdOn"}}, "2025-03-31"]}
+    ]}}),
+    ("$dateFromString bound", "find", {"$expr": {"$gte": ["$createdOn", {"$dateFromString": {"dateString": "2025-04-01T00:00:00Z"}}]}}),
+    ("year range with a month filter", "find", {"$expr": {"$and": [
+        {"$gte": [{"$year": "$createdOn"}, 2024]},
+        {"$in": [{"$month": "$createdOn"}, [1, 2, 3]]}
+    ]}}),
+    ("computed year/month fields", "aggregate", [
+        {"$addFields": {"year": {"$year": "$createdOn"}, "month": {"$month": "$createdOn"}}},
+        {"$match": {"year": 2025, "month": 4}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]),
+]
+
+
+class DateConstraint:
+    """One comparison of a function of a date field with a constant"""
+
+    def __init__(self, field: str, kind: str, op: str, value: Any, null_matches: bool, source: Any, label: str):
+        self.field = field
+        self.kind = kind  # "date", "year", "month", "day" or a PERIOD_FORMATS format
+        self.op = op
+        self.value = value
+        self.null_matches = null_matches  # whether a missing or null field satisfies the original predicate
+        self.source = source  # the $expr conjunct or alias key it came from
+        self.label = label
+
+
+def _utc(arguments: Dict[str, Any]) -> bool:
+    return arguments.get("timezone", "UTC") in UTC_NAMES
+
+
+def _field_ref(value: Any) -> Optional[str]:
+    if isinstance(value, str) and value.startswith("$") and not value.startswith("$$"):
+        return value[1:]
+    return None
+
+
+def date_function(expression: Any) -> Optional[Tuple[str, str]]:
+    """(field, kind) for "$field", {"$year": "$field"}, ... or a sortable {"$dateToString": ...} of a field"""
+    field = _field_ref(expression)
+    if field:
+        return field, "date"
+    if not isinstance(expression, dict) or len(expression) != 1:
+        return None
+    op, argument = next(iter(expression.items()))
+    if op in DATE_PARTS:
+        if isinstance(argument, list) and len(argument) == 1:
+            argument = argument[0]
+        if isinstance(argument, dict):
+            if not _utc(argument):
+                return None
+            argument = argument.get("date")
+        field = _field_ref(argument)
+        return (field, DATE_PARTS[op]) if field else None
+    if (op == "$dateToString" and isinstance(argument, dict) and _utc(argument) and "onNull" not in argument
+            and argument.get("format") in PERIOD_FORMATS):
+        field = _field_ref(argument.get("date"))
+        return (field, argument["format"]) if field else None
+    return None
+
+
+def _parse_iso(text: str) -> Optional[datetime.datetime]:
+    try:
+        value = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return _naive_utc(value)
+
+
+def _naive_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def constant_date(value: Any) -> Optional[datetime.datetime]:
+    """The UTC datetime of a constant date expression ({"$date": ...}, $toDate, $dateFromString), else None"""
+    if isinstance(value, datetime.datetime):
+        return _naive_utc(value)
+    if not isinstance(value, dict) or len(value) != 1:
+        return None
+    op, argument = next(iter(value.items()))
+    if op in ("$date", "$toDate") and isinstance(argument, str):
+        return _parse_iso(argument)
+    if op == "$dateFromString" and isinstance(argument, dict) and isinstance(argument.get("dateString"), str) and _utc(argument):
+        date_format = argument.get("format")
+        if date_format is None:
+            return _parse_iso(argument["dateString"])
+        if SIMPLE_DATE_FORMAT.fullmatch(date_format):
+            try:
+                return datetime.datetime.strptime(argument["dateString"], date_format)
+            except ValueError:
+                return None
+    return None
+
+
+def _period(kind: str, value: Any) -> Optional[Tuple[datetime.datetime, datetime.datetime]]:
+    """[start, end) of the year/month/day a comparison constant names, if it is in canonical form"""
+    if kind == "year":
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value < 9999:
+            return None
+        return datetime.datetime(value, 1, 1), datetime.datetime(value + 1, 1, 1)
+    if not isinstance(value, str):
+        return None
+    try:
+        start = datetime.datetime.strptime(value, kind)
+    except ValueError:
+        return None
+    if start.strftime(kind) != value or start.year >= 9999:
+        return None  # "2025-4" sorts differently from what $dateToString produces
+    return _period_of(PERIOD_FORMATS[kind], start)
+
+
+def _period_of(unit: str, start: datetime.datetime) -> Tuple[datetime.datetime, datetime.datetime]:
+    if unit == "year":
+        return start, start.replace(year=start.year + 1)
+    if unit == "month":
+        return start, (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start, start + datetime.timedelta(days=1)
+
+
+def _period_bounds(op: str, start: datetime.datetime, end: datetime.datetime) -> List[Tuple[str, datetime.datetime]]:
+    return {
+        "$eq": [("$gte", start), ("$lt", end)],
+        "$gte": [("$gte", start)],
+        "$gt": [("$gte", end)],
+        "$lt": [("$lt", start)],
+        "$lte": [("$lt", end)]
+    }[op]
+
+
+def _label(kind: str) -> str:
+    return {"date": "date comparison", "year": "$year", "month": "$month", "day": "$dayOfMonth"}.get(kind, f"$dateToString {kind}")
+
+
+def expression_constraint(expression: Any) -> Optional[DateConstraint]:
+    """Constraint for an $expr comparison such as {"$eq": [{"$year": "$createdOn"}, 2025]}"""
+    if not isinstance(expression, dict) or len(expression) != 1:
+        return None
+    op, arguments = next(iter(expression.items()))
+    if op not in COMPARISONS or not isinstance(arguments, list) or len(arguments) != 2:
+        return None
+    for function, constant, operator in ((arguments[0], arguments[1], op), (arguments[1], arguments[0], FLIPPED[op])):
+        found = date_function(function)
+        if not found or isinstance(constant, str) and constant.startswith("$"):
+            continue
+        if isinstance(constant, (dict, list)) and constant_date(constant) is None:
+            continue
+        # In $expr a missing or null value sorts below every constant
+        return DateConstraint(found[0], found[1], operator, constant, operator in ("$lt", "$lte"), expression,
+                              _label(found[1]))
+    return None
+
+
+def _alias_constraints(alias: str, function: Tuple[str, str], value: Any) -> Optional[List[DateConstraint]]:
+    """Constraints for a query on a field computed by a date function, e.g. {"year": 2025} after $addFields"""
+    if isinstance(value, dict):
+        if not value or any(op not in COMPARISONS or isinstance(item, (dict, list)) for op, item in value.items()):
+            return None
+        comparisons = list(value.items())
+    elif value is None or isinstance(value, list):
+        return None
+    else:
+        comparisons = [("$eq", value)]
+    # Query operators never match a missing or null field against a constant
+    return [DateConstraint(function[0], function[1], op, item, False, alias, f"{alias} ({_label(function[1])})")
+            for op, item in comparisons]
+
+
+def _conjuncts(expression: Any) -> List[Any]:
+    if isinstance(expression, dict) and list(expression) == ["$and"] and isinstance(expression["$and"], list):
+        return [item for conjunct in expression["$and"] for item in _conjuncts(conjunct)]
+    return [expression]
+
+
+def _combine(constraints: List[DateConstraint]) -> Tuple[Dict[str, Dict[str, Any]], List[DateConstraint]]:
+    """Turn constraints into per-field bounds; returns (field -> {"bounds", "null_matches", "labels"}, consumed)"""
+    fields: Dict[str, Dict[str, Any]] = {}
+    consumed = []
+
+    def bound(field: str, used: List[DateConstraint], bounds: List[Tuple[str, datetime.datetime]]):
+        entry = fields.setdefault(field, {"bounds": {}, "null_matches": True, "labels": []})
+        for op, value in bounds:
+            current = entry["bounds"].get(op)
+            if current is None or (value > current if op in ("$gt", "$gte") else value < current):
+                entry["bounds"][op] = value
+        entry["null_matches"] = entry["null_matches"] and all(constraint.null_matches for constraint in used)
+        entry["labels"].extend(constraint.label for constraint in used if constraint.label not in entry["labels"])
+        consumed.extend(used)
+
+    by_field: Dict[str, List[DateConstraint]] = {}
+    for constraint in constraints:
+        by_field.setdefault(constraint.field, []).append(constraint)
+
+    for field, field_constraints in by_field.items():
+        parts = {"year": [], "month": [], "day": []}
+        for constraint in field_constraints:
+            if constraint.kind == "date":
+                value = constant_date(constraint.value)
+                if value is not None:
+                    ops = [("$gte", value), ("$lte", value)] if constraint.op == "$eq" else [(constraint.op, value)]
+                    bound(field, [constraint], ops)
+            elif constraint.kind in PERIOD_FORMATS:
+                period = _period(constraint.kind, constraint.value)
+                if period:
+                    bound(field, [constraint], _period_bounds(constraint.op, *period))
+            else:
+                parts[constraint.kind].append(constraint)
+
+        # A month (and day) only narrows to one range together with an exact year
+        equal = {kind: [c for c in parts[kind] if c.op == "$eq" and isinstance(c.value, int) and not isinstance(c.value, bool)]
+                 for kind in parts}
+        years = {c.value for c in equal["year"]}
+        months = {c.value for c in equal["month"]}
+        days = {c.value for c in equal["day"]}
+        if len(years) == 1 and len(months) == 1 and 1 <= next(iter(months)) <= 12 and 1 <= next(iter(years)) < 9999:
+            year, month = next(iter(years)), next(iter(months))
+            try:
+                if len(days) == 1:
+                    start = datetime.datetime(year, month, next(iter(days)))
+                    bound(field, equal["year"] + equal["month"] + equal["day"], _period_bounds("$eq", *_period_of("day", start)))
+                else:
+                    bound(field, equal["year"] + equal["month"], _period_bounds("$eq", *_period_of("month", datetime.datetime(year, month, 1))))
+            except ValueError:
+                pass  # e.g. February 30th: leave the original predicate to match nothing
+        for constraint in parts["year"]:
+            if constraint in consumed:
+                continue
+            period = _period("year", constraint.value)
+            if period:
+                bound(field, [constraint], _period_bounds(constraint.op, *period))
+    return fields, consumed
+
+
+def date_literal(value: datetime.datetime) -> Dict[str, str]:
+    """Extended JSON date, like the rest of a generated query; the engines convert it before running"""
+    text = value.isoformat(timespec="milliseconds" if value.microsecond else "seconds")
+    return {"$date": text + "Z"}
+
+
+def rewrite_filter(spec: Any, aliases: Optional[Dict[str, Tuple[str, str]]] = None) -> Tuple[Any, List[str]]:
+    """Rewrite date-function predicates of a query filter into range predicates on the date field"""
+    if not isinstance(spec, dict):
+        return spec, []
+    aliases = aliases or {}
+    rewrites = []
+    kept = {}
+    and_clauses = []
+    expressions = []
+    constraints = []
+    alias_sources = {}
+    for key, value in spec.items():
+        if key == "$expr":
+            for conjunct in _conjuncts(value):
+                constraint = expression_constraint(conjunct)
+                if constraint:
+                    constraints.append(constraint)
+                else:
+                    expressions.append(conjunct)
+        elif key == "$and" and isinstance(value, list):
+            for clause in value:
+                clause, clause_rewrites = rewrite_filter(clause, aliases)
+                and_clauses.append(clause)
+                rewrites.extend(clause_rewrites)
+        elif key in ("$or", "$nor") and isinstance(value, list):
+            branches = []
+            for branch in value:
+                branch, branch_rewrites = rewrite_filter(branch, aliases)
+                branches.append(branch)
+                rewrites.extend(branch_rewrites)
+            kept[key] = branches
+        elif key in aliases and _alias_constraints(key, aliases[key], value) is not None:
+            alias_sources[key] = value
+            constraints.extend(_alias_constraints(key, aliases[key], value))
+        else:
+            kept[key] = value
+
+    fields, consumed = _combine(constraints)
+    if not fields and not rewrites:
+        return spec, []
+    for constraint in constraints:
+        if constraint not in consumed:
+            if isinstance(constraint.source, str):
+                # Part of an alias predicate is still needed, so keep all of it
+                kept[constraint.source] = alias_sources[constraint.source]
+            else:
+                expressions.append(constraint.source)
+
+    rewritten = dict(kept)
+    for field, entry in fields.items():
+        bounds = {op: date_literal(value) for op, value in entry["bounds"].items()}
+        if entry["null_matches"]:
+            and_clauses.append({"$or": [{field: bounds}, {field: None}]})
+        elif field in rewritten:
+            and_clauses.append({field: bounds})
+        else:
+            rewritten[field] = bounds
+        rewrites.append(f"{' + '.join(entry['labels'])} on {field} -> range on {field}")
+    if expressions:
+        rewritten["$expr"] = expressions[0] if len(expressions) == 1 else {"$and": expressions}
+    if len(and_clauses) == 1 and not set(and_clauses[0]) & set(rewritten):
+        rewritten.update(and_clauses[0])
+    elif and_clauses:
+        rewritten["$and"] = and_clauses
+    return rewritten, rewrites
+
+
+def _update_aliases(aliases: Dict[str, Tuple[str, str]], name: str, spec: Any) -> Dict[str, Tuple[str, str]]:
+    """Date-function aliases still valid after a stage: alias field -> (source field, kind)"""
+    if name in ("$match", "$sort", "$limit", "$skip"):
+        return aliases
+    if name in ("$addFields", "$set") and isinstance(spec, dict):
+        for key, value in spec.items():
+            # Redefining a field drops aliases computed from it, and any alias of the same name
+            aliases = {alias: function for alias, function in aliases.items()
+                       if not overlaps(alias, key) and not overlaps(function[0], key)}
+            function = date_function(value)
+            if function and function[1] != "date":
+                aliases[key] = function
+        return aliases
+    if name == "$project" and isinstance(spec, dict):
+        parts = project_spec(spec)
+        if parts is None:
+            return {}
+        included, excluded, computed = parts
+        if not included and not computed:
+            return {alias: function for alias, function in aliases.items()
+                    if not any(overlaps(alias, key) or overlaps(function[0], key) for key in excluded)}
+        # The range replaces a predicate on the alias, so the source field has to survive the projection
+        def kept(field: str) -> bool:
+            return any(field == key or field.startswith(key + ".") for key in included)
+
+        result = {alias: function for alias, function in aliases.items() if alias in included and kept(function[0])}
+        for key, value in computed.items():
+            function = date_function(value)
+            if function and function[1] != "date" and kept(function[0]):
+                result[key] = function
+        return result
+    return {}
+
+
+def rewrite_pipeline(pipeline: List[Any]) -> Tuple[List[Any], List[str]]:
+    """Rewrite every $match of a pipeline, including matches on fields computed by date functions"""
+    rewritten = []
+    rewrites = []
+    aliases: Dict[str, Tuple[str, str]] = {}
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            rewritten.append(stage)
+            aliases = {}
+            continue
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            spec, stage_rewrites = rewrite_filter(spec, aliases)
+            stage = {"$match": spec}
+            rewrites.extend(stage_rewrites)
+        aliases = _update_aliases(aliases, name, spec)
+        rewritten.append(stage)
+    return rewritten, rewrites
+
+
+def rewrite_query(query_type: str, query: Any) -> Tuple[Any, List[str]]:
+    """Make a generated query's date predicates index-friendly; returns (query, description of each rewrite)"""
+    if not SARGABLE_REWRITE:
+        return query, []
+    if query_type == "aggregate" and isinstance(query, list):
+        return rewrite_pipeline(query)
+    if query_type == "distinct" and isinstance(query, dict) and isinstance(query.get("filter"), dict):
+        filter_query, rewrites = rewrite_filter(query["filter"])
+        return {**query, "filter": filter_query}, rewrites
+    if query_type in ("find", "count"):
+        return rewrite_filter(query)
+    return query, []
+
+
+if __name__ == "__main__":
+    # Show each corpus query's plan before and after rewriting (needs an index on createdOn):
+    #   python -m common.sargable [collection]
+    import sys
+    import json
+    from bson import json_util
+    from common.database import get_client
+    from common.query_guard import plan_summary
+
+    def explain(collection, query_type: str, query: Any) -> str:
+        query = json_util.loads(json.dumps(query))  # {"$date": ...} literals to datetimes
+        if query_type == "aggregate":
+            command = {"aggregate": collection.name, "pipeline": query, "cursor": {}}
+        elif query_type == "count":
+            command = {"count": collection.name, "query": query}
+        else:
+            command = {"find": collection.name, "filter": query}
+        plan = plan_summary(collection.database.command({"explain": command, "verbosity": "queryPlanner"}))
+        scan = "COLLSCAN" if "COLLSCAN" in plan["stages"] else "IXSCAN" if "IXSCAN" in plan["stages"] else "/".join(plan["stages"])
+        return scan + (f" ({', '.join(plan['indexes'])})" if plan["indexes"] else "")
+
+    collection = None
+    if os.getenv("MONGO_URL") and os.getenv("MONGO_DB"):
+        collection = get_client(os.getenv("MONGO_URL"))[os.getenv("MONGO_DB")][sys.argv[1] if len(sys.argv) > 1 else "portcalls"]
+
+    for title, query_type, query in CORPUS:
+        rewritten, rewrites = rewrite_query(query_type, query)
+        print(f"{title}:")
+        print(f"  before: {json.dumps(query)}")
+        print(f"  after:  {json.dumps(rewritten)}")
+        print(f"  rewrites: {'; '.join(rewrites) or 'none'}")
+        if collection is not None:
+            print(f"  plan: {explain(collection, query_type, query)} -> {explain(collection, query_type, rewritten)}")
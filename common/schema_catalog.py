@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import threading
+from typing import Dict, Any, Optional
+
+from dotenv import load_dotenv
+from common.query_cache import schema_fingerprint
+
+# Load environment variables
+load_dotenv()
+
+SCHEMA_CATALOG_PATH = os.getenv("SCHEMA_CATALOG_PATH", os.path.join("cache", "schema_catalog.json"))
+# Entries older than this are served immediately but re-analyzed in the background
+SCHEMA_CATALOG_MAX_AGE = int(os.getenv("SCHEMA_CATALOG_MAX_AGE", "86400"))
+CATALOG_VERSION = 1
+
+
+class SchemaCatalog:
+    """Local JSON catalog of analyzed collection metadata, so engines start without re-sampling"""
+
+    def __init__(self, database_name: str, path: str = SCHEMA_CATALOG_PATH, max_age: int = SCHEMA_CATALOG_MAX_AGE):
+        self.database_name = database_name
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = self._read().get(database_name, {})
+
+    def _read(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                catalog = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable schema catalog {self.path}: {e}")
+            return {}
+        if catalog.get("version") != CATALOG_VERSION:
+            return {}
+        return catalog.get("databases", {})
+
+    def get(self, collection_name: str) -> Optional[Dict[str, Any]]:
+        """Return cached metadata for a collection, or None"""
+        entry = self._entries.get(collection_name)
+        return entry["metadata"] if entry else None
+
+    def is_stale(self, collection_name: str) -> bool:
+        entry = self._entries.get(collection_name)
+        return entry is None or time.time() - entry["analyzed_at"] > self.max_age
+
+    def put(self, collection_name: str, metadata: Dict[str, Any]):
+        """Record metadata for a collection and persist the catalog"""
+        fingerprint = schema_fingerprint(metadata)
+        previous = self._entries.get(collection_name)
+        if previous and previous["fingerprint"] != fingerprint:
+            print(f"Schema of {collection_name} changed since it was last analyzed")
+
+        entry = {"analyzed_at": time.time(), "fingerprint": fingerprint, "metadata": metadata}
+        with self._lock:
+            self._entries[collection_name] = entry
+
+            # Merge with the file on disk so other databases and processes are not clobbered
+            databases = self._read()
+            databases.setdefault(self.database_name, {})[collection_name] = entry
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": CATALOG_VERSION, "databases": databases}, f, default=str)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,327 @@
+import os
+import datetime
+from typing import List, Dict, Any, Callable, Optional, Set, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure
+
+# Load environment variables
+load_dotenv()
+
+SCHEMA_SAMPLE_BATCH = int(os.getenv("SCHEMA_SAMPLE_BATCH", "100"))
+SCHEMA_SAMPLE_MAX = int(os.getenv("SCHEMA_SAMPLE_MAX", "2000"))
+# Stop sampling after this many consecutive batches add no new field or type
+SCHEMA_SAMPLE_PATIENCE = int(os.getenv("SCHEMA_SAMPLE_PATIENCE", "2"))
+# Comma-separated top-level fields left out of sampled documents (large blobs the schema does not need)
+SCHEMA_SAMPLE_EXCLUDE = [field.strip() for field in os.getenv("SCHEMA_SAMPLE_EXCLUDE", "").split(",") if field.strip()]
+# Array elements inspected per array value when discovering the fields of arrays of objects
+SCHEMA_ARRAY_SAMPLE = int(os.getenv("SCHEMA_ARRAY_SAMPLE", "50"))
+
+
+def _type_name(value: Any) -> str:
+    if isinstance(value, datetime.datetime):
+        return "datetime"
+    if isinstance(value, ObjectId):
+        return "objectid"
+    return type(value).__name__
+
+
+def _analyze_value(obj: Dict[str, Any], fields: Dict[str, Any], prefix: str, seen: Set[Tuple[str, str]],
+                   array_sample: int):
+    for key, value in obj.items():
+        field_name = f"{prefix}{key}"
+        info = fields.get(field_name)
+        if info is None:
+            info = fields[field_name] = {"types": set(), "examples": [], "documents": 0, "type_counts": {}}
+
+        value_type = _type_name(value)
+        info["types"].add(value_type)
+
+        # Presence and type counts are per document, however many array elements hold the path
+        if (field_name, "") not in seen:
+            seen.add((field_name, ""))
+            info["documents"] += 1
+        if (field_name, value_type) not in seen:
+            seen.add((field_name, value_type))
+            info["type_counts"][value_type] = info["type_counts"].get(value_type, 0) + 1
+
+        # Store examples for non-ID fields
+        if field_name != "_id" and len(info["examples"]) < 3:
+            info["examples"].append(str(value))
+
+        if isinstance(value, dict):
+            _analyze_value(value, fields, f"{field_name}.", seen, array_sample)
+        elif isinstance(value, list):
+            # Merge every (bounded) element, so fields only present in later elements are found too
+            for item in value[:array_sample]:
+                if isinstance(item, dict):
+                    _analyze_value(item, fields, f"{field_name}[].", seen, array_sample)
+
+
+def analyze_document(doc: Dict[str, Any], fields: Dict[str, Any], array_sample: int = SCHEMA_ARRAY_SAMPLE):
+    """Fold one document's field paths, types and examples into fields, including all array elements"""
+    _analyze_value(doc, fields, "", set(), array_sample)
+
+
+def summarize_fields(fields: Dict[str, Any], document_count: int) -> Dict[str, Any]:
+    """Turn per-field document counts into presence frequencies over the analyzed documents"""
+    for info in fields.values():
+        if "documents" in info:
+            info["presence"] = round(info.pop("documents") / max(document_count, 1), 4)
+    return fields
+
+
+def schema_signature(fields: Dict[str, Any]) -> Set[Tuple[str, str]]:
+    """The (field, type) pairs seen so far; sampling has converged when this stops growing"""
+    return {(field, value_type) for field, info in fields.items() for value_type in info["types"]}
+
+
+class SchemaSampler:
+    """Random-sample schema inference that stops once the field/type set converges"""
+
+    def __init__(
+        self,
+        analyze: Callable[[Dict[str, Any], Dict[str, Any]], None] = analyze_document,
+        batch_size: int = SCHEMA_SAMPLE_BATCH,
+        max_documents: int = SCHEMA_SAMPLE_MAX,
+        patience: int = SCHEMA_SAMPLE_PATIENCE,
+        exclude: Optional[List[str]] = None
+    ):
+        self.analyze = analyze  # folds one document into the fields dict
+        self.batch_size = batch_size
+        self.max_documents = max_documents
+        self.patience = patience
+        self.exclude = SCHEMA_SAMPLE_EXCLUDE if exclude is None else exclude
+
+    def _pipeline(self, size: int) -> List[Dict[str, Any]]:
+        pipeline = [{"$sample": {"size": size}}]
+        if self.exclude:
+            pipeline.append({"$project": {field: 0 for field in self.exclude}})
+        return pipeline
+
+    def _start(self):
+        return {"docs": [], "seen_ids": set(), "fields": {}, "signature": set(), "quiet": 0, "batch": self.batch_size}
+
+    def _add_batch(self, state: Dict[str, Any], batch: List[Dict[str, Any]], requested: int) -> bool:
+        """Fold a sampled batch into the state; return True when sampling should stop"""
+        new_docs = [doc for doc in batch if doc.get("_id") not in state["seen_ids"]]
+        for doc in new_docs:
+            state["seen_ids"].add(doc.get("_id"))
+            state["docs"].append(doc)
+            self.analyze(doc, state["fields"])
+
+        signature = schema_signature(state["fields"])
+        if signature - state["signature"]:
+            # New fields or types keep appearing, so look at more documents per round
+            state["signature"] = signature
+            state["quiet"] = 0
+            state["batch"] *= 2
+        else:
+            state["quiet"] += 1
+
+        # $sample returns fewer documents than asked once it has seen the whole (small) collection
+        exhausted = not new_docs or len(batch) < requested
+        return exhausted or state["quiet"] >= self.patience or len(state["docs"]) >= self.max_documents
+
+    def _next_size(self, state: Dict[str, Any]) -> int:
+        return max(1, min(state["batch"], self.max_documents - len(state["docs"])))
+
+    def _finish(self, state: Dict[str, Any], collection_name: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        print(f"Sampled {len(state['docs'])} documents from {collection_name}: {len(state['fields'])} fields")
+        return state["docs"], summarize_fields(state["fields"], len(state["docs"]))
+
+    def run(self, collection) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Sample a pymongo collection; returns (sampled documents, fields)"""
+        state = self._start()
+        while True:
+            size = self._next_size(state)
+            batch = list(collection.aggregate(self._pipeline(size)))
+            if self._add_batch(state, batch, size):
+                return self._finish(state, collection.name)
+
+    async def arun(self, collection) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Async (Motor) variant of run()"""
+        state = self._start()
+        while True:
+            size = self._next_size(state)
+            batch = await collection.aggregate(self._pipeline(size)).to_list(length=None)
+            if self._add_batch(state, batch, size):
+                return self._finish(state, collection.name)
+
+
+# "server" infers the schema with an aggregation and only ships the summary back; "sample" analyzes
+# sampled documents in Python. Server inference falls back to sampling on servers that reject it.
+SCHEMA_INFERENCE_MODE = os.getenv("SCHEMA_INFERENCE_MODE", "server")
+SCHEMA_SERVER_SAMPLE = int(os.getenv("SCHEMA_SERVER_SAMPLE", "1000"))
+SCHEMA_MAX_DEPTH = int(os.getenv("SCHEMA_MAX_DEPTH", "6"))
+
+# $type names mapped to the Python type names the document analyzer records
+BSON_TYPE_NAMES = {
+    "double": "float",
+    "string": "str",
+    "object": "dict",
+    "array": "list",
+    "binData": "bytes",
+    "objectId": "objectid",
+    "bool": "bool",
+    "date": "datetime",
+    "null": "NoneType",
+    "regex": "Regex",
+    "javascript": "Code",
+    "int": "int",
+    "timestamp": "Timestamp",
+    "long": "Int64",
+    "decimal": "Decimal128",
+    "minKey": "MinKey",
+    "maxKey": "MaxKey",
+}
+
+
+class ServerSchemaInference:
+    """Schema inference in the database: field paths, type histograms and presence via $objectToArray/$type"""
+
+    def __init__(self, sample_size: int = SCHEMA_SERVER_SAMPLE, max_depth: int = SCHEMA_MAX_DEPTH,
+                 array_sample: int = SCHEMA_ARRAY_SAMPLE):
+        self.sample_size = sample_size
+        self.max_depth = max_depth
+        self.array_sample = array_sample
+
+    @staticmethod
+    def _key_value_pairs(values: Any, prefix: str, parent: int) -> Dict[str, Any]:
+        """Expression flattening every object in the array expression `values` into {k, v, p} pairs"""
+        return {"$reduce": {
+            "input": values,
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", {"$cond": [
+                {"$eq": [{"$type": "$$this"}, "object"]},
+                {"$map": {
+                    "input": {"$objectToArray": "$$this"},
+                    "as": "kv",
+                    "in": {"k": {"$concat": [prefix, "$$kv.k"]}, "v": "$$kv.v", "p": parent}
+                }},
+                []
+            ]}]}
+        }}
+
+    def _child_values(self, values: Any, key: str, is_array: bool) -> Dict[str, Any]:
+        """Expression for the values of `key` under every object in `values`, flattening arrays"""
+        if not is_array:
+            return {"$map": {"input": values, "as": "o", "in": f"$$o.{key}"}}
+        return {"$reduce": {
+            "input": {"$map": {"input": values, "as": "o", "in": {"$cond": [
+                {"$isArray": f"$$o.{key}"}, {"$slice": [f"$$o.{key}", self.array_sample]}, []
+            ]}}},
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", "$$this"]}
+        }}
+
+    def _sample_pipeline(self) -> List[Dict[str, Any]]:
+        return [{"$sample": {"size": self.sample_size}}, {"$project": {"_id": 1}}]
+
+    def _level_pipeline(self, ids: List[Any], parents: List[Tuple[Any, str]]) -> List[Dict[str, Any]]:
+        pairs = [self._key_value_pairs(values, prefix, index) for index, (values, prefix) in enumerate(parents)]
+        return [
+            # Every level reads the same sampled documents, so child paths and presence ratios line up
+            {"$match": {"_id": {"$in": ids}}},
+            {"$project": {"pairs": {"$concatArrays": pairs}}},
+            {"$unwind": "$pairs"},
+            # One row per (path, type, document) so counts are documents containing the path
+            {"$group": {
+                "_id": {"path": "$pairs.k", "type": {"$type": "$pairs.v"}, "parent": "$pairs.p", "doc": "$_id"},
+                "example": {"$first": "$pairs.v"},
+                "has_objects": {"$max": {"$cond": [
+                    {"$and": [
+                        {"$isArray": "$pairs.v"},
+                        {"$in": ["object", {"$map": {
+                            "input": {"$slice": ["$pairs.v", self.array_sample]}, "as": "e", "in": {"$type": "$$e"}
+                        }}]}
+                    ]}, True, False
+                ]}}
+            }},
+            {"$group": {
+                "_id": {"path": "$_id.path", "type": "$_id.type", "parent": "$_id.parent"},
+                "documents": {"$sum": 1},
+                "examples": {"$firstN": {"input": "$example", "n": 3}},
+                "has_objects": {"$max": "$has_objects"}
+            }}
+        ]
+
+    def _start(self, ids: List[Any]):
+        return {"fields": {}, "parents": [(["$$ROOT"], "")], "depth": 0, "ids": ids, "sampled": len(ids)}
+
+    def _add_level(self, state: Dict[str, Any], rows: List[Dict[str, Any]]) -> bool:
+        """Fold one level's rows into the fields; return True when there is nothing left to expand"""
+        fields = state["fields"]
+        parents = state["parents"]
+        next_parents = {}
+        for row in rows:
+            path, bson_type = row["_id"]["path"], row["_id"]["type"]
+            value_type = BSON_TYPE_NAMES.get(bson_type, bson_type)
+            info = fields.setdefault(path, {"types": set(), "examples": [], "documents": 0, "type_counts": {}})
+            info["types"].add(value_type)
+            info["type_counts"][value_type] = info["type_counts"].get(value_type, 0) + row["documents"]
+            # A path can hold several types across documents, so the largest type count is a lower bound on presence
+            info["documents"] = max(info["documents"], row["documents"])
+            if path != "_id":
+                for example in row["examples"]:
+                    if len(info["examples"]) < 3:
+                        info["examples"].append(str(example))
+
+            values, prefix = parents[row["_id"]["parent"]]
+            key = path[len(prefix):]
+            if "." in key or key.startswith("$"):
+                continue  # not addressable with a field path expression
+            if bson_type == "object":
+                next_parents[f"{path}."] = self._child_values(values, key, is_array=False)
+            elif bson_type == "array" and row["has_objects"]:
+                next_parents[f"{path}[]."] = self._child_values(values, key, is_array=True)
+
+        state["parents"] = [(values, prefix) for prefix, values in next_parents.items()]
+        state["depth"] += 1
+        return not state["parents"] or state["depth"] >= self.max_depth
+
+    def _finish(self, state: Dict[str, Any], sample_docs: List[Dict[str, Any]], collection_name: str):
+        print(f"Inferred {len(state['fields'])} fields of {collection_name} server-side from {state['sampled']} documents")
+        return sample_docs, summarize_fields(state["fields"], state["sampled"])
+
+    def run(self, collection) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Infer the schema of a pymongo collection; returns (one sample document, fields)"""
+        state = self._start([doc["_id"] for doc in collection.aggregate(self._sample_pipeline())])
+        while True:
+            cursor = collection.aggregate(self._level_pipeline(state["ids"], state["parents"]), allowDiskUse=True)
+            if self._add_level(state, list(cursor)):
+                break
+        sample_docs = list(collection.aggregate([{"$sample": {"size": 1}}]))
+        return self._finish(state, sample_docs, collection.name)
+
+    async def arun(self, collection) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Async (Motor) variant of run()"""
+        ids = [doc["_id"] for doc in await collection.aggregate(self._sample_pipeline()).to_list(length=None)]
+        state = self._start(ids)
+        while True:
+            cursor = collection.aggregate(self._level_pipeline(state["ids"], state["parents"]), allowDiskUse=True)
+            if self._add_level(state, await cursor.to_list(length=None)):
+                break
+        sample_docs = await collection.aggregate([{"$sample": {"size": 1}}]).to_list(length=1)
+        return self._finish(state, sample_docs, collection.name)
+
+
+def infer_schema(collection, analyze, batch_size: int = SCHEMA_SAMPLE_BATCH, mode: str = SCHEMA_INFERENCE_MODE):
+    """Infer a collection's schema server-side when possible, otherwise from sampled documents"""
+    if mode == "server":
+        try:
+            return ServerSchemaInference().run(collection)
+        except OperationFailure as e:
+            print(f"Server-side schema inference failed ({e}), sampling documents instead")
+    return SchemaSampler(analyze, batch_size=batch_size).run(collection)
+
+
+async def ainfer_schema(collection, analyze, batch_size: int = SCHEMA_SAMPLE_BATCH, mode: str = SCHEMA_INFERENCE_MODE):
+    """Async (Motor) variant of infer_schema()"""
+    if mode == "server":
+        try:
+            return await ServerSchemaInference().arun(collection)
+        except OperationFailure as e:
+            print(f"Server-side schema inference failed ({e}), sampling documents instead")
+    return await SchemaSampler(analyze, batch_size=batch_size).arun(collection)
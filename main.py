@@ -1,17 +1,32 @@
 import os
-from typing import List, Dict, Any
-from pymongo import MongoClient
+import time
+from typing import List, Dict, Any, Tuple
+from pymongo.errors import PyMongoError
+from bson import json_util
 from dotenv import load_dotenv
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from transformers import AutoTokenizer
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.chains import ConversationalRetrievalChain
 from langchain.docstore.document import Document
+from common.database import get_client
+from common.embeddings import BatchEmbeddings
+from common.embedding_cache import CachedEmbeddings
+from common.doc_serializer import DocumentSerializer
+from common.index_store import index_key, index_path, load_manifest, save_manifest, clear_index
 
 # Load environment variables
 load_dotenv()
 
+EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
+INDEX_COLLECTION = "mongodb_qa"
+WATERMARK_FIELD = os.getenv("INDEX_WATERMARK_FIELD", "updatedOn")
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "256"))
+# Chunk sizes are in model tokens: all-mpnet-base-v2 truncates at 384, less the [CLS]/[SEP] markers
+CHUNK_SIZE = int(os.getenv("INDEX_CHUNK_SIZE", "382"))
+CHUNK_OVERLAP = int(os.getenv("INDEX_CHUNK_OVERLAP", "32"))
+
 class MongoDBQA:
     def __init__(
         self,
@@ -20,7 +35,13 @@ class MongoDBQA:
         collection_name: str,
         google_api_key: str,
         query_filter: Dict[str, Any] = None,
-        field_list: List[str] = None
+        field_list: List[str] = None,
+        field_templates: Dict[str, str] = None,
+        index_root: str = None,
+        rebuild_index: bool = False,
+        sync_on_start: bool = False,
+        watermark_field: str = WATERMARK_FIELD,
+        batch_size: int = INDEX_BATCH_SIZE
     ):
         self.mongodb_uri = mongodb_uri
         self.database_name = database_name
@@ -28,8 +49,24 @@ class MongoDBQA:
         self.google_api_key = google_api_key
         self.query_filter = query_filter or {}
         self.field_list = field_list
+        self.rebuild_index = rebuild_index
+        self.sync_on_start = sync_on_start
+        self.watermark_field = watermark_field
+        self.batch_size = batch_size
+
+        # Unchanged chunks are served from the shared content-hash cache instead of being re-embedded
+        self.embeddings = CachedEmbeddings(BatchEmbeddings(EMBEDDING_MODEL))
+        self.serializer = DocumentSerializer(fields=field_list, templates=field_templates)
+        # Chunks are measured in the embedding model's own tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+        self.index_key = index_key(
+            database_name, collection_name, self.query_filter, field_list,
+            self.embeddings.model_id, self.serializer.signature(),
+            {"tokenizer": EMBEDDING_MODEL, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+        )
+        self.index_path = index_path(collection_name, self.index_key, index_root)
 
-        self.documents = None
+        self.manifest = None
         self.vectorstore = None
         self.qa_chain = None
         self.chat_history = []
@@ -37,10 +74,42 @@ class MongoDBQA:
         self._load_documents()
 
     def _load_documents(self):
+        self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            self.tokenizer, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+        )
+
+        self.manifest = None if self.rebuild_index else load_manifest(self.index_path)
+        if self.manifest:
+            print(f"Loading persisted index from {self.index_path} "
+                  f"({self.manifest['document_count']} documents, {self.manifest['chunk_count']} chunks)")
+            self.vectorstore = Chroma(
+                collection_name=INDEX_COLLECTION,
+                embedding_function=self.embeddings,
+                persist_directory=self.index_path
+            )
+            if self.sync_on_start:
+                self.sync()
+        else:
+            self._build_index()
+
+        llm = ChatGoogleGenerativeAI(
+            model="gemini-1.5-pro",
+            google_api_key=self.google_api_key,
+            temperature=0.2
+        )
+
+        self.qa_chain = ConversationalRetrievalChain.from_llm(
+            llm=llm,
+            retriever=self.vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 5}),
+            return_source_documents=True
+        )
+
+    def _connect(self):
+        """Open the source collection, checking the connection first"""
         print(f"Connecting to MongoDB collection: {self.collection_name}")
 
-        # Connect to MongoDB manually
-        client = MongoClient(self.mongodb_uri, serverSelectionTimeoutMS=20000)
+        # Reuse the process-wide pooled client instead of opening a new one per load
+        client = get_client(self.mongodb_uri, serverSelectionTimeoutMS=20000)
         db = client[self.database_name]
         collection = db[self.collection_name]
 
@@ -49,41 +118,213 @@ class MongoDBQA:
         except Exception as e:
             raise ConnectionError(f"Failed to connect to MongoDB: {e}")
 
-        projection = {field: 1 for field in self.field_list} if self.field_list else None
-        cursor = collection.find(self.query_filter, projection)
-        docs = list(cursor)
+        return collection
 
-        print(f"Loaded {len(docs)} documents")
-        if not docs:
-            raise ValueError("No documents found in the collection")
+    def _projection(self):
+        if not self.field_list:
+            return None
+        # The watermark field is needed to advance the sync position
+        return {field: 1 for field in self.field_list + [self.watermark_field]}
 
-        documents = [Document(page_content=str(doc), metadata={"source": self.collection_name}) for doc in docs]
+    def _split_documents(self, docs: List[Dict[str, Any]]) -> Tuple[List[Document], int]:
+        """Serialize and split Mongo documents into chunks tagged with their source document id"""
+        chunks = []
+        tokens = 0
+        for doc in docs:
+            doc_id = str(doc["_id"])
+            text = self.serializer.serialize(doc)
+            tokens += len(self.tokenizer.tokenize(text))
+            document = Document(page_content=text, metadata={"source": self.collection_name, "doc_id": doc_id})
+            for i, chunk in enumerate(self.text_splitter.split_documents([document])):
+                chunk.id = f"{doc_id}:{i}"
+                chunks.append(chunk)
+        return chunks, tokens
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        self.documents = text_splitter.split_documents(documents)
-        print(f"Split into {len(self.documents)} chunks")
+    def _current_resume_token(self, collection):
+        """Return a change stream resume token for 'now', or None if change streams are unavailable"""
+        try:
+            with collection.watch() as stream:
+                stream.try_next()
+                return stream.resume_token
+        except PyMongoError as e:
+            print(f"Change streams unavailable, falling back to '{self.watermark_field}' watermark: {e}")
+            return None
 
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-mpnet-base-v2",
-            model_kwargs={'device': 'cpu'}
-        )
+    def _max_watermark(self, docs: List[Dict[str, Any]], current=None):
+        values = [doc[self.watermark_field] for doc in docs if doc.get(self.watermark_field) is not None]
+        if current is not None:
+            values.append(current)
+        return max(values) if values else None
 
-        self.vectorstore = Chroma.from_documents(
-            documents=self.documents,
-            embedding=embeddings
-        )
+    def _batches(self, cursor):
+        """Yield documents from a cursor in lists of at most batch_size"""
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-pro",
-            google_api_key=self.google_api_key,
-            temperature=0.2
+    def _ingest(self, cursor, replace_existing: bool = False) -> Dict[str, Any]:
+        """Split, embed and upsert documents batch by batch so memory is bounded by the batch size"""
+        stats = {"documents": 0, "chunks": 0, "tokens": 0, "replaced": 0, "watermark": None}
+        start = time.time()
+
+        for batch in self._batches(cursor):
+            if replace_existing:
+                stats["replaced"] += self._delete_document_chunks([str(doc["_id"]) for doc in batch])
+
+            chunks, tokens = self._split_documents(batch)
+            if chunks:
+                self.vectorstore.add_documents(chunks, ids=[chunk.id for chunk in chunks])
+
+            stats["documents"] += len(batch)
+            stats["chunks"] += len(chunks)
+            stats["tokens"] += tokens
+            stats["watermark"] = self._max_watermark(batch, stats["watermark"])
+
+            elapsed = max(time.time() - start, 1e-6)
+            print(f"Indexed {stats['documents']} documents / {stats['chunks']} chunks "
+                  f"(~{stats['tokens'] / stats['documents']:.0f} tokens/doc, {stats['chunks'] / stats['documents']:.2f} chunks/doc) "
+                  f"in {elapsed:.1f}s ({stats['documents'] / elapsed:.1f} docs/s, {stats['chunks'] / elapsed:.1f} chunks/s, "
+                  f"{self.embeddings.hits} cached / {self.embeddings.misses} embedded)")
+
+        if self.manifest:
+            self.manifest["chunk_count"] += stats["chunks"]
+        return stats
+
+    def _build_index(self):
+        """Embed the collection into a persistent index and record its manifest"""
+        collection = self._connect()
+
+        # Take the resume token before scanning so no concurrent write is missed
+        resume_token = self._current_resume_token(collection)
+
+        # Start from an empty directory so a partial earlier build is never reused
+        clear_index(self.index_path)
+        self.vectorstore = Chroma(
+            collection_name=INDEX_COLLECTION,
+            embedding_function=self.embeddings,
+            persist_directory=self.index_path
         )
 
-        self.qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=self.vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 5}),
-            return_source_documents=True
+        cursor = collection.find(self.query_filter, self._projection(), batch_size=self.batch_size)
+        stats = self._ingest(cursor)
+        if not stats["documents"]:
+            raise ValueError("No documents found in the collection")
+
+        self.manifest = {
+            "key": self.index_key,
+            "database": self.database_name,
+            "collection": self.collection_name,
+            "filter": self.query_filter,
+            "fields": self.field_list,
+            "model": self.embeddings.model_id,
+            "document_count": stats["documents"],
+            "chunk_count": stats["chunks"],
+            "avg_tokens_per_document": round(stats["tokens"] / stats["documents"], 1),
+            "watermark_field": self.watermark_field,
+            "watermark": json_util.dumps(stats["watermark"]),
+            "resume_token": json_util.dumps(resume_token) if resume_token else None
+        }
+        save_manifest(self.index_path, self.manifest)
+        print(f"Persisted index to {self.index_path}")
+
+    def _delete_document_chunks(self, doc_ids: List[str]) -> int:
+        """Delete all chunks belonging to the given documents, returning how many documents had chunks"""
+        if not doc_ids:
+            return 0
+        existing = self.vectorstore.get(where={"doc_id": {"$in": doc_ids}}, include=["metadatas"])
+        if existing["ids"]:
+            self.vectorstore.delete(ids=existing["ids"])
+            self.manifest["chunk_count"] -= len(existing["ids"])
+        return len({metadata["doc_id"] for metadata in existing["metadatas"]})
+
+    def _apply_changes(self, collection, changed_ids: List[Any], deleted_ids: List[Any]):
+        """Re-embed changed documents and drop vectors of deleted ones"""
+        removed = self._delete_document_chunks([str(doc_id) for doc_id in deleted_ids])
+        ingested = 0
+
+        for i in range(0, len(changed_ids), self.batch_size):
+            batch_ids = changed_ids[i:i + self.batch_size]
+            removed += self._delete_document_chunks([str(doc_id) for doc_id in batch_ids])
+            # Re-read through the filter so documents that no longer match stay removed
+            cursor = collection.find({"$and": [self.query_filter, {"_id": {"$in": batch_ids}}]}, self._projection())
+            ingested += self._ingest(cursor)["documents"]
+
+        self.manifest["document_count"] += ingested - removed
+        print(f"Synced {len(changed_ids)} changed and {len(deleted_ids)} deleted documents")
+
+    def _sync_from_change_stream(self, collection, resume_token) -> bool:
+        """Apply changes recorded since the resume token; returns False if the token is no longer valid"""
+        changed_ids, deleted_ids = [], []
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        try:
+            with collection.watch(pipeline, resume_after=resume_token) as stream:
+                while True:
+                    change = stream.try_next()
+                    if change is None:
+                        break
+                    doc_id = change["documentKey"]["_id"]
+                    if change["operationType"] == "delete":
+                        deleted_ids.append(doc_id)
+                    else:
+                        changed_ids.append(doc_id)
+                new_token = stream.resume_token
+        except PyMongoError as e:
+            print(f"Could not resume change stream: {e}")
+            return False
+
+        changed = list(dict.fromkeys(changed_ids))
+        changed_set = set(changed)
+        self._apply_changes(collection, changed, [doc_id for doc_id in deleted_ids if doc_id not in changed_set])
+        self.manifest["resume_token"] = json_util.dumps(new_token)
+        return True
+
+    def _sync_from_watermark(self, collection):
+        """Apply inserts and updates newer than the stored watermark"""
+        watermark = json_util.loads(self.manifest.get("watermark") or "null")
+        if watermark is None:
+            print(f"No '{self.watermark_field}' watermark recorded; use prune_deleted() or rebuild the index")
+            return
+
+        cursor = collection.find(
+            {"$and": [self.query_filter, {self.watermark_field: {"$gt": watermark}}]},
+            self._projection(),
+            batch_size=self.batch_size
         )
+        stats = self._ingest(cursor, replace_existing=True)
+        self.manifest["document_count"] += stats["documents"] - stats["replaced"]
+        self.manifest["watermark"] = json_util.dumps(stats["watermark"] or watermark)
+        print(f"Synced {stats['documents']} changed documents")
+
+    def sync(self):
+        """Incrementally bring the persisted index up to date with the collection"""
+        if not self.manifest:
+            raise ValueError("No persisted index to sync")
+
+        collection = self._connect()
+        resume_token = self.manifest.get("resume_token")
+        if not (resume_token and self._sync_from_change_stream(collection, json_util.loads(resume_token))):
+            self._sync_from_watermark(collection)
+
+        save_manifest(self.index_path, self.manifest)
+
+    def prune_deleted(self):
+        """Remove vectors of documents that no longer exist, for watermark-only deployments"""
+        if not self.manifest:
+            raise ValueError("No persisted index to prune")
+
+        collection = self._connect()
+        live_ids = {str(doc["_id"]) for doc in collection.find(self.query_filter, {"_id": 1})}
+        indexed_ids = {metadata["doc_id"] for metadata in self.vectorstore.get(include=["metadatas"])["metadatas"]}
+        deleted = self._delete_document_chunks(sorted(indexed_ids - live_ids))
+        self.manifest["document_count"] -= deleted
+
+        save_manifest(self.index_path, self.manifest)
+        print(f"Pruned {deleted} deleted documents")
 
     def ask(self, question: str) -> str:
         if not self.qa_chain:
@@ -118,11 +359,13 @@ def main():
             database_name=database_name,
             collection_name=collection_name,
             google_api_key=google_api_key,
-            field_list=field_list
+            field_list=field_list,
+            rebuild_index=os.getenv("REBUILD_INDEX", "").lower() in ("1", "true", "yes"),
+            sync_on_start=os.getenv("INDEX_SYNC", "").lower() in ("1", "true", "yes")
         )
 
         print("\nMongoDB QA system initialized successfully!")
-        print("Type 'exit' to quit or 'reset' to clear chat history.")
+        print("Type 'exit' to quit, 'reset' to clear chat history or 'sync' to pick up collection changes.")
 
         while True:
             question = input("\nAsk a question about your data: ")
@@ -132,6 +375,9 @@ def main():
                 qa_system.reset_chat_history()
                 print("Chat history reset.")
                 continue
+            elif question.lower() == 'sync':
+                qa_system.sync()
+                continue
 
             try:
                 answer = qa_system.ask(question)
@@ -139,6 +385,8 @@ def main():
             except Exception as e:
                 print(f"Error: {e}")
 
+        qa_system.embeddings.close()
+
     except Exception as e:
         print(f"Failed to initialize MongoDB QA system: {e}")
 
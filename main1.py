@@ -1,6 +1,5 @@
 import os
 from typing import List, Dict, Any, Optional, Union
-from pymongo import MongoClient
 from bson import json_util
 import json
 import ssl
@@ -8,6 +7,7 @@ import re
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.schema import SystemMessage, HumanMessage
+from common.database import get_client, get_database
 
 # Load environment variables
 load_dotenv()
@@ -23,7 +23,7 @@ class MongoDBQueryEngine:
         self.database_name = database_name
         self.google_api_key = google_api_key
         # mongodb_uri = mongodb_uri + "&ssl=true&ssl_cert_reqs=CERT_NONE"
-        self.client =   MongoClient(
+        self.client = get_client(
             mongodb_uri,
             serverSelectionTimeoutMS=30000,
             connectTimeoutMS=30000,
@@ -31,6 +31,8 @@ class MongoDBQueryEngine:
             tlsAllowInvalidCertificates=True  # More modern way to disable cert verification
         )
         self.db = self.client[database_name]
+        # Heavy read-only work (stats, trends) goes to secondaries when available
+        self.analytics_db = get_database(self.client, database_name, analytics=True)
         self.collections = {}  # Cache of collection metadata
         self.current_collection = None
         self.chat_history = []
@@ -289,7 +291,7 @@ class MongoDBQueryEngine:
         if not col_name:
             raise ValueError("No collection specified and no current collection set")
         
-        collection = self.db[col_name]
+        collection = self.analytics_db[col_name]
         
         # Get basic collection stats
         stats = {
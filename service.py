@@ -0,0 +1,187 @@
+import os
+import time
+import uuid
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from common.database import pool_metrics, async_health_check
+from common.serializer import dumps
+from async_engine import AsyncMongoDBQueryEngine
+
+# Load environment variables
+load_dotenv()
+
+MAX_SESSIONS = int(os.getenv("SERVICE_MAX_SESSIONS", "500"))
+SESSION_TTL_SECONDS = int(os.getenv("SERVICE_SESSION_TTL", "3600"))
+MAX_HISTORY_MESSAGES = int(os.getenv("SERVICE_MAX_HISTORY", "50"))
+# Requests beyond MAX_INFLIGHT wait up to QUEUE_TIMEOUT seconds before being rejected with 503
+MAX_INFLIGHT = int(os.getenv("SERVICE_MAX_INFLIGHT", "64"))
+QUEUE_TIMEOUT = float(os.getenv("SERVICE_QUEUE_TIMEOUT", "5"))
+
+
+class AskRequest(BaseModel):
+    question: str
+
+
+class CollectionRequest(BaseModel):
+    name: str
+
+
+class Session:
+    """Per-user state: an engine view sharing the pool and schema cache, plus chat history"""
+
+    def __init__(self, engine: AsyncMongoDBQueryEngine):
+        self.engine = engine
+        self.last_used = time.time()
+        self.lock = asyncio.Lock()  # one in-flight question per session keeps history ordered
+
+    def record(self, question: str, answer: str):
+        self.engine.chat_history.append({"role": "user", "parts": [question]})
+        self.engine.chat_history.append({"role": "model", "parts": [answer]})
+        del self.engine.chat_history[:-MAX_HISTORY_MESSAGES]
+
+
+class QueryService:
+    """Holds the shared engine and per-session state, and applies admission control"""
+
+    def __init__(self):
+        self.engine: Optional[AsyncMongoDBQueryEngine] = None
+        self.sessions: Dict[str, Session] = {}
+        self.inflight = asyncio.Semaphore(MAX_INFLIGHT)
+
+    async def start(self):
+        self.engine = await AsyncMongoDBQueryEngine.create(
+            mongodb_uri=os.getenv("MONGO_URL"),
+            database_name=os.getenv("MONGO_DB"),
+            google_api_key=os.getenv("GOOGLE_API_KEY")
+        )
+
+    def _evict_idle(self):
+        cutoff = time.time() - SESSION_TTL_SECONDS
+        for session_id in [sid for sid, session in self.sessions.items() if session.last_used < cutoff]:
+            del self.sessions[session_id]
+
+    def create_session(self) -> str:
+        self._evict_idle()
+        if len(self.sessions) >= MAX_SESSIONS:
+            raise HTTPException(status_code=503, detail="Too many active sessions", headers={"Retry-After": "30"})
+
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = Session(self.engine.session())
+        return session_id
+
+    def get_session(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired session")
+        session.last_used = time.time()
+        return session
+
+    @asynccontextmanager
+    async def admit(self):
+        """Bound concurrent work; shed load with 503 instead of queueing without limit"""
+        try:
+            await asyncio.wait_for(self.inflight.acquire(), timeout=QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "5"})
+        try:
+            yield
+        finally:
+            self.inflight.release()
+
+
+service = QueryService()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await service.start()
+    yield
+
+
+class BSONJSONResponse(JSONResponse):
+    """JSON response rendered straight to bytes by the orjson-based serializer"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+app = FastAPI(title="MongoDB Query Service", lifespan=lifespan, default_response_class=BSONJSONResponse)
+
+
+@app.post("/sessions")
+async def create_session() -> Dict[str, str]:
+    return {"session_id": service.create_session()}
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str) -> Dict[str, bool]:
+    return {"deleted": service.sessions.pop(session_id, None) is not None}
+
+
+@app.post("/sessions/{session_id}/ask")
+async def ask(session_id: str, request: AskRequest) -> Dict[str, Any]:
+    session = service.get_session(session_id)
+    async with session.lock, service.admit():
+        answer = await session.engine.ask(request.question)
+        session.record(request.question, answer)
+    return {"answer": answer, "collection": session.engine.current_collection}
+
+
+@app.post("/sessions/{session_id}/collection")
+async def use_collection(session_id: str, request: CollectionRequest) -> Dict[str, Any]:
+    session = service.get_session(session_id)
+    async with session.lock, service.admit():
+        try:
+            message = await session.engine.set_current_collection(request.name)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    return {"message": message, "collection": session.engine.current_collection}
+
+
+@app.get("/sessions/{session_id}/schema")
+async def schema(session_id: str) -> Dict[str, Any]:
+    session = service.get_session(session_id)
+    if not session.engine.current_collection:
+        raise HTTPException(status_code=400, detail="No collection selected")
+    return {"collection": session.engine.current_collection, "fields": session.engine.get_collection_schema()}
+
+
+@app.get("/sessions/{session_id}/stats")
+async def stats(session_id: str, exact: bool = False) -> Dict[str, Any]:
+    session = service.get_session(session_id)
+    if not session.engine.current_collection:
+        raise HTTPException(status_code=400, detail="No collection selected")
+    async with service.admit():
+        collection_stats = await session.engine.get_collection_stats(exact=exact)
+    return {"stats": session.engine._format_stats(collection_stats)}
+
+
+@app.get("/sessions/{session_id}/history")
+async def history(session_id: str) -> Dict[str, Any]:
+    return {"history": service.get_session(session_id).engine.chat_history}
+
+
+@app.get("/health")
+async def health() -> Dict[str, Any]:
+    return {
+        "sessions": len(service.sessions),
+        "pools": await async_health_check(),
+        "pool_metrics": pool_metrics(),
+        "result_cache": service.engine.result_cache.stats() if service.engine else None
+    }
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "service:app",
+        host=os.getenv("SERVICE_HOST", "0.0.0.0"),
+        port=int(os.getenv("SERVICE_PORT", "8000")),
+        workers=1  # sessions live in process memory
+    )
@@ -1,7 +1,6 @@
 import os
+import threading
 from typing import List, Dict, Any, Optional, Union
-from pymongo import MongoClient
-from bson import json_util, ObjectId
 import json
 import ssl
 import re
@@ -10,10 +9,29 @@ from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.schema import SystemMessage, HumanMessage
+from pymongo.errors import ExecutionTimeout
+from common.database import get_client, get_database, pool_metrics, health_check
+from common.query_cache import QueryCache, schema_fingerprint
+from common.schema_catalog import SchemaCatalog
+from common.counts import CountProvider
+from common.collection_stats import CollectionStatsBuilder
+from common.hll import FieldSketches, SketchStore
+from common.prompt_builder import SchemaPromptBuilder
+from common.doc_serializer import count_tokens
+from common.prompt_cache import PromptPrefixCache, timed_invoke
+from common.result_cache import ResultCache, result_key
+from common.serializer import to_jsonable, dumps
+from common.query_guard import QueryGuard
+from common.pipeline_optimizer import PipelineOptimizer
+from common.sargable import rewrite_query
+from common.schema_inference import infer_schema, analyze_document, summarize_fields
 
 # Load environment variables
 load_dotenv()
 
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+QUERY_SYSTEM_INSTRUCTION = "You are a MongoDB query expert assistant that outputs only valid JSON objects."
+
 class MongoDBQueryEngine:
     def __init__(
         self,
@@ -24,7 +42,7 @@ class MongoDBQueryEngine:
         self.mongodb_uri = mongodb_uri
         self.database_name = database_name
         self.google_api_key = google_api_key
-        self.client = MongoClient(
+        self.client = get_client(
             mongodb_uri,
             serverSelectionTimeoutMS=30000,
             connectTimeoutMS=30000,
@@ -32,13 +50,22 @@ class MongoDBQueryEngine:
             tlsAllowInvalidCertificates=True
         )
         self.db = self.client[database_name]
+        # Heavy read-only work (stats, trends) goes to secondaries when available
+        self.analytics_db = get_database(self.client, database_name, analytics=True)
         self.collections = {}  # Cache of collection metadata
         self.current_collection = None
         self.chat_history = []
 
+        self._init_components(google_api_key)
+        
+        # Load database schema
+        self._load_database_schema()
+
+    def _init_components(self, google_api_key: str):
+        """Create the LLM, embeddings and query cache shared by sync and async engines"""
         # Initialize LLM for query generation
         self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
+            model=LLM_MODEL,
             google_api_key=google_api_key,
             temperature=0.2
         )
@@ -50,8 +77,38 @@ class MongoDBQueryEngine:
             task_type="retrieval_query"
         )
         
-        # Load database schema
-        self._load_database_schema()
+        # Cache generated queries so repeated questions skip the LLM
+        similarity_threshold = os.getenv("QUERY_CACHE_SIMILARITY")
+        self.query_cache = QueryCache(
+            max_entries=int(os.getenv("QUERY_CACHE_SIZE", "256")),
+            ttl_seconds=int(os.getenv("QUERY_CACHE_TTL", "3600")),
+            embeddings=self.embeddings,
+            similarity_threshold=float(similarity_threshold) if similarity_threshold else None
+        )
+        
+        # Persisted collection metadata lets startup skip re-sampling collections
+        self.schema_catalog = SchemaCatalog(self.database_name)
+        
+        # Document counts come from collection metadata unless an exact count is asked for
+        self.count_provider = CountProvider()
+        
+        # Persisted HyperLogLog sketches give field cardinalities without materializing distinct values
+        self.sketch_store = SketchStore(self.database_name)
+        
+        # Keeps the schema part of query prompts within a fixed token budget
+        self.prompt_builder = SchemaPromptBuilder()
+        
+        # Static per-collection prompt prefixes, registered as provider cached content when enabled
+        self.prompt_prefixes = PromptPrefixCache(LLM_MODEL, google_api_key, QUERY_SYSTEM_INSTRUCTION)
+        
+        # Executed query results, invalidated when the collection changes
+        self.result_cache = ResultCache()
+        
+        # Explain-based cost check and time limit for generated queries
+        self.query_guard = QueryGuard()
+        
+        # Rewrites generated aggregation pipelines before they run
+        self.pipeline_optimizer = PipelineOptimizer()
 
     def _load_database_schema(self):
         """Load schema information about all collections in the database"""
@@ -71,32 +128,40 @@ class MongoDBQueryEngine:
         #     if col_name == "system.views":
         #         continue
         #     print(f"Analyzing collection: {col_name}")
-        self._analyze_collection("portcalls")
+        if not self._load_from_catalog("portcalls"):
+            self._analyze_collection("portcalls")
     
     def _analyze_collection(self, collection_name: str, sample_size: int = 100):
         """Analyze a collection's schema from a sample of documents"""
         collection = self.db[collection_name]
         
-        # Count total documents
-        total_count = collection.count_documents({})
+        # Estimated total documents (metadata only, no collection scan)
+        total_count = self.count_provider.count(collection)
         
-        # Get a sample of documents
-        sample_docs = list(collection.find().limit(sample_size))
+        # Server-side inference, or a random sample grown until the field/type set stops changing
+        sample_docs, fields = infer_schema(collection, self._analyze_document, batch_size=sample_size)
         
-        # Extract field information
-        fields = {}
-        for doc in sample_docs:
-            self._analyze_document(doc, fields)
+        self._store_collection_metadata(collection_name, total_count, sample_docs, fields)
+    
+    def _store_collection_metadata(self, collection_name: str, total_count: int, sample_docs: List[Dict[str, Any]],
+                                   fields: Optional[Dict[str, Any]] = None):
+        """Build and cache collection metadata from a document count and sample"""
+        # Extract field information unless the sampler already did
+        if fields is None:
+            fields = {}
+            for doc in sample_docs:
+                self._analyze_document(doc, fields)
+            summarize_fields(fields, len(sample_docs))
         
         # Convert sets to lists for JSON serialization
         for field in fields:
             fields[field]["types"] = list(fields[field]["types"])
         
-        # Store collection metadata
-        self.collections[collection_name] = {
+        # Build collection metadata
+        metadata = {
             "total_documents": total_count,
             "fields": fields,
-            "sample_document": json.loads(json_util.dumps(sample_docs[0] if sample_docs else {}))
+            "sample_document": to_jsonable(sample_docs[0] if sample_docs else {})
         }
         
         # Detect date fields for trend analysis
@@ -104,42 +169,41 @@ class MongoDBQueryEngine:
                       if "datetime" in info["types"] or "date" in info["types"]]
         
         if date_fields:
-            self.collections[collection_name]["date_fields"] = date_fields
+            metadata["date_fields"] = date_fields
+        
+        # Swap in the finished metadata at once so background refreshes never expose a partial entry
+        self.collections[collection_name] = metadata
+        self.schema_catalog.put(collection_name, metadata)
     
-    def _analyze_document(self, doc, fields, prefix=""):
-        """Recursively analyze document structure including nested fields"""
-        for key, value in doc.items():
-            field_name = f"{prefix}{key}"
-            
-            if field_name not in fields:
-                fields[field_name] = {"types": set(), "examples": []}
-            
-            # Handle special types
-            if isinstance(value, datetime.datetime):
-                value_type = "datetime"
-            elif isinstance(value, ObjectId):
-                value_type = "objectid"
-            else:
-                value_type = type(value).__name__
-                
-            fields[field_name]["types"].add(value_type)
-            
-            # Store examples for non-ID fields
-            if field_name != "_id" and len(fields[field_name]["examples"]) < 3:
-                fields[field_name]["examples"].append(str(value))
-            
-            # Recursively analyze nested documents
-            if isinstance(value, dict):
-                self._analyze_document(value, fields, f"{field_name}.")
-            
-            # Handle arrays of objects
-            elif isinstance(value, list) and value and isinstance(value[0], dict):
-                # Sample the first item in the array
-                self._analyze_document(value[0], fields, f"{field_name}[].")
+    def _analyze_document(self, doc, fields):
+        """Analyze document structure including nested fields and all array elements"""
+        analyze_document(doc, fields)
+    
+    def _load_from_catalog(self, collection_name: str) -> bool:
+        """Load collection metadata from the schema catalog, refreshing stale entries in the background"""
+        metadata = self.schema_catalog.get(collection_name)
+        if metadata is None:
+            return False
+        
+        self.collections[collection_name] = metadata
+        print(f"Loaded schema for {collection_name} from catalog")
+        if self.schema_catalog.is_stale(collection_name):
+            self._refresh_in_background(collection_name)
+        return True
+    
+    def _refresh_in_background(self, collection_name: str):
+        """Re-analyze a collection without blocking the caller"""
+        def refresh():
+            try:
+                self._analyze_collection(collection_name)
+            except Exception as e:
+                print(f"Background schema refresh of {collection_name} failed: {e}")
+        
+        threading.Thread(target=refresh, daemon=True).start()
     
     def set_current_collection(self, collection_name: str):
         """Set the current collection for queries"""
-        if collection_name not in self.collections:
+        if collection_name not in self.collections and not self._load_from_catalog(collection_name):
             if collection_name in self.db.list_collection_names():
                 self._analyze_collection(collection_name)
             else:
@@ -176,6 +240,13 @@ class MongoDBQueryEngine:
         
         return schema_info
 
+    def _make_sargable(self, query_data: Dict[str, Any]):
+        """Rewrite date-function predicates into index-friendly ranges, before date formats are normalized"""
+        query, rewrites = rewrite_query(query_data.get("query_type", "").lower(), query_data["query"])
+        for rewrite in rewrites:
+            print(f"Sargable rewrite: {rewrite}")
+        return query
+    
     def _fix_date_formats(self, query):
         """Fix date formats in MongoDB queries by converting string date operators to proper MongoDB operators"""
         if isinstance(query, dict):
@@ -217,30 +288,88 @@ class MongoDBQueryEngine:
             raise ValueError("No collection selected. Please select a collection first.")
         
         collection_info = self.collections[self.current_collection]
-        sample_doc = collection_info["sample_document"]
-        print("11111111111111111")
-        print("4444444444444444444444444")
-        # Format field information
-        fields_info = "\n".join([
-            f"- {field} (types: {', '.join(info['types'])}, examples: {', '.join(info['examples']) if info['examples'] else 'N/A'})"
-            for field, info in collection_info["fields"].items()
-        ])
-        print("777777777777777777777777777777777")
+        
+        # Repeated questions are answered from the query cache without calling the LLM
+        fingerprint = schema_fingerprint(collection_info)
+        cached_query = self.query_cache.get(question, self.current_collection, fingerprint)
+        if cached_query is not None:
+            print(f"Query cache hit for: {question}")
+            return cached_query
+        
+        messages, llm_kwargs = self._build_query_messages(question, collection_info)
+        print("-----------------------")
+        try:
+            response_text = timed_invoke(self.llm, messages, **llm_kwargs)
+        except Exception as e:
+            if not llm_kwargs:
+                raise
+            # The cached context may have been evicted provider-side; resend the full prompt
+            print(f"Cached prompt context failed ({e}), sending the full prompt")
+            self.prompt_prefixes.discard_cached_content(self.current_collection)
+            messages, llm_kwargs = self._build_query_messages(question, collection_info)
+            response_text = timed_invoke(self.llm, messages, **llm_kwargs)
+        print("---------------------------",response_text)
+        query_data = self._parse_query_response(response_text)
+        self.query_cache.put(question, self.current_collection, fingerprint, query_data)
+        return query_data
+
+    def _build_query_messages(self, question: str, collection_info: Dict[str, Any]):
+        """Build the LLM messages asking for a query that answers the question, plus extra LLM call arguments"""
+        prefix = self.prompt_prefixes.get(
+            self.current_collection,
+            schema_fingerprint(collection_info),
+            lambda: self._build_query_prefix(collection_info)
+        )
+        
+        # Only this part changes between questions; the prefix above is identical for the collection
+        delta = ""
+        relevant = self.prompt_builder.relevant_fields(question, collection_info["fields"])
+        if relevant:
+            cardinalities = self.sketch_store.cardinalities(self.current_collection)
+            lower_bounds = self.sketch_store.lower_bounds(self.current_collection)
+            delta += "Fields most relevant to this question:\n" + "\n".join(
+                self.prompt_builder.field_line(field, collection_info["fields"][field], cardinalities.get(field),
+                                               field in lower_bounds)
+                for field in relevant
+            ) + "\n\n"
+        delta += f"User question: {question}\n"
+        
+        if prefix.cached_content:
+            # The system instruction and prefix already live in the provider-side cache
+            return [HumanMessage(content=delta)], {"cached_content": prefix.cached_content}
+        
+        prompt = prefix.text + delta
+        print(f"Query prompt: ~{count_tokens(prompt)} tokens")
+        messages = [
+            SystemMessage(content=QUERY_SYSTEM_INSTRUCTION),
+            HumanMessage(content=prompt)
+        ]
+        return messages, {}
+    
+    def _build_query_prefix(self, collection_info: Dict[str, Any]) -> str:
+        """Build the question-independent part of the query prompt for the current collection"""
+        # Budgeted field list and compacted sample document, in schema order
+        cardinalities = self.sketch_store.cardinalities(self.current_collection)
+        lower_bounds = self.sketch_store.lower_bounds(self.current_collection)
+        fields_info, sample_doc_text, prompt_report = self.prompt_builder.build("", collection_info, cardinalities,
+                                                                                lower_bounds)
+        print(f"Prompt schema: {prompt_report['fields_included']}/{prompt_report['fields_total']} fields, "
+              f"{prompt_report['field_tokens']} field tokens, {prompt_report['sample_tokens']} sample tokens")
+        
         # Add specialized handling for time-series and trend analysis
         trend_guidance = ""
         if "date_fields" in collection_info and collection_info["date_fields"]:
             date_fields = collection_info["date_fields"]
             trend_guidance = f"""
-            For time-series or trend analysis:
-            - Available date fields: {', '.join(date_fields)}
-            - For current month, use: {{ $gte: new Date(new Date().getFullYear(), new Date().getMonth(), 1), $lt: new Date(new Date().getFullYear(), new Date().getMonth()+1, 1) }}
-            - Avoid using $dateFromString with format specifiers - use simpler date expressions like ISODate()
-            - For aggregations by time period, use $group with date operators like $dayOfMonth, $month, $year
-            """
-        print("555555555555555555555555555555555555555555")
-        # Create prompt for query generation
-        prompt = f"""
-        You are a MongoDB query expert. Generate a MongoDB query or aggregation pipeline to answer the following question.
+        For time-series or trend analysis:
+        - Available date fields: {', '.join(date_fields)}
+        - For current month, use: {{ $gte: new Date(new Date().getFullYear(), new Date().getMonth(), 1), $lt: new Date(new Date().getFullYear(), new Date().getMonth()+1, 1) }}
+        - Avoid using $dateFromString with format specifiers - use simpler date expressions like ISODate()
+        - For aggregations by time period, use $group with date operators like $dayOfMonth, $month, $year
+        """
+        
+        return f"""
+        You are a MongoDB query expert. Generate a MongoDB query or aggregation pipeline to answer the user question at the end.
 
         Database: {self.database_name}
         Collection: {self.current_collection}
@@ -250,12 +379,10 @@ class MongoDBQueryEngine:
         {fields_info}
 
         Sample document:
-        {json.dumps(sample_doc, indent=2)}
+        {sample_doc_text}
         
         {trend_guidance}
 
-        User question: {question}
-
         Important guidelines:
         1. For time trends, use standard MongoDB date operators like $dayOfMonth, $month, $year in $group stages
         2. Avoid complex date format strings in $dateToString or $dateFromString
@@ -276,18 +403,11 @@ class MongoDBQueryEngine:
         "explanation": "..."
         }}
         ```
-        """
-       
-        # Generate query using LLM
-        messages = [
-            SystemMessage(content="You are a MongoDB query expert assistant that outputs only valid JSON objects."),
-            HumanMessage(content=prompt)
-        ]
-        print("-----------------------")
-        response = self.llm.invoke(messages)
-        print("---------------------------",response)
-        response_text = response.content
-        
+
+"""
+
+    def _parse_query_response(self, response_text: str):
+        """Extract the query JSON from an LLM response and fix date formats"""
         # Extract JSON from the response
         json_pattern = r'```(?:json)?\s*([\s\S]*?)\s*```'
         match = re.search(json_pattern, response_text)
@@ -302,7 +422,7 @@ class MongoDBQueryEngine:
                 # Fix potential date format issues
                 if "query" in query_data:
                     print("lllllllllllllllllllllllll")
-                    query_data["query"] = self._fix_date_formats(query_data["query"])
+                    query_data["query"] = self._fix_date_formats(self._make_sargable(query_data))
                 print("//////////////",query_data)
                 return query_data
                 # pipeline = {
@@ -329,7 +449,7 @@ class MongoDBQueryEngine:
             try:
                 query_data = json.loads(response_text)
                 if "query" in query_data:
-                    query_data["query"] = self._fix_date_formats(query_data["query"])
+                    query_data["query"] = self._fix_date_formats(self._make_sargable(query_data))
                 print("sssssssssssssssssssssss",query_data)    
                 return query_data
             except:
@@ -397,12 +517,8 @@ class MongoDBQueryEngine:
         
         return query
 
-    def execute_query(self, query_data: Dict[str, Any]):
-        """Execute a MongoDB query based on the query data"""
-        if not self.current_collection:
-            raise ValueError("No collection selected")
-        
-        collection = self.db[self.current_collection]
+    def _prepare_query(self, query_data: Dict[str, Any]):
+        """Normalize generated query data into (query_type, query, explanation) ready to run"""
         query_type = query_data.get("query_type", "").lower()
         query = query_data.get("query", {})
         explanation = query_data.get("explanation", "")
@@ -410,36 +526,71 @@ class MongoDBQueryEngine:
         # Pre-process and fix date-related issues in the query
         query = self._handle_date_in_query(query)
         
+        if query_type == "aggregate" and isinstance(query, list):
+            # Add a $limit stage if not present for safety
+            has_limit = any(stage.get("$limit") is not None for stage in query if isinstance(stage, dict))
+            if not has_limit:
+                query.append({"$limit": 50})
+        
         print(f"Executing {query_type} query: {json.dumps(query, default=str)}")
         print(f"Explanation: {explanation}")
+        return query_type, query, explanation
+
+    def execute_query(self, query_data: Dict[str, Any]):
+        """Execute a MongoDB query based on the query data"""
+        if not self.current_collection:
+            raise ValueError("No collection selected")
+        
+        collection = self.db[self.current_collection]
+        query_type, query, explanation = self._prepare_query(query_data)
+        
+        # Rewrite generated pipelines so filters, projections and limits apply as early as possible
+        original_query, rewrites = query, []
+        if query_type == "aggregate":
+            query, rewrites = self.pipeline_optimizer.optimize(query)
+        
+        # Identical queries are served from the result cache until the collection changes
+        cache_key = result_key(self.database_name, self.current_collection, query_type, query)
+        self.result_cache.ensure_invalidation(collection)
+        generation = self.result_cache.generation(collection.full_name)
+        cached_result = self.result_cache.get(cache_key)
+        if cached_result is not None:
+            print("Result cache hit")
+            cached_result["explanation"] = explanation
+            return cached_result
+        
+        # Explain first: expensive queries are routed to the analytics node or refused
+        if self.query_guard.enabled:
+            estimate = self.query_guard.check(collection, query_type, query, self.count_provider.count(collection))
+            if estimate.route == "analytics":
+                collection = self.analytics_db[self.current_collection]
+        max_time_ms = self.query_guard.max_time_ms
+        
+        # Log how the rewrites changed the query plan
+        self.pipeline_optimizer.log_comparison(collection, original_query, query, rewrites)
         
         try:
             if query_type == "find":
-                cursor = collection.find(query)
+                cursor = collection.find(query, max_time_ms=max_time_ms)
                 results = list(cursor.limit(50))  # Limit to first 50 results for safety
-                return {
+                result = {
                     "count": len(results),
-                    "results": json.loads(json_util.dumps(results)),
+                    "results": to_jsonable(results),
                     "explanation": explanation
                 }
             
             elif query_type == "aggregate":
-                # Add a $limit stage if not present for safety
-                has_limit = any(stage.get("$limit") is not None for stage in query if isinstance(stage, dict))
-                if not has_limit:
-                    query.append({"$limit": 50})
-                
-                cursor = collection.aggregate(query)
+                cursor = collection.aggregate(query, maxTimeMS=max_time_ms, **self.pipeline_optimizer.options(query))
                 results = list(cursor)
-                return {
+                result = {
                     "count": len(results),
-                    "results": json.loads(json_util.dumps(results)),
+                    "results": to_jsonable(results),
                     "explanation": explanation
                 }
             
             elif query_type == "count":
-                count = collection.count_documents(query)
-                return {
+                count = collection.count_documents(query, maxTimeMS=max_time_ms)
+                result = {
                     "count": count,
                     "explanation": explanation
                 }
@@ -450,8 +601,8 @@ class MongoDBQueryEngine:
                 if not field:
                     raise ValueError("'field' is required for distinct queries")
                 
-                values = collection.distinct(field, filter_query)
-                return {
+                values = collection.distinct(field, filter_query, maxTimeMS=max_time_ms)
+                result = {
                     "count": len(values),
                     "values": values,
                     "explanation": explanation
@@ -460,8 +611,13 @@ class MongoDBQueryEngine:
             else:
                 raise ValueError(f"Unsupported query type: {query_type}")
                 
+        except ExecutionTimeout:
+            raise RuntimeError(f"Query exceeded the {max_time_ms} ms time limit. Please ask a narrower question.")
         except Exception as e:
             raise RuntimeError(f"Error executing query: {str(e)}")
+        
+        self.result_cache.put(cache_key, collection.full_name, result, generation)
+        return result
     
     def get_time_range_query(self, time_range: str):
         """Generate a date range query based on a time range description"""
@@ -511,144 +667,107 @@ class MongoDBQueryEngine:
         
         return {"$gte": start_date, "$lt": end_date}
     
-    def get_collection_stats(self, collection_name: Optional[str] = None):
+    def get_collection_stats(self, collection_name: Optional[str] = None, exact: bool = False):
         """Get detailed statistics about a collection"""
         col_name = collection_name or self.current_collection
         
         if not col_name:
             raise ValueError("No collection specified and no current collection set")
         
-        collection = self.db[col_name]
+        collection = self.analytics_db[col_name]
         
         # Get basic collection stats
         stats = {
             "name": col_name,
-            "document_count": collection.count_documents({}),
+            "document_count": self.count_provider.count(collection, exact=exact),
+            "count_estimated": not exact,
             "field_stats": {}
         }
         
-        # For each field, get distribution of values if cardinality is reasonable
         if col_name in self.collections:
-            for field_name in self.collections[col_name]["fields"]:
-                if field_name == "_id":
-                    continue
-                    
-                # Get unique value count
-                distinct_count = len(collection.distinct(field_name))
-                
-                if distinct_count <= 15:  # Only get distribution for low-cardinality fields
-                    pipeline = [
-                        {"$group": {"_id": f"${field_name}", "count": {"$sum": 1}}},
-                        {"$sort": {"count": -1}},
-                        {"$limit": 10}
-                    ]
-                    distribution = list(collection.aggregate(pipeline))
-                    
-                    stats["field_stats"][field_name] = {
-                        "distinct_values": distinct_count,
-                        "distribution": [{"value": item["_id"], "count": item["count"]} for item in distribution]
-                    }
-                else:
-                    stats["field_stats"][field_name] = {
-                        "distinct_values": distinct_count
-                    }
-                    
-            # Add time series stats if date fields exist
-            if "date_fields" in self.collections[col_name] and self.collections[col_name]["date_fields"]:
-                primary_date_field = self.collections[col_name]["date_fields"][0]
-                stats["time_stats"] = {}
-                
-                # Get date range
-                pipeline = [
-                    {"$group": {
-                        "_id": None,
-                        "min_date": {"$min": f"${primary_date_field}"},
-                        "max_date": {"$max": f"${primary_date_field}"}
-                    }}
-                ]
-                date_range = list(collection.aggregate(pipeline))
-                if date_range:
-                    stats["time_stats"]["date_range"] = {
-                        "min": date_range[0]["min_date"],
-                        "max": date_range[0]["max_date"]
-                    }
-                
-                # Get counts by month for recent data
-                pipeline = [
-                    {"$match": {
-                        primary_date_field: {
-                            "$gte": datetime.datetime.now() - relativedelta(months=6)
-                        }
-                    }},
-                    {"$group": {
-                        "_id": {
-                            "year": {"$year": f"${primary_date_field}"},
-                            "month": {"$month": f"${primary_date_field}"}
-                        },
-                        "count": {"$sum": 1}
-                    }},
-                    {"$sort": {"_id.year": 1, "_id.month": 1}}
-                ]
-                monthly_counts = list(collection.aggregate(pipeline))
-                if monthly_counts:
-                    stats["time_stats"]["monthly_counts"] = [
-                        {
-                            "year": item["_id"]["year"],
-                            "month": item["_id"]["month"],
-                            "count": item["count"]
-                        }
-                        for item in monthly_counts
-                    ]
+            metadata = self.collections[col_name]
+            builder = CollectionStatsBuilder(
+                metadata["fields"],
+                date_field=(metadata.get("date_fields") or [None])[0],
+                document_count=stats["document_count"],
+                cardinalities=self._field_cardinalities(collection, col_name, stats["document_count"]),
+                lower_bounds=self.sketch_store.lower_bounds(col_name)
+            )
+            
+            # All field cardinalities, distributions and time stats in a few $facet passes
+            results = [next(collection.aggregate(pipeline, allowDiskUse=True), {}) for pipeline in builder.pipelines()]
+            stats.update(builder.merge(results))
         
         return stats
+    
+    def _field_cardinalities(self, collection, collection_name: str, document_count: int) -> Dict[str, int]:
+        """Approximate distinct values per field from persisted sketches, rebuilt when stale"""
+        field_names = [field for field in self.collections[collection_name]["fields"] if field != "_id"]
+        if self.sketch_store.is_stale(collection_name, field_names):
+            print(f"Building cardinality sketches for {collection_name}")
+            sketches = FieldSketches(field_names, document_count=document_count)
+            pipeline = sketches.pipeline()
+            if pipeline is not None:
+                for doc in collection.aggregate(pipeline, allowDiskUse=True):
+                    sketches.add(doc)
+            self.sketch_store.save(collection_name, sketches)
+        return self.sketch_store.cardinalities(collection_name)
 
     def process_analytical_question(self, question: str):
         """Process analytical questions that require specialized handling"""
         if not self.current_collection:
             return "No collection selected. Please select a collection first."
             
+        trend_request = self._parse_trend_question(question)
+        if trend_request:
+            return self._generate_trend_analysis(*trend_request)
+            
+        # For other analytical questions, use the standard query generator
+        return None
+    
+    def _parse_trend_question(self, question: str):
+        """Detect a trend analysis question and return (date_field, time_periods, group_by), or None"""
         collection_info = self.collections[self.current_collection]
         
         # Check if this is a trend analysis question
         trend_keywords = ["trend", "over time", "monthly", "weekly", "daily", "comparison", "historical", "history", "pattern"]
         is_trend_question = any(keyword in question.lower() for keyword in trend_keywords)
         
-        if is_trend_question and "date_fields" in collection_info and collection_info["date_fields"]:
-            primary_date_field = collection_info["date_fields"][0]
+        if not (is_trend_question and "date_fields" in collection_info and collection_info["date_fields"]):
+            return None
             
-            # Extract time range information from the question
-            current_month_keywords = ["current month", "this month"]
-            last_month_keywords = ["last month", "previous month"]
-            last_6_months_keywords = ["last 6 months", "past 6 months", "previous 6 months"]
+        primary_date_field = collection_info["date_fields"][0]
+        
+        # Extract time range information from the question
+        current_month_keywords = ["current month", "this month"]
+        last_month_keywords = ["last month", "previous month"]
+        last_6_months_keywords = ["last 6 months", "past 6 months", "previous 6 months"]
+        
+        time_periods = []
+        
+        if any(keyword in question.lower() for keyword in current_month_keywords):
+            time_periods.append("this_month")
+        if any(keyword in question.lower() for keyword in last_month_keywords):
+            time_periods.append("last_month")
+        if any(keyword in question.lower() for keyword in last_6_months_keywords):
+            time_periods.append("last_6_months")
             
-            time_periods = []
+        # Default to current month + previous 6 months if no specific period mentioned
+        if not time_periods:
+            time_periods = ["this_month", "last_6_months"]
             
-            if any(keyword in question.lower() for keyword in current_month_keywords):
-                time_periods.append("this_month")
-            if any(keyword in question.lower() for keyword in last_month_keywords):
-                time_periods.append("last_month")
-            if any(keyword in question.lower() for keyword in last_6_months_keywords):
-                time_periods.append("last_6_months")
-                
-            # Default to current month + previous 6 months if no specific period mentioned
-            if not time_periods:
-                time_periods = ["this_month", "last_6_months"]
-                
-            # Determine appropriate aggregation level (daily, weekly, monthly)
-            if "daily" in question.lower() or "day" in question.lower():
-                group_by = "day"
-            elif "weekly" in question.lower() or "week" in question.lower():
-                group_by = "week"
-            else:
-                group_by = "month"  # default to monthly
-                
-            return self._generate_trend_analysis(primary_date_field, time_periods, group_by)
+        # Determine appropriate aggregation level (daily, weekly, monthly)
+        if "daily" in question.lower() or "day" in question.lower():
+            group_by = "day"
+        elif "weekly" in question.lower() or "week" in question.lower():
+            group_by = "week"
+        else:
+            group_by = "month"  # default to monthly
             
-        # For other analytical questions, use the standard query generator
-        return None
+        return primary_date_field, time_periods, group_by
     
-    def _generate_trend_analysis(self, date_field: str, time_periods: List[str], group_by: str = "month"):
-        """Generate a trend analysis for specified time periods and grouping"""
+    def _trend_pipelines(self, date_field: str, time_periods: List[str], group_by: str = "month"):
+        """Build one aggregation pipeline per time period for a trend analysis"""
         # Get appropriate MongoDB date operator for grouping
         group_id = {}
         if group_by == "day":
@@ -671,17 +790,11 @@ class MongoDBQueryEngine:
             }
             sort_order = ["year", "month"]
             
-        # Build date range query for all time periods
-        date_queries = {}
-        for period in time_periods:
-            date_queries[period] = self.get_time_range_query(period)
-            
         # Build aggregation pipeline for each time period
-        results = {}
-        collection = self.db[self.current_collection]
-        
-        for period, date_query in date_queries.items():
-            pipeline = [
+        pipelines = {}
+        for period in time_periods:
+            date_query = self.get_time_range_query(period)
+            pipelines[period] = [
                 {"$match": {date_field: date_query}},
                 {"$group": {
                     "_id": group_id,
@@ -689,14 +802,24 @@ class MongoDBQueryEngine:
                 }},
                 {"$sort": {f"_id.{field}": 1 for field in sort_order}}
             ]
-            
+        return pipelines
+    
+    def _generate_trend_analysis(self, date_field: str, time_periods: List[str], group_by: str = "month"):
+        """Generate a trend analysis for specified time periods and grouping"""
+        results = {}
+        collection = self.analytics_db[self.current_collection]
+        
+        for period, pipeline in self._trend_pipelines(date_field, time_periods, group_by).items():
             try:
                 cursor = collection.aggregate(pipeline)
                 results[period] = list(cursor)
             except Exception as e:
                 results[period] = f"Error: {str(e)}"
                 
-        # Format results for display
+        return self._format_trend_analysis(results, group_by)
+    
+    def _format_trend_analysis(self, results: Dict[str, Any], group_by: str) -> str:
+        """Format trend analysis results for display"""
         response = f"Trend analysis of {self.current_collection} by {group_by}\n\n"
         
         for period, data in results.items():
@@ -742,10 +865,13 @@ class MongoDBQueryEngine:
             schema = self.get_collection_schema()
             return f"Schema for {self.current_collection}:\n" + "\n".join(schema)
             
-        elif question.lower() == "collection stats" or question.lower() == "stats":
+        elif question.lower() == "pool stats":
+            return self._format_pool_stats(health_check(), pool_metrics())
+            
+        elif question.lower() in ("collection stats", "stats", "stats exact"):
             if not self.current_collection:
                 return "No collection selected. Use 'use collection [name]' first."
-            stats = self.get_collection_stats()
+            stats = self.get_collection_stats(exact=question.lower() == "stats exact")
             return self._format_stats(stats)
         
         # If no collection is selected yet, ask the user to select one
@@ -804,7 +930,7 @@ class MongoDBQueryEngine:
             # Format each result
             for i, doc in enumerate(results):
                 response += f"Result {i+1}:\n"
-                response += json.dumps(doc, indent=2) + "\n\n"
+                response += dumps(doc, indent=True).decode("utf-8") + "\n\n"
                 
         # If no results found
         elif 'results' in result and not result['results']:
@@ -812,15 +938,35 @@ class MongoDBQueryEngine:
             
         return response
     
+    def _format_pool_stats(self, health: Dict[str, Any], metrics: Dict[str, Any]) -> str:
+        """Format connection pool health and metrics into a readable response"""
+        response = "Connection pools:\n"
+        for name, pool in metrics.items():
+            status = health.get(name, {})
+            state = f"ok ({status['latency_ms']} ms)" if status.get("ok") else f"unhealthy ({status.get('error', 'unknown')})"
+            response += f"\n{name}: {state}\n"
+            response += f"- Open connections: {pool['open_connections']}, checked out: {pool['checked_out']}\n"
+            response += f"- Checkouts: {pool['checkouts']}, failures: {pool['checkout_failures']}\n"
+            response += f"- Checkout wait: avg {pool['avg_wait_ms']} ms, max {pool['max_wait_ms']} ms\n"
+        return response
+    
     def _format_stats(self, stats: Dict[str, Any]) -> str:
         """Format collection statistics into a readable response"""
         response = f"Statistics for collection: {stats['name']}\n"
-        response += f"Total documents: {stats['document_count']}\n\n"
+        estimate_note = " (estimated)" if stats.get("count_estimated") else ""
+        response += f"Total documents: {stats['document_count']}{estimate_note}\n"
+        if 'sampled_documents' in stats:
+            response += f"Field statistics computed from a random sample of {stats['sampled_documents']} documents\n"
+        response += "\n"
         
         response += "Field statistics:\n"
         for field, field_stats in stats['field_stats'].items():
             response += f"\nField: {field}\n"
-            response += f"- Distinct values: {field_stats['distinct_values']}\n"
+            if field_stats.get('lower_bound'):
+                response += f"- Distinct values: ≥{field_stats['distinct_values']} (sampled)\n"
+            else:
+                approximate = "~" if field_stats.get('approximate') else ""
+                response += f"- Distinct values: {approximate}{field_stats['distinct_values']}\n"
             
             if 'distribution' in field_stats:
                 response += "- Value distribution:\n"
@@ -871,7 +1017,8 @@ def main():
         print("- list collections: Show all collections in the database")
         print("- use collection [name]: Select a collection to query")
         print("- show schema: Show the schema for the current collection")
-        print("- stats: Show statistics for the current collection")
+        print("- stats: Show statistics for the current collection (stats exact: with an exact document count)")
+        print("- pool stats: Show MongoDB connection pool health and metrics")
         print("- [any question]: Ask a question about the current collection")
         print("- exit: Quit the program")
 
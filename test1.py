@@ -1,7 +1,6 @@
 import os
+import threading
 from typing import List, Dict, Any, Optional, Union
-from pymongo import MongoClient
-from bson import json_util, ObjectId
 from chat_history import chat_history_user
 import json
 import ssl
@@ -11,10 +10,30 @@ from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.schema import SystemMessage, HumanMessage
+from pymongo.errors import ExecutionTimeout
+from common.database import get_client, get_database, pool_metrics, health_check
+from common.query_cache import QueryCache, schema_fingerprint, context_fingerprint
+from common.schema_catalog import SchemaCatalog
+from common.counts import CountProvider
+from common.collection_stats import CollectionStatsBuilder
+from common.hll import FieldSketches, SketchStore
+from common.prompt_builder import SchemaPromptBuilder
+from common.doc_serializer import count_tokens
+from common.prompt_cache import PromptPrefixCache, timed_invoke
+from common.result_cache import ResultCache, result_key
+from common.serializer import to_jsonable, dumps
+from common.query_guard import QueryGuard
+from common.pipeline_optimizer import PipelineOptimizer
+from common.sargable import rewrite_query
+from common.conversation import ConversationMemory
+from common.schema_inference import infer_schema, analyze_document
 
 # Load environment variables
 load_dotenv()
 
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+QUERY_SYSTEM_INSTRUCTION = "You are a MongoDB query expert assistant that outputs only valid JSON objects."
+
 class MongoDBQueryEngine:
     def __init__(
         self,
@@ -25,7 +44,7 @@ class MongoDBQueryEngine:
         self.mongodb_uri = mongodb_uri
         self.database_name = database_name
         self.google_api_key = google_api_key
-        self.client = MongoClient(
+        self.client = get_client(
             mongodb_uri,
             serverSelectionTimeoutMS=30000,
             connectTimeoutMS=30000,
@@ -33,16 +52,18 @@ class MongoDBQueryEngine:
             tlsAllowInvalidCertificates=True
         )
         self.db = self.client[database_name]
+        # Heavy read-only work (stats, trends) goes to secondaries when available
+        self.analytics_db = get_database(self.client, database_name, analytics=True)
         self.collections = {}  # Cache of collection metadata
         self.current_collection = None
         
         # Initialize chat history to track conversation context
-        self.chat_history = chat_history_user
+        self.chat_history = ConversationMemory(chat_history_user)
         # Keep last 5 interactions for context
         
         # Initialize LLM for query generation
         self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
+            model=LLM_MODEL,
             google_api_key=google_api_key,
             temperature=0.2
         )
@@ -54,6 +75,39 @@ class MongoDBQueryEngine:
             task_type="retrieval_query"
         )
         
+        # Cache generated queries so repeated questions skip the LLM
+        similarity_threshold = os.getenv("QUERY_CACHE_SIMILARITY")
+        self.query_cache = QueryCache(
+            max_entries=int(os.getenv("QUERY_CACHE_SIZE", "256")),
+            ttl_seconds=int(os.getenv("QUERY_CACHE_TTL", "3600")),
+            embeddings=self.embeddings,
+            similarity_threshold=float(similarity_threshold) if similarity_threshold else None
+        )
+        
+        # Persisted collection metadata lets startup skip re-sampling collections
+        self.schema_catalog = SchemaCatalog(self.database_name)
+        
+        # Document counts come from collection metadata unless an exact count is asked for
+        self.count_provider = CountProvider()
+        
+        # Persisted HyperLogLog sketches give field cardinalities without materializing distinct values
+        self.sketch_store = SketchStore(self.database_name)
+        
+        # Keeps the schema part of query prompts within a fixed token budget
+        self.prompt_builder = SchemaPromptBuilder()
+        
+        # Static per-collection prompt prefixes, registered as provider cached content when enabled
+        self.prompt_prefixes = PromptPrefixCache(LLM_MODEL, google_api_key, QUERY_SYSTEM_INSTRUCTION)
+        
+        # Executed query results, invalidated when the collection changes
+        self.result_cache = ResultCache()
+        
+        # Explain-based cost check and time limit for generated queries
+        self.query_guard = QueryGuard()
+        
+        # Rewrites generated aggregation pipelines before they run
+        self.pipeline_optimizer = PipelineOptimizer()
+        
         # Load database schema
         self._load_database_schema()
 
@@ -75,32 +129,28 @@ class MongoDBQueryEngine:
         #     if col_name == "system.views":
         #         continue
         #     print(f"Analyzing collection: {col_name}")
-        self._analyze_collection("portcalls")
+        if not self._load_from_catalog("portcalls"):
+            self._analyze_collection("portcalls")
     
     def _analyze_collection(self, collection_name: str, sample_size: int = 100):
         """Analyze a collection's schema from a sample of documents"""
         collection = self.db[collection_name]
         
-        # Count total documents
-        total_count = collection.count_documents({})
+        # Estimated total documents (metadata only, no collection scan)
+        total_count = self.count_provider.count(collection)
         
-        # Get a sample of documents
-        sample_docs = list(collection.find().limit(sample_size))
-        
-        # Extract field information
-        fields = {}
-        for doc in sample_docs:
-            self._analyze_document(doc, fields)
+        # Server-side inference, or a random sample grown until the field/type set stops changing
+        sample_docs, fields = infer_schema(collection, self._analyze_document, batch_size=sample_size)
         
         # Convert sets to lists for JSON serialization
         for field in fields:
             fields[field]["types"] = list(fields[field]["types"])
         
-        # Store collection metadata
-        self.collections[collection_name] = {
+        # Build collection metadata
+        metadata = {
             "total_documents": total_count,
             "fields": fields,
-            "sample_document": json.loads(json_util.dumps(sample_docs[0] if sample_docs else {}))
+            "sample_document": to_jsonable(sample_docs[0] if sample_docs else {})
         }
         
         # Detect date fields for trend analysis
@@ -108,42 +158,41 @@ class MongoDBQueryEngine:
                       if "datetime" in info["types"] or "date" in info["types"]]
         
         if date_fields:
-            self.collections[collection_name]["date_fields"] = date_fields
+            metadata["date_fields"] = date_fields
+        
+        # Swap in the finished metadata at once so background refreshes never expose a partial entry
+        self.collections[collection_name] = metadata
+        self.schema_catalog.put(collection_name, metadata)
     
-    def _analyze_document(self, doc, fields, prefix=""):
-        """Recursively analyze document structure including nested fields"""
-        for key, value in doc.items():
-            field_name = f"{prefix}{key}"
-            
-            if field_name not in fields:
-                fields[field_name] = {"types": set(), "examples": []}
-            
-            # Handle special types
-            if isinstance(value, datetime.datetime):
-                value_type = "datetime"
-            elif isinstance(value, ObjectId):
-                value_type = "objectid"
-            else:
-                value_type = type(value).__name__
-                
-            fields[field_name]["types"].add(value_type)
-            
-            # Store examples for non-ID fields
-            if field_name != "_id" and len(fields[field_name]["examples"]) < 3:
-                fields[field_name]["examples"].append(str(value))
-            
-            # Recursively analyze nested documents
-            if isinstance(value, dict):
-                self._analyze_document(value, fields, f"{field_name}.")
-            
-            # Handle arrays of objects
-            elif isinstance(value, list) and value and isinstance(value[0], dict):
-                # Sample the first item in the array
-                self._analyze_document(value[0], fields, f"{field_name}[].")
+    def _analyze_document(self, doc, fields):
+        """Analyze document structure including nested fields and all array elements"""
+        analyze_document(doc, fields)
+    
+    def _load_from_catalog(self, collection_name: str) -> bool:
+        """Load collection metadata from the schema catalog, refreshing stale entries in the background"""
+        metadata = self.schema_catalog.get(collection_name)
+        if metadata is None:
+            return False
+        
+        self.collections[collection_name] = metadata
+        print(f"Loaded schema for {collection_name} from catalog")
+        if self.schema_catalog.is_stale(collection_name):
+            self._refresh_in_background(collection_name)
+        return True
+    
+    def _refresh_in_background(self, collection_name: str):
+        """Re-analyze a collection without blocking the caller"""
+        def refresh():
+            try:
+                self._analyze_collection(collection_name)
+            except Exception as e:
+                print(f"Background schema refresh of {collection_name} failed: {e}")
+        
+        threading.Thread(target=refresh, daemon=True).start()
     
     def set_current_collection(self, collection_name: str):
         """Set the current collection for queries"""
-        if collection_name not in self.collections:
+        if collection_name not in self.collections and not self._load_from_catalog(collection_name):
             if collection_name in self.db.list_collection_names():
                 self._analyze_collection(collection_name)
             else:
@@ -180,6 +229,13 @@ class MongoDBQueryEngine:
         
         return schema_info
 
+    def _make_sargable(self, query_data: Dict[str, Any]):
+        """Rewrite date-function predicates into index-friendly ranges, before date formats are normalized"""
+        query, rewrites = rewrite_query(query_data.get("query_type", "").lower(), query_data["query"])
+        for rewrite in rewrites:
+            print(f"Sargable rewrite: {rewrite}")
+        return query
+    
     def _fix_date_formats(self, query):
         """Fix date formats in MongoDB queries by converting string date operators to proper MongoDB operators"""
         if isinstance(query, dict):
@@ -214,78 +270,30 @@ class MongoDBQueryEngine:
         else:
             return query
 
-    def generate_mongodb_query(self, question: str):
-        """Generate a MongoDB query or aggregation pipeline based on a natural language question with full chat history context"""
-        # Prepare context with collection information
-        if not self.current_collection:
-            raise ValueError("No collection selected. Please select a collection first.")
-        
-        collection_info = self.collections[self.current_collection]
-        sample_doc = collection_info["sample_document"]
-        
-        # Format field information
-        fields_info = "\n".join([
-            f"- {field} (types: {', '.join(info['types'])}, examples: {', '.join(info['examples']) if info['examples'] else 'N/A'})"
-            for field, info in collection_info["fields"].items()
-        ])
+    def _build_query_prefix(self, collection_info: Dict[str, Any]) -> str:
+        """Build the question-independent part of the query prompt for the current collection"""
+        # Budgeted field list and compacted sample document, in schema order
+        cardinalities = self.sketch_store.cardinalities(self.current_collection)
+        lower_bounds = self.sketch_store.lower_bounds(self.current_collection)
+        fields_info, sample_doc_text, prompt_report = self.prompt_builder.build("", collection_info, cardinalities,
+                                                                                lower_bounds)
+        print(f"Prompt schema: {prompt_report['fields_included']}/{prompt_report['fields_total']} fields, "
+              f"{prompt_report['field_tokens']} field tokens, {prompt_report['sample_tokens']} sample tokens")
         
         # Add specialized handling for time-series and trend analysis
         trend_guidance = ""
         if "date_fields" in collection_info and collection_info["date_fields"]:
             date_fields = collection_info["date_fields"]
             trend_guidance = f"""
-            For time-series or trend analysis:
-            - Available date fields: {', '.join(date_fields)}
-            - For current month, use: {{ $gte: new Date(new Date().getFullYear(), new Date().getMonth(), 1), $lt: new Date(new Date().getFullYear(), new Date().getMonth()+1, 1) }}
-            - Avoid using $dateFromString with format specifiers - use simpler date expressions like ISODate()
-            - For aggregations by time period, use $group with date operators like $dayOfMonth, $month, $year
-            """
-        
-        # Format the full chat history for context with the new structure
-        chat_context = ""
-        if self.chat_history:
-            chat_context = "Previous conversation context:\n"
-            for i in range(0, len(self.chat_history), 2):  # Process pairs of messages
-                if i+1 < len(self.chat_history):  # Ensure we have both user and model message
-                    user_msg = self.chat_history[i]["parts"][0]
-                    model_msg = self.chat_history[i+1]["parts"][0]
-                    
-                    chat_context += f"Question {i//2+1}: {user_msg}\n"
-                    
-                    # Try to extract query information from the model response if it contains JSON
-                    try:
-                        # Look for JSON code blocks in the response
-                        json_pattern = r'```(?:javascript|json)?\s*([\s\S]*?)\s*```'
-                        match = re.search(json_pattern, model_msg)
-                        
-                        if match:
-                            # Try to parse the code block as JSON
-                            try:
-                                query_data = json.loads(match.group(1))
-                                if isinstance(query_data, dict) and "query" in query_data:
-                                    query_str = json.dumps(query_data["query"], indent=2)
-                                    chat_context += f"Query {i//2+1}: {query_str}\n"
-                                    
-                                    if "explanation" in query_data:
-                                        chat_context += f"Explanation {i//2+1}: {query_data['explanation']}\n"
-                            except:
-                                # Not valid JSON, use the code block as is
-                                brief_code = match.group(1)[:150] + "..." if len(match.group(1)) > 150 else match.group(1)
-                                chat_context += f"Code {i//2+1}: {brief_code}\n"
-                        else:
-                            # No code block found, use the text response
-                            brief_response = model_msg.split("\n\n")[0] if "\n\n" in model_msg else model_msg[:100]
-                            chat_context += f"Response {i//2+1}: {brief_response}\n"
-                    except Exception:
-                        # Fall back to using the raw response
-                        brief_response = model_msg.split("\n\n")[0] if "\n\n" in model_msg else model_msg[:100]
-                        chat_context += f"Response {i//2+1}: {brief_response}\n"
-            
-            chat_context += "\n"
-        
-        # Create prompt for query generation
-        prompt = f"""
-        You are a MongoDB query expert. Generate a MongoDB query or aggregation pipeline to answer the following question.
+        For time-series or trend analysis:
+        - Available date fields: {', '.join(date_fields)}
+        - For current month, use: {{ $gte: new Date(new Date().getFullYear(), new Date().getMonth(), 1), $lt: new Date(new Date().getFullYear(), new Date().getMonth()+1, 1) }}
+        - Avoid using $dateFromString with format specifiers - use simpler date expressions like ISODate()
+        - For aggregations by time period, use $group with date operators like $dayOfMonth, $month, $year
+        """
+        
+        return f"""
+        You are a MongoDB query expert. Generate a MongoDB query or aggregation pipeline to answer the current user question at the end.
 
         Database: {self.database_name}
         Collection: {self.current_collection}
@@ -295,13 +303,9 @@ class MongoDBQueryEngine:
         {fields_info}
 
         Sample document:
-        {json.dumps(sample_doc, indent=2)}
+        {sample_doc_text}
         
         {trend_guidance}
-        
-        {chat_context}
-
-        Current user question: {question}
 
         Important guidelines:
         1. For time trends, use standard MongoDB date operators like $dayOfMonth, $month, $year in $group stages
@@ -326,16 +330,65 @@ class MongoDBQueryEngine:
         "explanation": "..."
         }}
         ```
-        """
+
+"""
+    
+    def generate_mongodb_query(self, question: str):
+        """Generate a MongoDB query or aggregation pipeline based on a natural language question with full chat history context"""
+        # Prepare context with collection information
+        if not self.current_collection:
+            raise ValueError("No collection selected. Please select a collection first.")
+        
+        collection_info = self.collections[self.current_collection]
+        
+        # Recent turns plus a bounded summary of older ones; extracts are cached per message
+        chat_context = self.chat_history.context()
         
-        # Generate query using LLM
-        messages = [
-            SystemMessage(content="You are a MongoDB query expert assistant that outputs only valid JSON objects."),
-            HumanMessage(content=prompt)
-        ]
+        # Any question may lean on the conversation, so cached queries are keyed on it as well as the schema
+        fingerprint = schema_fingerprint(collection_info)
+        cache_fingerprint = context_fingerprint(fingerprint, chat_context)
+        cached_query = self.query_cache.get(question, self.current_collection, cache_fingerprint)
+        if cached_query is not None:
+            print(f"Query cache hit for: {question}")
+            return cached_query
         
-        response = self.llm.invoke(messages)
-        response_text = response.content
+        # The collection part of the prompt is built once per schema and reused for every question
+        prefix = self.prompt_prefixes.get(
+            self.current_collection,
+            fingerprint,
+            lambda: self._build_query_prefix(collection_info)
+        )
+        
+        relevant_context = ""
+        relevant = self.prompt_builder.relevant_fields(question, collection_info["fields"])
+        if relevant:
+            cardinalities = self.sketch_store.cardinalities(self.current_collection)
+            lower_bounds = self.sketch_store.lower_bounds(self.current_collection)
+            relevant_context = "Fields most relevant to this question:\n" + "\n".join(
+                self.prompt_builder.field_line(field, collection_info["fields"][field], cardinalities.get(field),
+                                               field in lower_bounds)
+                for field in relevant
+            ) + "\n\n"
+        
+        # Only the conversation and the question change between calls
+        delta = f"{relevant_context}{chat_context}Current user question: {question}\n"
+        if prefix.cached_content:
+            messages, llm_kwargs = [HumanMessage(content=delta)], {"cached_content": prefix.cached_content}
+        else:
+            prompt = prefix.text + delta
+            print(f"Query prompt: ~{count_tokens(prompt)} tokens")
+            messages, llm_kwargs = [SystemMessage(content=QUERY_SYSTEM_INSTRUCTION), HumanMessage(content=prompt)], {}
+        
+        try:
+            response_text = timed_invoke(self.llm, messages, **llm_kwargs)
+        except Exception as e:
+            if not llm_kwargs:
+                raise
+            # The cached context may have been evicted provider-side; resend the full prompt
+            print(f"Cached prompt context failed ({e}), sending the full prompt")
+            self.prompt_prefixes.discard_cached_content(self.current_collection)
+            messages = [SystemMessage(content=QUERY_SYSTEM_INSTRUCTION), HumanMessage(content=prefix.text + delta)]
+            response_text = timed_invoke(self.llm, messages)
         print("yyyyyyyyyyyyyyyyyyyy",response_text)
         # Extract JSON from the response
         json_pattern = r'```(?:json)?\s*([\s\S]*?)\s*```'
@@ -349,7 +402,8 @@ class MongoDBQueryEngine:
                 print("=====================")
                 # Fix potential date format issues
                 if "query" in query_data:
-                    query_data["query"] = self._fix_date_formats(query_data["query"])
+                    query_data["query"] = self._fix_date_formats(self._make_sargable(query_data))
+                self.query_cache.put(question, self.current_collection, cache_fingerprint, query_data)
                 return query_data
             except json.JSONDecodeError as e:
                 raise ValueError(f"Generated invalid JSON: {e}\nJSON string: {json_str}")
@@ -360,7 +414,8 @@ class MongoDBQueryEngine:
                 query_data = json.loads(response_text)
                 if "query" in query_data:
                     print("tttttttttttttttttttttttttt")
-                    query_data["query"] = self._fix_date_formats(query_data["query"])
+                    query_data["query"] = self._fix_date_formats(self._make_sargable(query_data))
+                self.query_cache.put(question, self.current_collection, cache_fingerprint, query_data)
                 return query_data
             except:
                 raise ValueError(f"Could not extract valid JSON from response: {response_text}")
@@ -440,36 +495,62 @@ class MongoDBQueryEngine:
         # Pre-process and fix date-related issues in the query
         query = self._handle_date_in_query(query)
         
+        if query_type == "aggregate" and isinstance(query, list):
+            # Add a $limit stage if not present for safety
+            has_limit = any(stage.get("$limit") is not None for stage in query if isinstance(stage, dict))
+            if not has_limit:
+                query.append({"$limit": 50})
+        
         print(f"Executing {query_type} query: {json.dumps(query, default=str)}")
         print(f"Explanation: {explanation}")
         
+        # Rewrite generated pipelines so filters, projections and limits apply as early as possible
+        original_query, rewrites = query, []
+        if query_type == "aggregate":
+            query, rewrites = self.pipeline_optimizer.optimize(query)
+        
+        # Identical queries are served from the result cache until the collection changes
+        cache_key = result_key(self.database_name, self.current_collection, query_type, query)
+        self.result_cache.ensure_invalidation(collection)
+        generation = self.result_cache.generation(collection.full_name)
+        cached_result = self.result_cache.get(cache_key)
+        if cached_result is not None:
+            print("Result cache hit")
+            cached_result["explanation"] = explanation
+            return cached_result
+        
+        # Explain first: expensive queries are routed to the analytics node or refused
+        if self.query_guard.enabled:
+            estimate = self.query_guard.check(collection, query_type, query, self.count_provider.count(collection))
+            if estimate.route == "analytics":
+                collection = self.analytics_db[self.current_collection]
+        max_time_ms = self.query_guard.max_time_ms
+        
+        # Log how the rewrites changed the query plan
+        self.pipeline_optimizer.log_comparison(collection, original_query, query, rewrites)
+        
         try:
             if query_type == "find":
-                cursor = collection.find(query)
+                cursor = collection.find(query, max_time_ms=max_time_ms)
                 results = list(cursor.limit(50))  # Limit to first 50 results for safety
-                return {
+                result = {
                     "count": len(results),
-                    "results": json.loads(json_util.dumps(results)),
+                    "results": to_jsonable(results),
                     "explanation": explanation
                 }
             
             elif query_type == "aggregate":
-                # Add a $limit stage if not present for safety
-                has_limit = any(stage.get("$limit") is not None for stage in query if isinstance(stage, dict))
-                if not has_limit:
-                    query.append({"$limit": 50})
-                
-                cursor = collection.aggregate(query)
+                cursor = collection.aggregate(query, maxTimeMS=max_time_ms, **self.pipeline_optimizer.options(query))
                 results = list(cursor)
-                return {
+                result = {
                     "count": len(results),
-                    "results": json.loads(json_util.dumps(results)),
+                    "results": to_jsonable(results),
                     "explanation": explanation
                 }
             
             elif query_type == "count":
-                count = collection.count_documents(query)
-                return {
+                count = collection.count_documents(query, maxTimeMS=max_time_ms)
+                result = {
                     "count": count,
                     "explanation": explanation
                 }
@@ -480,8 +561,8 @@ class MongoDBQueryEngine:
                 if not field:
                     raise ValueError("'field' is required for distinct queries")
                 
-                values = collection.distinct(field, filter_query)
-                return {
+                values = collection.distinct(field, filter_query, maxTimeMS=max_time_ms)
+                result = {
                     "count": len(values),
                     "values": values,
                     "explanation": explanation
@@ -490,8 +571,13 @@ class MongoDBQueryEngine:
             else:
                 raise ValueError(f"Unsupported query type: {query_type}")
                 
+        except ExecutionTimeout:
+            raise RuntimeError(f"Query exceeded the {max_time_ms} ms time limit. Please ask a narrower question.")
         except Exception as e:
             raise RuntimeError(f"Error executing query: {str(e)}")
+        
+        self.result_cache.put(cache_key, collection.full_name, result, generation)
+        return result
     
     def get_time_range_query(self, time_range: str):
         """Generate a date range query based on a time range description"""
@@ -541,96 +627,51 @@ class MongoDBQueryEngine:
         
         return {"$gte": start_date, "$lt": end_date}
     
-    def get_collection_stats(self, collection_name: Optional[str] = None):
+    def get_collection_stats(self, collection_name: Optional[str] = None, exact: bool = False):
         """Get detailed statistics about a collection"""
         col_name = collection_name or self.current_collection
         
         if not col_name:
             raise ValueError("No collection specified and no current collection set")
         
-        collection = self.db[col_name]
+        collection = self.analytics_db[col_name]
         
         # Get basic collection stats
         stats = {
             "name": col_name,
-            "document_count": collection.count_documents({}),
+            "document_count": self.count_provider.count(collection, exact=exact),
+            "count_estimated": not exact,
             "field_stats": {}
         }
         
-        # For each field, get distribution of values if cardinality is reasonable
         if col_name in self.collections:
-            for field_name in self.collections[col_name]["fields"]:
-                if field_name == "_id":
-                    continue
-                    
-                # Get unique value count
-                distinct_count = len(collection.distinct(field_name))
-                
-                if distinct_count <= 15:  # Only get distribution for low-cardinality fields
-                    pipeline = [
-                        {"$group": {"_id": f"${field_name}", "count": {"$sum": 1}}},
-                        {"$sort": {"count": -1}},
-                        {"$limit": 10}
-                    ]
-                    distribution = list(collection.aggregate(pipeline))
-                    
-                    stats["field_stats"][field_name] = {
-                        "distinct_values": distinct_count,
-                        "distribution": [{"value": item["_id"], "count": item["count"]} for item in distribution]
-                    }
-                else:
-                    stats["field_stats"][field_name] = {
-                        "distinct_values": distinct_count
-                    }
-                    
-            # Add time series stats if date fields exist
-            if "date_fields" in self.collections[col_name] and self.collections[col_name]["date_fields"]:
-                primary_date_field = self.collections[col_name]["date_fields"][0]
-                stats["time_stats"] = {}
-                
-                # Get date range
-                pipeline = [
-                    {"$group": {
-                        "_id": None,
-                        "min_date": {"$min": f"${primary_date_field}"},
-                        "max_date": {"$max": f"${primary_date_field}"}
-                    }}
-                ]
-                date_range = list(collection.aggregate(pipeline))
-                if date_range:
-                    stats["time_stats"]["date_range"] = {
-                        "min": date_range[0]["min_date"],
-                        "max": date_range[0]["max_date"]
-                    }
-                
-                # Get counts by month for recent data
-                pipeline = [
-                    {"$match": {
-                        primary_date_field: {
-                            "$gte": datetime.datetime.now() - relativedelta(months=6)
-                        }
-                    }},
-                    {"$group": {
-                        "_id": {
-                            "year": {"$year": f"${primary_date_field}"},
-                            "month": {"$month": f"${primary_date_field}"}
-                        },
-                        "count": {"$sum": 1}
-                    }},
-                    {"$sort": {"_id.year": 1, "_id.month": 1}}
-                ]
-                monthly_counts = list(collection.aggregate(pipeline))
-                if monthly_counts:
-                    stats["time_stats"]["monthly_counts"] = [
-                        {
-                            "year": item["_id"]["year"],
-                            "month": item["_id"]["month"],
-                            "count": item["count"]
-                        }
-                        for item in monthly_counts
-                    ]
+            metadata = self.collections[col_name]
+            builder = CollectionStatsBuilder(
+                metadata["fields"],
+                date_field=(metadata.get("date_fields") or [None])[0],
+                document_count=stats["document_count"],
+                cardinalities=self._field_cardinalities(collection, col_name, stats["document_count"]),
+                lower_bounds=self.sketch_store.lower_bounds(col_name)
+            )
+            
+            # All field cardinalities, distributions and time stats in a few $facet passes
+            results = [next(collection.aggregate(pipeline, allowDiskUse=True), {}) for pipeline in builder.pipelines()]
+            stats.update(builder.merge(results))
         
         return stats
+    
+    def _field_cardinalities(self, collection, collection_name: str, document_count: int) -> Dict[str, int]:
+        """Approximate distinct values per field from persisted sketches, rebuilt when stale"""
+        field_names = [field for field in self.collections[collection_name]["fields"] if field != "_id"]
+        if self.sketch_store.is_stale(collection_name, field_names):
+            print(f"Building cardinality sketches for {collection_name}")
+            sketches = FieldSketches(field_names, document_count=document_count)
+            pipeline = sketches.pipeline()
+            if pipeline is not None:
+                for doc in collection.aggregate(pipeline, allowDiskUse=True):
+                    sketches.add(doc)
+            self.sketch_store.save(collection_name, sketches)
+        return self.sketch_store.cardinalities(collection_name)
 
     def process_analytical_question(self, question: str):
         """Process analytical questions that require specialized handling"""
@@ -708,7 +749,7 @@ class MongoDBQueryEngine:
             
         # Build aggregation pipeline for each time period
         results = {}
-        collection = self.db[self.current_collection]
+        collection = self.analytics_db[self.current_collection]
         
         for period, date_query in date_queries.items():
             pipeline = [
@@ -755,26 +796,26 @@ class MongoDBQueryEngine:
             
         return response
 
+    def clear_chat_history(self):
+        """Forget the conversation so follow-up questions start fresh"""
+        self.chat_history.clear()
+        return "Chat history cleared."
+    
     def ask(self, question: str):
         """Process a natural language question about the data, maintaining full chat history"""
-        # Store user question in the new format
-        user_message = {"role": "user", "parts": [question]}
-        
         # Check if this is a command to switch collections or get info
         if question.lower().startswith("use collection "):
             collection_name = question[len("use collection "):].strip()
             response = self.set_current_collection(collection_name)
             # Add to chat history
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [response]})
+            self.chat_history.add_turn(question, response)
             return response
         
         elif question.lower() == "list collections":
             collections = self.list_collections()
             response = "Available collections:\n" + "\n".join(collections)
             # Add to chat history
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [response]})
+            self.chat_history.add_turn(question, response)
             return response
         
         elif question.lower() == "show schema" or question.lower() == "describe collection":
@@ -784,19 +825,20 @@ class MongoDBQueryEngine:
                 schema = self.get_collection_schema()
                 response = f"Schema for {self.current_collection}:\n" + "\n".join(schema)
             # Add to chat history
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [response]})
+            self.chat_history.add_turn(question, response)
             return response
             
-        elif question.lower() == "collection stats" or question.lower() == "stats":
+        elif question.lower() == "pool stats":
+            return self._format_pool_stats(health_check(), pool_metrics())
+            
+        elif question.lower() in ("collection stats", "stats", "stats exact"):
             if not self.current_collection:
                 response = "No collection selected. Use 'use collection [name]' first."
             else:
-                stats = self.get_collection_stats()
+                stats = self.get_collection_stats(exact=question.lower() == "stats exact")
                 response = self._format_stats(stats)
             # Add to chat history
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [response]})
+            self.chat_history.add_turn(question, response)
             return response
             
         elif question.lower() == "clear history":
@@ -807,8 +849,7 @@ class MongoDBQueryEngine:
         if not self.current_collection:
             response = "Please select a collection first using 'use collection [name]'"
             # Add to chat history
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [response]})
+            self.chat_history.add_turn(question, response)
             return response
         
         try:
@@ -816,8 +857,7 @@ class MongoDBQueryEngine:
             analytical_result = self.process_analytical_question(question)
             if analytical_result:
                 # Add to chat history in new format
-                self.chat_history.append(user_message)
-                self.chat_history.append({"role": "model", "parts": [analytical_result]})
+                self.chat_history.add_turn(question, analytical_result)
                 return analytical_result
                 
             # Otherwise, generate and execute the appropriate MongoDB query
@@ -827,9 +867,6 @@ class MongoDBQueryEngine:
             # Format the result for display
             response = self._format_result(result, question)
             
-            # Add to chat history in new format
-            self.chat_history.append(user_message)
-            
             # Create a model response that includes both the visible output and the query data
             # We'll format the response to show the MongoDB query in a code block to match your example
             formatted_response = response
@@ -839,15 +876,15 @@ class MongoDBQueryEngine:
                 if "```" not in formatted_response:
                     formatted_response = f"{formatted_response}\n\n```javascript\n{query_json}\n```"
             
-            self.chat_history.append({"role": "model", "parts": [formatted_response]})
+            # Add to chat history
+            self.chat_history.add_turn(question, formatted_response)
             
             return response
             
         except Exception as e:
             error_response = f"Error: {str(e)}"
             # Add error to chat history in new format
-            self.chat_history.append(user_message)
-            self.chat_history.append({"role": "model", "parts": [error_response]})
+            self.chat_history.add_turn(question, error_response)
             return error_response
     def _format_result(self, result: Dict[str, Any], question: str) -> str:
         """Format the query result into a readable response"""
@@ -879,7 +916,7 @@ class MongoDBQueryEngine:
             # Format each result
             for i, doc in enumerate(results):
                 response += f"Result {i+1}:\n"
-                response += json.dumps(doc, indent=2) + "\n\n"
+                response += dumps(doc, indent=True).decode("utf-8") + "\n\n"
                 
         # If no results found
         elif 'results' in result and not result['results']:
@@ -887,15 +924,35 @@ class MongoDBQueryEngine:
             
         return response
     
+    def _format_pool_stats(self, health: Dict[str, Any], metrics: Dict[str, Any]) -> str:
+        """Format connection pool health and metrics into a readable response"""
+        response = "Connection pools:\n"
+        for name, pool in metrics.items():
+            status = health.get(name, {})
+            state = f"ok ({status['latency_ms']} ms)" if status.get("ok") else f"unhealthy ({status.get('error', 'unknown')})"
+            response += f"\n{name}: {state}\n"
+            response += f"- Open connections: {pool['open_connections']}, checked out: {pool['checked_out']}\n"
+            response += f"- Checkouts: {pool['checkouts']}, failures: {pool['checkout_failures']}\n"
+            response += f"- Checkout wait: avg {pool['avg_wait_ms']} ms, max {pool['max_wait_ms']} ms\n"
+        return response
+    
     def _format_stats(self, stats: Dict[str, Any]) -> str:
         """Format collection statistics into a readable response"""
         response = f"Statistics for collection: {stats['name']}\n"
-        response += f"Total documents: {stats['document_count']}\n\n"
+        estimate_note = " (estimated)" if stats.get("count_estimated") else ""
+        response += f"Total documents: {stats['document_count']}{estimate_note}\n"
+        if 'sampled_documents' in stats:
+            response += f"Field statistics computed from a random sample of {stats['sampled_documents']} documents\n"
+        response += "\n"
         
         response += "Field statistics:\n"
         for field, field_stats in stats['field_stats'].items():
             response += f"\nField: {field}\n"
-            response += f"- Distinct values: {field_stats['distinct_values']}\n"
+            if field_stats.get('lower_bound'):
+                response += f"- Distinct values: ≥{field_stats['distinct_values']} (sampled)\n"
+            else:
+                approximate = "~" if field_stats.get('approximate') else ""
+                response += f"- Distinct values: {approximate}{field_stats['distinct_values']}\n"
             
             if 'distribution' in field_stats:
                 response += "- Value distribution:\n"
@@ -946,7 +1003,9 @@ def main():
         print("- list collections: Show all collections in the database")
         print("- use collection [name]: Select a collection to query")
         print("- show schema: Show the schema for the current collection")
-        print("- stats: Show statistics for the current collection")
+        print("- stats: Show statistics for the current collection (stats exact: with an exact document count)")
+        print("- pool stats: Show MongoDB connection pool health and metrics")
+        print("- clear history: Forget the conversation so far")
         print("- [any question]: Ask a question about the current collection")
         print("- exit: Quit the program")
 